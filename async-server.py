@@ -0,0 +1,1540 @@
+#!/usr/bin/env python3
+"""Asyncio variant of the audio streaming server.
+
+Serves the same REST and Socket.IO API as server.py and direct-server.py
+from a single event loop (aiohttp and python-socketio's AsyncServer), so an
+open connection costs a coroutine and its buffers rather than a thread.
+Chunks are stored in S3 (--storage s3) or under audio_chunks/ (--storage
+local); blocking storage and SQLite calls, and audio conversion, run on a
+small fixed thread pool and never hold up the loop.
+"""
+import io
+import os
+import time
+import json
+import asyncio
+import functools
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import socketio
+from aiohttp import web
+from audio_codecs import (CODECS, Converter, SilenceGate, codec_for_extension, conversion_target, convert_chunk,
+                          format_key, get_codec)
+from sharding import new_stream_id
+from chunk_index import ChunkIndex, gaps_to_silence
+import export
+import ingest
+import playlist
+import preroll
+import segments
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+# Configuration
+S3_BUCKET = 'emeraldflow-audio-stream'
+STORAGE_DIR = 'audio_chunks'
+CHUNK_DURATION = 5  # seconds
+GAP_FILL_LIMIT = 1.0  # seconds; longer gaps start a new chunk instead of being padded with silence
+SILENCE_HANGOVER = 1.0  # seconds of quiet before a stream's silence gate closes, unless set per stream
+REGISTRY_PATH = 'registry.db'
+IO_THREADS = 8  # threads for blocking storage, registry and conversion calls
+UPLOAD_WORKERS = 4
+UPLOAD_QUEUE_SIZE = 50  # chunks waiting per worker before ingest waits
+UPLOAD_RETRIES = 5
+UPLOAD_RETRY_INTERVAL = 60  # seconds before chunks that could not be stored are queued again
+DEFAULT_FORMAT = {'rate': 44100, 'channels': 1, 'sample_width': 2, 'codec': 'pcm'}
+CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+COMPACT_INTERVAL = 300  # seconds between compaction passes, 0 to disable
+COMPACT_AGE = 3600  # seconds; older chunks of live streams are compacted into segments
+STREAM_IDLE_TIMEOUT = 300  # seconds without audio before a live stream is ended, 0 to keep it open
+STREAM_EVICT_AFTER = 60  # seconds an ended stream stays in memory after it was last used
+REAP_INTERVAL = 10  # seconds between checks for idle and unused streams
+PREROLL_BUFFER = 10  # seconds of recent audio kept per live stream for listeners that join
+EXPORT_WORKERS = export.WORKERS  # chunks read at the same time for one export
+BROADCAST_QUEUE_SIZE = 1000  # buffers waiting to be broadcast before the oldest is dropped
+LISTENER_QUEUE_LIMIT = 100  # packets queued for one listener before it skips ahead
+ACTIVE_STREAMS = {}
+LISTENERS = {}
+
+sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*')
+app = web.Application(client_max_size=64 * 1024 * 1024)
+sio.attach(app)
+routes = web.RouteTableDef()
+io_pool = ThreadPoolExecutor(IO_THREADS, thread_name_prefix='storage-io')
+
+async def run_io(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(io_pool, functools.partial(func, *args, **kwargs))
+
+class S3Storage:
+    def __init__(self, bucket=S3_BUCKET):
+        self.bucket = bucket
+        self.s3 = boto3.client('s3', region_name='us-west-1', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+
+    def path(self, chunk_id):
+        return None
+
+    def put(self, chunk_id, data, metadata):
+        self.s3.put_object(Bucket=self.bucket, Key=chunk_id, Body=data, Metadata=metadata)
+
+    def get(self, chunk_id):
+        return self.s3.get_object(Bucket=self.bucket, Key=chunk_id)['Body'].read()
+
+    def get_range(self, key, offset, size):
+        return self.s3.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={offset}-{offset + size - 1}")['Body'].read()
+
+    def delete(self, keys):
+        for i in range(0, len(keys), 1000):
+            self.s3.delete_objects(Bucket=self.bucket,
+                                   Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+
+    def save_metadata(self, stream_id, metadata):
+        self.s3.put_object(Bucket=self.bucket, Key=f"{stream_id}/metadata.json", Body=json.dumps(metadata))
+
+class LocalStorage:
+    def __init__(self, root=STORAGE_DIR):
+        self.root = root
+
+    def path(self, chunk_id):
+        return os.path.join(self.root, chunk_id)
+
+    def put(self, chunk_id, data, metadata):
+        # Written under a temporary name next to the chunk and renamed into
+        # place, so a chunk file is complete whenever it exists
+        path = self.path(chunk_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.part')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def get(self, chunk_id):
+        with open(self.path(chunk_id), 'rb') as f:
+            return f.read()
+
+    def get_range(self, key, offset, size):
+        with open(self.path(key), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def delete(self, keys):
+        for key in keys:
+            os.unlink(self.path(key))
+
+    def save_metadata(self, stream_id, metadata):
+        os.makedirs(os.path.join(self.root, stream_id), exist_ok=True)
+        with open(os.path.join(self.root, stream_id, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+storage = None
+
+class ChunkCache:
+    """In-memory LRU cache of chunk contents in front of the storage backend.
+
+    Chunks that are still being stored are served from their buffer, and
+    concurrent misses for the same chunk wait on a single read, of the chunk
+    itself or of its byte range in a segment. Chunks
+    converted to listener formats are cached under their own ids, produced
+    by a `load` coroutine function instead of read from storage.
+    """
+
+    def __init__(self, memory_bytes=CACHE_MEMORY_BYTES):
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.pending = {}
+        self.loading = {}
+        self.stats = {'memory_hits': 0, 'pending_hits': 0, 'misses': 0}
+
+    def add_pending(self, chunk_id, data):
+        self.pending[chunk_id] = data
+
+    def remove_pending(self, chunk_id):
+        self.pending.pop(chunk_id, None)
+
+    def put(self, chunk_id, data):
+        if len(data) > self.memory_bytes:
+            return
+        if chunk_id in self.memory:
+            self.memory_size -= len(self.memory.pop(chunk_id))
+        self.memory[chunk_id] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            _, old_data = self.memory.popitem(last=False)
+            self.memory_size -= len(old_data)
+
+    async def get(self, chunk_id, load=None, store=True):
+        # store=False leaves a chunk that was read out of the cache, for one-off reads like exports
+        if chunk_id in self.memory:
+            self.memory.move_to_end(chunk_id)
+            self.stats['memory_hits'] += 1
+            return self.memory[chunk_id]
+        if chunk_id in self.pending:
+            self.stats['pending_hits'] += 1
+            return self.pending[chunk_id]
+
+        # Another request may already be reading this chunk
+        if chunk_id in self.loading:
+            return await asyncio.shield(self.loading[chunk_id])
+
+        self.stats['misses'] += 1
+        future = self.loading[chunk_id] = asyncio.ensure_future(load() if load else read_chunk(chunk_id))
+        try:
+            data = await asyncio.shield(future)
+            if store:
+                self.put(chunk_id, data)
+            return data
+        finally:
+            del self.loading[chunk_id]
+
+    def info(self):
+        return dict(self.stats,
+                    memory_bytes=self.memory_size,
+                    memory_chunks=len(self.memory),
+                    pending_chunks=len(self.pending))
+
+cache = ChunkCache()
+
+class ChunkUploader:
+    """Stores finished chunks from a fixed number of worker tasks.
+
+    Every chunk of a stream goes to the same worker, so a stream's chunks are
+    stored, listed and announced in the order they were recorded. Ingest
+    waits while a worker's queue is full. Chunks that still fail after
+    `retries` attempts are kept in memory and queued again every
+    `retry_interval` seconds; until then their place on the timeline is
+    free for backfill.
+    """
+
+    def __init__(self, workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE, retries=UPLOAD_RETRIES,
+                 retry_interval=UPLOAD_RETRY_INTERVAL):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.queues = []
+        self.tasks = []
+        self.pending = 0
+        self.pending_streams = {}  # stream_id -> chunks waiting to be stored
+        self.failed = 0
+        self.retrying = []  # (stream, entry, data, announce) of chunks that could not be stored
+
+    def start(self):
+        if self.queues:
+            return
+        for _ in range(self.workers):
+            q = asyncio.Queue(maxsize=self.queue_size)
+            self.tasks.append(asyncio.ensure_future(self._run(q)))
+            self.queues.append(q)
+        self.tasks.append(asyncio.ensure_future(self._retry_loop()))
+
+    async def submit(self, stream, entry, data, announce=True):
+        self.start()
+        self.pending += 1
+        self.pending_streams[stream.stream_id] = self.pending_streams.get(stream.stream_id, 0) + 1
+        await self.queues[hash(stream.stream_id) % len(self.queues)].put((stream, entry, data, announce))
+
+    def backlog(self):
+        return self.pending
+
+    def busy(self, stream_id):
+        return stream_id in self.pending_streams or any(item[0].stream_id == stream_id for item in self.retrying)
+
+    async def wait(self):
+        for q in self.queues:
+            await q.join()
+
+    async def _retry_loop(self):
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            await self.retry_failed()
+
+    async def retry_failed(self):
+        """Queues chunks that could not be stored again, unless backfill has stored their audio in the meantime."""
+        failed, self.retrying = self.retrying, []
+        for stream, entry, data, announce in failed:
+            start, end = entry['start'], entry['start'] + entry['frames']
+            frame_bytes = stream.codec.bytes_per_frame(stream.format)
+            async with stream.lock:
+                holes = list(stream._holes(start, end))
+                if holes == [(start, end)]:
+                    stream.uploading.add((start, end))
+                    cache.add_pending(entry['chunk_id'], data)
+                    await self.submit(stream, entry, data, announce)
+                elif holes and frame_bytes is not None:
+                    # Only the frames still missing are stored, like backfill does
+                    for first, last in holes:
+                        await stream._save_backfill(first, last - first,
+                                                    data[(first - start) * frame_bytes:(last - start) * frame_bytes])
+                elif holes:
+                    print(f"Chunk {entry['chunk_id']} overlaps audio stored since, dropping it")
+
+    async def _upload(self, entry, data, audio_format):
+        chunk_id = entry['chunk_id']
+        metadata = {key: str(value) for key, value in audio_format.items()}
+        metadata['frames'] = str(entry['frames'])
+        delay = 0.5
+        for attempt in range(self.retries):
+            try:
+                await run_io(storage.put, chunk_id, data, metadata)
+                return True
+            except Exception as e:
+                print(f"Error storing chunk {chunk_id} (attempt {attempt + 1}/{self.retries}): {e}")
+                if attempt + 1 < self.retries:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+        return False
+
+    async def _run(self, q):
+        while True:
+            stream, entry, data, announce = await q.get()
+            chunk_id = entry['chunk_id']
+            try:
+                if await self._upload(entry, data, stream.format):
+                    # Listeners are about to ask for this chunk, keep it hot
+                    cache.put(chunk_id, data)
+                    cache.remove_pending(chunk_id)
+                    stream.index.insert(entry)
+                    stream.uploading.discard((entry['start'], entry['start'] + entry['frames']))
+                    await run_io(registry.add_chunk, stream.stream_id, entry)
+
+                    # Notify all listeners; backfilled chunks are not news to them
+                    if announce:
+                        await sio.emit('new_chunk', {'chunk_id': chunk_id}, room=stream.stream_id)
+                else:
+                    # Kept in memory for a later attempt; its frames are no
+                    # longer taken, so backfill can store them meanwhile
+                    cache.remove_pending(chunk_id)
+                    stream.uploading.discard((entry['start'], entry['start'] + entry['frames']))
+                    self.failed += 1
+                    self.retrying.append((stream, entry, data, announce))
+                    print(f"Giving up on chunk {chunk_id} for now, keeping it in memory")
+            except Exception as e:
+                print(f"Error finishing chunk {chunk_id}: {e}")
+            finally:
+                self.pending -= 1
+                self.pending_streams[stream.stream_id] -= 1
+                if not self.pending_streams[stream.stream_id]:
+                    del self.pending_streams[stream.stream_id]
+                q.task_done()
+
+uploader = ChunkUploader()
+
+class Broadcaster:
+    """Fans live audio out to listeners from a background task.
+
+    Ingest only enqueues; each buffer is then emitted once to the stream's
+    live room. Listeners whose outgoing packet queue grows past
+    LISTENER_QUEUE_LIMIT are taken out of the live room until they catch
+    up, so they skip ahead instead of holding back everyone else.
+    Listeners that asked for another format share one converter and one
+    room per stream and format, so each buffer is converted once per format.
+    """
+
+    def __init__(self, queue_size=BROADCAST_QUEUE_SIZE, listener_limit=LISTENER_QUEUE_LIMIT):
+        self.queue_size = queue_size
+        self.queue = None
+        self.listener_limit = listener_limit
+        self.lagging = {}
+        self.converters = {}  # stream_id -> {format key: Converter}
+        self.dropped = 0
+        self.skipped = 0
+        self._task = None
+        self.emitting = asyncio.Lock()  # held while a packet goes out, so listeners join between packets
+
+    def start(self):
+        if self._task is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.ensure_future(self._run())
+
+    def publish(self, stream_id, start, data, silence=0):
+        self.start()
+        if self.queue.full():
+            # Drop the oldest buffer rather than hold up ingest
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait((stream_id, start, data, silence))
+
+    def _pending_packets(self, sid):
+        try:
+            eio_sid = sio.manager.eio_sid_from_sid(sid, '/')
+            return sio.eio.sockets[eio_sid].queue.qsize()
+        except (KeyError, AttributeError):
+            return 0
+
+    def _check_listeners(self):
+        for stream_id, listeners in list(LISTENERS.items()):
+            for sid, target in list(listeners.items()):
+                pending = self._pending_packets(sid)
+                if sid in self.lagging:
+                    if pending <= self.listener_limit // 4:
+                        sio.enter_room(sid, live_room(stream_id, target))
+                        del self.lagging[sid]
+                elif pending > self.listener_limit:
+                    sio.leave_room(sid, live_room(stream_id, target))
+                    self.lagging[sid] = stream_id
+                    self.skipped += 1
+        for sid in list(self.lagging):
+            if self.lagging[sid] not in LISTENERS or sid not in LISTENERS[self.lagging[sid]]:
+                del self.lagging[sid]
+        for stream_id in list(self.converters):
+            if stream_id not in LISTENERS:
+                del self.converters[stream_id]
+
+    async def _emit_converted(self, stream_id, start, data, silence):
+        targets = {format_key(target): target for target in LISTENERS.get(stream_id, {}).values() if target}
+        converters = self.converters.setdefault(stream_id, {})
+        for key in list(converters):
+            if key not in targets:
+                del converters[key]
+
+        frames = None
+        for key, target in targets.items():
+            converter = converters.get(key)
+            if converter is None:
+                converter = converters[key] = Converter(ACTIVE_STREAMS[stream_id].format, target)
+            if silence:
+                # Silence only needs its length scaled to the target rate
+                message = {'stream_id': stream_id, 'start': start,
+                           'silence': round(silence * target['rate'] / converter.source['rate'])}
+            else:
+                # Every converter of a stream decodes the same source format;
+                # conversion runs off the event loop, one packet at a time
+                if frames is None:
+                    frames = await run_io(converter.decode, data)
+                message = {'stream_id': stream_id, 'start': start, 'data': await run_io(converter.process, frames)}
+            await sio.emit('audio_data', message, room=live_room(stream_id, target))
+
+    async def _run(self):
+        last_check = time.monotonic()
+        while True:
+            try:
+                stream_id, start, data, silence = await asyncio.wait_for(self.queue.get(), timeout=0.5)
+                # Silence goes out as a frame count instead of audio
+                if silence:
+                    message = {'stream_id': stream_id, 'start': start, 'silence': silence}
+                else:
+                    message = {'stream_id': stream_id, 'start': start, 'data': data}
+                async with self.emitting:
+                    await sio.emit('audio_data', message, room=live_room(stream_id))
+                    await self._emit_converted(stream_id, start, data, silence)
+            except asyncio.TimeoutError:
+                pass
+            except Exception as e:
+                print(f"Error broadcasting audio: {e}")
+
+            if time.monotonic() - last_check >= 0.2:
+                self._check_listeners()
+                last_check = time.monotonic()
+
+def live_room(stream_id, target=None):
+    if target:
+        return f"{stream_id}/live/{format_key(target)}"
+    return f"{stream_id}/live"
+
+def convert_packets(packets, converter):
+    converted = []
+    for start, data, count in packets:
+        if data is None:
+            converted.append((start, None, round(count * converter.target['rate'] / converter.source['rate'])))
+            continue
+        converted.append((start, converter.process(converter.decode(data)), count))
+    return converted
+
+async def preroll_packets(stream, converter, frames, after=None):
+    """Returns the newest packets of a live stream, covering `frames` sample frames and starting after `after`.
+
+    With a converter they are converted to the listener's format, off the
+    event loop, carrying on from the packets it converted before.
+    """
+    packets = [packet for packet in stream.recent.last(frames) if after is None or packet[0] > after]
+    if converter is None:
+        return packets
+    return await run_io(convert_packets, packets, converter)
+
+broadcaster = Broadcaster()
+
+class StreamRegistry:
+    """Durable record of streams and their chunks, kept in SQLite.
+
+    The schema is shared with server.py and direct-server.py. Calls block,
+    so the server makes them through run_io.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS streams (
+                    stream_id TEXT PRIMARY KEY,
+                    format TEXT NOT NULL,
+                    is_live INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    options TEXT
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    chunk_id TEXT PRIMARY KEY,
+                    stream_id TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    frames INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    metadata TEXT,
+                    segment TEXT,
+                    segment_offset INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS chunks_by_stream ON chunks (stream_id, start);
+            """)
+            # Registries created before gap tracking have no metadata column
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(chunks)')]
+            if 'metadata' not in columns:
+                self.db.execute('ALTER TABLE chunks ADD COLUMN metadata TEXT')
+            # ... or, before compaction, segment columns
+            if 'segment' not in columns:
+                self.db.execute('ALTER TABLE chunks ADD COLUMN segment TEXT')
+                self.db.execute('ALTER TABLE chunks ADD COLUMN segment_offset INTEGER')
+            self.db.execute('CREATE INDEX IF NOT EXISTS loose_chunks ON chunks (stream_id) WHERE segment IS NULL')
+            # ... and registries created before the silence gate no stream options
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(streams)')]
+            if 'options' not in columns:
+                self.db.execute('ALTER TABLE streams ADD COLUMN options TEXT')
+        return self.db
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            db = self._connect()
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def add_stream(self, stream_id, audio_format, options=None):
+        self._execute('INSERT INTO streams VALUES (?, ?, 1, ?, ?)',
+                      (stream_id, json.dumps(audio_format), time.time(), json.dumps(options) if options else None))
+
+    def add_chunk(self, stream_id, entry):
+        metadata = {key: entry[key] for key in ('gaps', 'duplicates', 'silence') if entry.get(key)}
+        self._execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, NULL, NULL)',
+                      (entry['chunk_id'], stream_id, entry['start'], entry['frames'], entry['bytes'],
+                       json.dumps(metadata) if metadata else None))
+
+    def set_live(self, stream_id, is_live):
+        self._execute('UPDATE streams SET is_live = ? WHERE stream_id = ?', (int(is_live), stream_id))
+
+    def load(self, stream_id):
+        rows = self._execute('SELECT format, is_live, options FROM streams WHERE stream_id = ?', (stream_id,))
+        if not rows:
+            return None
+        entries = []
+        for chunk_id, start, frames, size, metadata, segment, offset in self._execute(
+                'SELECT chunk_id, start, frames, bytes, metadata, segment, segment_offset FROM chunks '
+                'WHERE stream_id = ? ORDER BY start', (stream_id,)):
+            entry = {'chunk_id': chunk_id, 'start': start, 'frames': frames, 'bytes': size}
+            entry.update(json.loads(metadata) if metadata else {})
+            if segment is not None:
+                entry.update(segment=segment, offset=offset)
+            entries.append(entry)
+        return json.loads(rows[0][0]), bool(rows[0][1]), entries, json.loads(rows[0][2] or '{}')
+
+    def set_segment(self, entries):
+        # Compacted chunks keep their ids and are found through their segment
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.executemany('UPDATE chunks SET segment = ?, segment_offset = ?, bytes = ? WHERE chunk_id = ?',
+                               [(entry['segment'], entry['offset'], entry['bytes'], entry['chunk_id'])
+                                for entry in entries])
+
+    def streams_to_compact(self):
+        return [row[0] for row in self._execute('SELECT DISTINCT stream_id FROM chunks WHERE segment IS NULL')]
+
+    def list_streams(self):
+        rows = self._execute("""
+            SELECT streams.stream_id, streams.is_live, COUNT(chunks.chunk_id)
+            FROM streams LEFT JOIN chunks ON chunks.stream_id = streams.stream_id
+            GROUP BY streams.stream_id
+        """)
+        return {stream_id: {'is_live': bool(is_live), 'chunks': count} for stream_id, is_live, count in rows}
+
+registry = StreamRegistry()
+
+class AudioStream:
+    """One stream's chunking state; see AudioStream in server.py.
+
+    Chunks are only ever held in memory here. Finished chunks are collected
+    in `closed` and handed to the uploader by the async callers, so the
+    chunking itself never awaits.
+    """
+
+    def __init__(self, stream_id, audio_format=None, silence_gate=None):
+        self.stream_id = stream_id
+        self.format = audio_format or dict(DEFAULT_FORMAT)
+        self.silence_gate = silence_gate  # {'threshold': dBFS, 'hangover': seconds}, or None to store everything
+        self.gate = SilenceGate(**silence_gate) if silence_gate else None
+        self.codec = get_codec(self.format['codec'])
+        self.chunk_frames = int(self.format['rate'] * CHUNK_DURATION)
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        if frame_bytes is not None:
+            self.chunk_bytes = self.chunk_frames * frame_bytes
+        else:
+            self.chunk_bytes = int(self.chunk_frames * self.format['channels'] * self.format['sample_width'] *
+                                   self.codec.size_ratio * 1.1)
+        # {'chunk_id', 'start', 'frames', 'bytes'[, 'gaps', 'duplicates', 'silence']}, start/frames in sample frames
+        self.index = ChunkIndex(stream_id, self.codec.extension)
+        self.uploading = set()  # (start, end) frames of chunks not in the index until they are stored
+        self.next_frame = 0  # sender timestamp the next buffer should start at
+        self.current_chunk = None
+        self.current_chunk_start = 0
+        self.current_chunk_frames = 0
+        self.chunk_gaps = []  # [frame, missing frames] pairs for the current chunk
+        self.chunk_duplicates = 0
+        self.chunk_silence = []  # [frame, frames] runs of silence skipped before the current chunk
+        self.closed = []  # (entry, data) of chunks waiting to be submitted
+        self.is_live = True
+        self.last_seq = -1
+        self.lock = asyncio.Lock()
+        self.last_active = self.last_used = time.monotonic()  # last audio received, last request
+        self.recent = preroll.RecentAudio(self.format['rate'], PREROLL_BUFFER)  # pre-roll for listeners that join
+
+    @classmethod
+    async def load(cls, stream_id):
+        record = await run_io(registry.load, stream_id)
+        if record is None:
+            return None
+
+        audio_format, is_live, entries, options = record
+        stream = cls(stream_id, audio_format, options.get('silence_gate'))
+        stream.is_live = is_live
+        stream.index = ChunkIndex(stream_id, stream.codec.extension, entries)
+        if entries:
+            stream.next_frame = entries[-1]['start'] + entries[-1]['frames']
+        return stream
+
+    async def save_metadata(self):
+        # Archived chunks are only decodable with the stream's format and codec
+        try:
+            await run_io(storage.save_metadata, self.stream_id,
+                         {'stream_id': self.stream_id, 'format': self.format, 'chunk_names': 'start_frame'})
+        except Exception as e:
+            print(f"Error saving metadata for stream {self.stream_id}: {e}")
+
+    def find_entry(self, chunk_id):
+        return self.index.find(chunk_id)
+
+    def has_chunk(self, chunk_id):
+        # Chunks are in the index once stored, and held by the cache until then
+        return self.find_entry(chunk_id) is not None or chunk_id in cache.pending
+
+    def chunk_ranges(self, start, end):
+        """Yields (chunk_id, first_byte, last_byte, start_frame) for the audio between two offsets in seconds."""
+        rate = self.format['rate']
+        start_frame = int(start * rate)
+        end_frame = int(end * rate) if end is not None else None
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        for entry in list(self.index):
+            chunk_end = entry['start'] + entry['frames']
+            if chunk_end <= start_frame or (end_frame is not None and entry['start'] >= end_frame):
+                continue
+            if frame_bytes is None:
+                yield entry['chunk_id'], 0, entry['bytes'] - 1, entry['start']
+                continue
+            first = max(start_frame - entry['start'], 0)
+            last = entry['frames'] if end_frame is None else min(end_frame - entry['start'], entry['frames'])
+            yield entry['chunk_id'], first * frame_bytes, last * frame_bytes - 1, entry['start'] + first
+
+    def start_new_chunk(self):
+        self.current_chunk = bytearray()
+        self.current_chunk_start = self.next_frame
+        self.current_chunk_frames = 0
+        return self.current_chunk
+
+    def close_chunk(self):
+        if self.current_chunk is None:
+            return
+        if self.current_chunk:
+            # Named by the sample frame they start at, so names are unique and sort in stream order
+            chunk_id = f"{self.stream_id}/{self.current_chunk_start}.{self.codec.extension}"
+            data = self.current_chunk
+            entry = {'chunk_id': chunk_id, 'start': self.current_chunk_start,
+                     'frames': self.current_chunk_frames, 'bytes': len(data)}
+            if self.chunk_gaps:
+                entry['gaps'] = self.chunk_gaps
+            if self.chunk_duplicates:
+                entry['duplicates'] = self.chunk_duplicates
+            if self.chunk_silence:
+                entry['silence'] = self.chunk_silence
+            self.chunk_gaps = []
+            self.chunk_duplicates = 0
+            self.chunk_silence = []
+            cache.add_pending(chunk_id, data)
+            self.uploading.add((entry['start'], entry['start'] + entry['frames']))
+            self.closed.append((entry, data))
+        self.current_chunk = None
+
+    async def _submit_closed(self):
+        closed, self.closed = self.closed, []
+        for entry, data in closed:
+            await uploader.submit(self, entry, data)
+
+    def _write(self, data, frames):
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        data = memoryview(data)
+        while frames > 0:
+            if self.current_chunk is None:
+                self.start_new_chunk()
+
+            count = frames
+            if frame_bytes is not None:
+                count = min(frames, self.chunk_frames - self.current_chunk_frames)
+            part = data[:count * frame_bytes] if frame_bytes is not None else data
+            self.current_chunk += part
+            self.current_chunk_frames += count
+            self.next_frame += count
+            data = data[len(part):]
+            frames -= count
+
+            if self.current_chunk_frames >= self.chunk_frames:
+                self.close_chunk()
+
+    def _silence(self, frames):
+        fmt = self.format
+        return self.codec.encode(bytes(frames * fmt['channels'] * fmt['sample_width']), fmt)
+
+    def _align(self, data, frames, timestamp):
+        if timestamp > self.next_frame:
+            missing = timestamp - self.next_frame
+            if missing <= GAP_FILL_LIMIT * self.format['rate']:
+                self.chunk_gaps.append([self.next_frame, missing])
+                self._write(self._silence(missing), missing)
+            else:
+                self.close_chunk()
+                self.chunk_gaps.append([self.next_frame, missing])
+                self.next_frame = timestamp
+            return data, frames
+
+        self.chunk_duplicates += 1
+        overlap = self.next_frame - timestamp
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        if overlap >= frames or frame_bytes is None:
+            return data, 0
+        return data[overlap * frame_bytes:], frames - overlap
+
+    def _skip_silence(self, frames):
+        # Silence is not stored: the chunk ends and the next one starts after
+        # it, so chunk names still place every chunk on the stream's timeline
+        self.close_chunk()
+        last = self.chunk_silence[-1] if self.chunk_silence else None
+        if last is not None and last[0] + last[1] == self.next_frame:
+            last[1] += frames
+        else:
+            self.chunk_silence.append([self.next_frame, frames])
+        self.next_frame += frames
+
+    async def add_audio_data(self, data, seq=None, timestamp=None, silence=None):
+        """Appends a buffer of encoded audio, or `silence` frames of silence marked by the sender."""
+        self.last_active = time.monotonic()
+        async with self.lock:
+            # Senders number their buffers; ignore replays
+            if seq is not None:
+                if seq <= self.last_seq:
+                    self.chunk_duplicates += 1
+                    return
+                self.last_seq = seq
+
+            # Buffers without a timestamp are taken to follow on directly
+            frames = silence if silence is not None else self.codec.frames(data, self.format)
+            if timestamp is not None and timestamp != self.next_frame:
+                data, frames = self._align(data, frames, timestamp)
+            if frames <= 0:
+                return
+
+            if silence is None and self.gate is not None:
+                if self.gate.check(self.codec.decode(data, self.format), frames / self.format['rate']):
+                    silence = frames
+            start = self.next_frame
+            if silence is not None:
+                self._skip_silence(frames)
+                self.recent.add(start, None, frames)
+                if self.stream_id in LISTENERS:
+                    broadcaster.publish(self.stream_id, start, None, silence=frames)
+                await self._submit_closed()
+                return
+
+            self._write(data, frames)
+
+            # Kept for listeners that join, and forwarded to live ones
+            data = bytes(data)
+            self.recent.add(start, data, frames)
+            if self.stream_id in LISTENERS:
+                broadcaster.publish(self.stream_id, start, data)
+
+            await self._submit_closed()
+
+    def _holes(self, start, end):
+        # Frame ranges between start and end that no chunk holds yet
+        taken = [(entry['start'], entry['start'] + entry['frames']) for entry in self.index.overlapping(start, end)]
+        taken += [(first, last) for first, last in self.uploading if first < end and last > start]
+        position = start
+        for first, last in sorted(taken):
+            if first > position:
+                yield position, first
+            position = max(position, last)
+        if position < end:
+            yield position, end
+
+    async def _save_backfill(self, start, frames, data):
+        chunk_id = f"{self.stream_id}/{start}.{self.codec.extension}"
+        cache.add_pending(chunk_id, data)
+        self.uploading.add((start, start + frames))
+        await uploader.submit(self, {'chunk_id': chunk_id, 'start': start, 'frames': frames, 'bytes': len(data)}, data,
+                              announce=False)
+
+    async def backfill(self, data, timestamp):
+        """Stores audio its sender could not deliver live, in its place on the stream's timeline.
+
+        Only sample frames that no chunk holds yet are stored, as chunks of
+        their own, so audio that did arrive is never replaced and short gaps
+        that were padded with silence stay that way. Audio from past the last
+        frame received continues a live stream as usual, without going out to
+        listeners. Returns the number of frames stored.
+        """
+        frames = self.codec.frames(data, self.format)
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        end = timestamp + frames
+        async with self.lock:
+            if self.is_live and timestamp >= self.next_frame:
+                if timestamp > self.next_frame:
+                    data, frames = self._align(data, frames, timestamp)
+                self._write(data, frames)
+                await self._submit_closed()
+                return frames
+
+            # The chunk being recorded is not in the index yet
+            frontier = end
+            if self.is_live:
+                frontier = self.current_chunk_start if self.current_chunk is not None else self.next_frame
+            if frame_bytes is None:
+                # Buffers of codecs without fixed-size frames cannot be split
+                if end <= frontier and list(self._holes(timestamp, end)) == [(timestamp, end)]:
+                    await self._save_backfill(timestamp, frames, data)
+                    return frames
+                self.chunk_duplicates += 1
+                return 0
+
+            stored = 0
+            for first, last in list(self._holes(timestamp, min(end, frontier))):
+                for start in range(first, last, self.chunk_frames):
+                    count = min(self.chunk_frames, last - start)
+                    offset = (start - timestamp) * frame_bytes
+                    await self._save_backfill(start, count, data[offset:offset + count * frame_bytes])
+                    stored += count
+            if self.is_live and end > self.next_frame:
+                self._write(data[(self.next_frame - timestamp) * frame_bytes:], end - self.next_frame)
+                stored += end - self.next_frame
+                await self._submit_closed()
+            return stored
+
+    async def backfill_silence(self, timestamp, frames):
+        """Marks silence its sender could not deliver live, where the stream recorded a gap instead.
+
+        Silence is not stored, so what backfill restores is the difference
+        between silence and lost audio: the frames it covers move from the
+        gaps of their chunks to their skipped silence. Silence from past the
+        last frame received continues a live stream as usual. Returns the
+        number of frames marked.
+        """
+        end = timestamp + frames
+        async with self.lock:
+            if self.is_live and timestamp >= self.next_frame:
+                if timestamp > self.next_frame:
+                    self._align(b'', 0, timestamp)
+                self._skip_silence(frames)
+                await self._submit_closed()
+                return frames
+
+            # The chunk being recorded is not in the index yet
+            marked = gaps_to_silence(self.chunk_gaps, self.chunk_silence, timestamp, end)
+            changed, count = self.index.mark_silence(timestamp, end)
+            for entry in changed:
+                await run_io(registry.add_chunk, self.stream_id, entry)
+            return marked + count
+
+    async def end_stream(self):
+        async with self.lock:
+            self.close_chunk()
+            await self._submit_closed()
+            self.is_live = False
+            self.recent.clear()
+            await run_io(registry.set_live, self.stream_id, False)
+
+async def get_stream(stream_id):
+    # Streams that are not in memory (e.g. after a restart) are loaded from the registry
+    stream = ACTIVE_STREAMS.get(stream_id)
+    if stream is None and stream_id:
+        stream = await AudioStream.load(stream_id)
+        if stream is not None:
+            stream = ACTIVE_STREAMS.setdefault(stream_id, stream)
+    if stream is not None:
+        stream.last_used = time.monotonic()
+    return stream
+
+async def read_chunk(chunk_id):
+    # Compacted chunks are a byte range of their segment
+    stream = await get_stream(chunk_id.split('/', 1)[0])
+    entry = stream.find_entry(chunk_id) if stream is not None else None
+    if entry is not None and 'segment' in entry:
+        return await run_io(storage.get_range, entry['segment'], entry['offset'], entry['bytes'])
+    return await run_io(storage.get, chunk_id)
+
+class Compactor:
+    """Merges the chunks of each stream into segment files; see Compactor in server.py.
+
+    Runs as a background task, reading and writing through the storage
+    backend on the I/O threads.
+    """
+
+    def __init__(self, interval=COMPACT_INTERVAL, age=COMPACT_AGE, segment_bytes=segments.SEGMENT_BYTES):
+        self.interval = interval
+        self.age = age
+        self.segment_bytes = segment_bytes
+        self.compacted = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    async def run_once(self):
+        for stream_id in await run_io(registry.streams_to_compact):
+            try:
+                stream = await get_stream(stream_id)
+                if stream is not None:
+                    await self.compact(stream)
+            except Exception as e:
+                print(f"Error compacting stream {stream_id}: {e}")
+
+    async def compact(self, stream):
+        entries = list(stream.index)
+        if stream.is_live:
+            horizon = stream.next_frame - self.age * stream.format['rate']
+            entries = [entry for entry in entries if entry['start'] + entry['frames'] <= horizon]
+        for run in segments.plan(entries, self.segment_bytes, final=not stream.is_live):
+            await self._write_segment(stream, run)
+
+    async def _write_segment(self, stream, run):
+        chunks = [await run_io(storage.get, entry['chunk_id']) for entry in run]
+        segment_id = segments.segment_id(stream.stream_id, run[0]['start'])
+        f = io.BytesIO()
+        offsets = segments.write(f, stream.stream_id, stream.format, run, chunks)
+        await run_io(storage.put, segment_id, f.getvalue(), {})
+
+        updates = [{'segment': segment_id, 'offset': offset, 'bytes': len(data)} for offset, data in zip(offsets, chunks)]
+        await run_io(registry.set_segment, [dict(entry, **update) for entry, update in zip(run, updates)])
+        for entry, update in zip(run, updates):
+            stream.index.update(entry['chunk_id'], update)
+
+        # Only once nothing refers to them any more can the chunks go
+        await run_io(storage.delete, [entry['chunk_id'] for entry in run])
+        self.compacted += len(run)
+        print(f"Compacted {len(run)} chunks of stream {stream.stream_id} into {segment_id}")
+
+compactor = Compactor()
+
+class StreamReaper:
+    """Ends abandoned streams and unloads ended ones from a background task.
+
+    A sender that goes away without ending its stream would keep the
+    stream's chunk buffer open forever, so live streams that receive no
+    audio for `idle_timeout` seconds are ended as if the sender had ended
+    them. Ended streams are dropped from ACTIVE_STREAMS once they have gone
+    unused for `evict_after` seconds and have no listeners or uploads left;
+    get_stream loads them from the registry again when asked.
+    """
+
+    def __init__(self, idle_timeout=STREAM_IDLE_TIMEOUT, evict_after=STREAM_EVICT_AFTER, interval=REAP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.evict_after = evict_after
+        self.interval = interval
+        self.ended = 0
+        self.evicted = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    async def run_once(self):
+        now = time.monotonic()
+        for stream_id, stream in list(ACTIVE_STREAMS.items()):
+            try:
+                if stream.is_live:
+                    if self.idle_timeout and now - stream.last_active > self.idle_timeout:
+                        print(f"Ending stream {stream_id}: no audio for {self.idle_timeout:g} seconds")
+                        await stream.end_stream()
+                        self.ended += 1
+                elif now - stream.last_used > self.evict_after and stream_id not in LISTENERS and \
+                        not uploader.busy(stream_id):
+                    ACTIVE_STREAMS.pop(stream_id, None)
+                    self.evicted += 1
+            except Exception as e:
+                print(f"Error checking stream {stream_id}: {e}")
+
+reaper = StreamReaper()
+
+def parse_time_range(request):
+    try:
+        start = float(request.query.get('start', 0))
+        end = float(request.query['end']) if 'end' in request.query else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end <= start):
+        return None
+    return start, end
+
+def error(message, status):
+    return web.json_response({'error': message}, status=status)
+
+def not_modified(request, etag):
+    return any(tag.value in (etag, '*') for tag in request.if_none_match or ())
+
+@routes.get('/api/streams')
+async def list_streams(request):
+    # List all known streams, with live state from memory where loaded
+    streams = await run_io(registry.list_streams)
+    streams.update({id: {'is_live': stream.is_live, 'chunks': len(stream.index)}
+                    for id, stream in list(ACTIVE_STREAMS.items())})
+    return web.json_response(streams)
+
+@routes.post('/api/streams')
+async def create_stream(request):
+    try:
+        options = await request.json() if request.can_read_body else {}
+    except ValueError:
+        options = {}
+    options = options if isinstance(options, dict) else {}
+    try:
+        audio_format = {key: int(options.get(key, DEFAULT_FORMAT[key])) for key in ('rate', 'channels', 'sample_width')}
+    except (TypeError, ValueError):
+        return error('Invalid audio format', 400)
+
+    audio_format['codec'] = options.get('codec', 'pcm')
+    if audio_format['codec'] not in CODECS:
+        return error(f"Unsupported codec: {audio_format['codec']}", 400)
+    if audio_format['codec'] != 'pcm' and audio_format['sample_width'] != 2:
+        return error('Compressed codecs require 16-bit audio', 400)
+
+    # An optional silence gate keeps quiet stretches out of storage and off the wire
+    silence_gate = None
+    if options.get('silence_threshold') is not None:
+        try:
+            silence_gate = {'threshold': float(options['silence_threshold']),
+                            'hangover': float(options.get('silence_hangover', SILENCE_HANGOVER))}
+        except (TypeError, ValueError):
+            return error('Invalid silence gate', 400)
+        if audio_format['sample_width'] != 2 or get_codec(audio_format['codec']).bytes_per_frame(audio_format) is None:
+            return error('The silence gate needs 16-bit pcm, ulaw or alaw audio', 400)
+
+    stream_id = new_stream_id()
+    ACTIVE_STREAMS[stream_id] = AudioStream(stream_id, audio_format, silence_gate)
+    await ACTIVE_STREAMS[stream_id].save_metadata()
+    await run_io(registry.add_stream, stream_id, audio_format, {'silence_gate': silence_gate} if silence_gate else None)
+    print(f"Created new stream: {stream_id}")
+    return web.json_response({'stream_id': stream_id})
+
+@routes.post('/api/streams/{stream_id}/audio')
+async def add_audio(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    if not stream.is_live:
+        return error('Stream has ended', 400)
+
+    data = await request.read()
+    try:
+        seq = int(request.headers['X-Audio-Seq']) if 'X-Audio-Seq' in request.headers else None
+        timestamp = int(request.headers['X-Audio-Timestamp']) if 'X-Audio-Timestamp' in request.headers else None
+    except ValueError:
+        seq = timestamp = None
+    try:
+        silence = int(request.headers['X-Audio-Silence']) if 'X-Audio-Silence' in request.headers else None
+    except ValueError:
+        silence = None
+    await stream.add_audio_data(data, seq=seq, timestamp=timestamp, silence=silence)
+    return web.json_response({'success': True})
+
+@routes.post('/api/streams/{stream_id}/ingest')
+async def ingest_audio(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    if not stream.is_live:
+        return error('Stream has ended', 400)
+
+    # One long request carries the whole session (see ingest.py); frames are
+    # handled as they arrive instead of once the body is complete
+    reader = ingest.FrameReader()
+    count = 0
+    async for data in request.content.iter_any():
+        try:
+            frames = reader.feed(data)
+        except ValueError as e:
+            return web.json_response({'error': str(e), 'frames': count}, status=400)
+        for seq, timestamp, payload, silence in frames:
+            if not stream.is_live:
+                return web.json_response({'error': 'Stream has ended', 'frames': count}, status=400)
+            await stream.add_audio_data(payload, seq=seq, timestamp=timestamp, silence=silence)
+            count += 1
+    if reader.pending():
+        return web.json_response({'error': 'Body ends inside a frame', 'frames': count}, status=400)
+    return web.json_response({'success': True, 'frames': count})
+
+@routes.post('/api/streams/{stream_id}/backfill')
+async def backfill_audio(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    # Audio from a sender's spool; the stream may have ended in the meantime
+    try:
+        timestamp = int(request.headers['X-Audio-Timestamp'])
+    except (KeyError, ValueError):
+        timestamp = -1
+    if timestamp < 0:
+        return error('X-Audio-Timestamp is required', 400)
+    try:
+        silence = int(request.headers['X-Audio-Silence']) if 'X-Audio-Silence' in request.headers else None
+    except ValueError:
+        silence = 0
+    if silence is not None and silence <= 0:
+        return error('Invalid X-Audio-Silence', 400)
+    if silence is not None:
+        frames = await stream.backfill_silence(timestamp, silence)
+    else:
+        frames = await stream.backfill(await request.read(), timestamp)
+    return web.json_response({'success': True, 'frames': frames})
+
+@routes.get('/api/streams/{stream_id}/audio')
+async def get_audio(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    time_range = parse_time_range(request)
+    if time_range is None:
+        return error('Invalid time range', 400)
+
+    ranges = list(stream.chunk_ranges(*time_range))
+    if not ranges:
+        return error('No audio in the requested range', 404)
+
+    response = web.StreamResponse(headers={
+        'Content-Type': stream.codec.mimetype,
+        'X-Audio-Start': f"{ranges[0][3] / stream.format['rate']:.6f}",
+        'X-Audio-Format': json.dumps(stream.format)
+    })
+    await response.prepare(request)
+    for chunk_id, first, last, _ in ranges:
+        data = await cache.get(chunk_id)
+        await response.write(memoryview(data)[first:last + 1])
+    await response.write_eof()
+    return response
+
+async def export_blocks(stream, parts):
+    """Yields the PCM of export parts (see export.py) in order, reading up to EXPORT_WORKERS chunks ahead."""
+    frame_bytes = stream.format['channels'] * stream.format['sample_width']
+
+    async def load(entry):
+        # An export reads every chunk once, so it bypasses the cache
+        data = await cache.get(entry['chunk_id'], store=False)
+        return await run_io(stream.codec.decode, data, stream.format)
+
+    pending = deque()
+    try:
+        for part in parts:
+            pending.append((part, asyncio.ensure_future(load(part[0])) if part[0] is not None else None))
+            if len(pending) < EXPORT_WORKERS:
+                continue
+            part, task = pending.popleft()
+            for block in export.part_blocks(part, await task if task is not None else None, frame_bytes):
+                yield block
+        while pending:
+            part, task = pending.popleft()
+            for block in export.part_blocks(part, await task if task is not None else None, frame_bytes):
+                yield block
+    finally:
+        for _, task in pending:
+            if task is not None:
+                task.cancel()
+
+@routes.get('/api/streams/{stream_id}/export')
+async def export_audio(request):
+    stream_id = request.match_info['stream_id']
+    stream = await get_stream(stream_id)
+    if stream is None:
+        return error('Stream not found', 404)
+
+    time_range = parse_time_range(request)
+    if time_range is None:
+        return error('Invalid time range', 400)
+    file_format = request.query.get('format', 'wav')
+    try:
+        export.check(file_format, stream.format)
+    except ValueError as e:
+        return error(str(e), 400)
+
+    rate = stream.format['rate']
+    start, end = time_range
+    parts = export.plan(list(stream.index), int(start * rate), int(end * rate) if end is not None else None)
+    if not any(entry is not None for entry, _, _ in parts):
+        return error('No audio in the requested range', 404)
+
+    headers = {'Content-Type': export.FORMATS[file_format],
+               'Content-Disposition': f'attachment; filename="{stream_id}.{file_format}"',
+               'X-Audio-Start': f"{start:.6f}",
+               'X-Audio-Format': json.dumps(stream.format)}
+    if file_format == 'wav':
+        frames = export.total_frames(parts)
+        response = web.StreamResponse(headers=headers)
+        response.content_length = export.WAV_HEADER_BYTES + frames * stream.format['channels'] * stream.format['sample_width']
+        await response.prepare(request)
+        await response.write(export.wav_header(stream.format, frames))
+        async for block in export_blocks(stream, parts):
+            await response.write(export.wav_data(block, stream.format))
+        await response.write_eof()
+        return response
+
+    # The size of a FLAC file is only known once it is encoded, so it is
+    # written to a temp file first
+    f = await run_io(tempfile.TemporaryFile)
+    try:
+        try:
+            writer = await run_io(export.FlacWriter, f, stream.format)
+            async for block in export_blocks(stream, parts):
+                await run_io(writer.write, block)
+            await run_io(writer.close)
+        except Exception as e:
+            return error(str(e), 500)
+        response = web.StreamResponse(headers=headers)
+        response.content_length = await run_io(f.seek, 0, os.SEEK_END)
+        await response.prepare(request)
+        await run_io(f.seek, 0)
+        while True:
+            data = await run_io(f.read, 64 * 1024)
+            if not data:
+                break
+            await response.write(data)
+        await response.write_eof()
+        return response
+    finally:
+        f.close()
+
+@routes.post('/api/streams/{stream_id}/end')
+async def end_stream(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    await stream.end_stream()
+    return web.json_response({'success': True})
+
+@routes.get('/api/streams/{stream_id}/chunks')
+async def get_chunks(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    return web.json_response({
+        'chunks': stream.index.chunk_ids(),
+        'format': stream.format,
+        'index': [{
+            'chunk_id': entry['chunk_id'],
+            'start': entry['start'] / stream.format['rate'],
+            'duration': entry['frames'] / stream.format['rate'],
+            'bytes': entry['bytes'],
+            'gaps': [[frame / stream.format['rate'], missing / stream.format['rate']]
+                     for frame, missing in entry.get('gaps', [])],
+            'duplicates': entry.get('duplicates', 0),
+            'silence': [[frame / stream.format['rate'], frames / stream.format['rate']]
+                        for frame, frames in entry.get('silence', [])]
+        } for entry in stream.index],
+        'is_live': stream.is_live
+    })
+
+@routes.get('/api/streams/{stream_id}/playlist.m3u8')
+async def get_playlist(request):
+    stream = await get_stream(request.match_info['stream_id'])
+    if stream is None:
+        return error('Stream not found', 404)
+
+    # ?rate=, ?channels= and ?codec= list the chunks converted to that format
+    try:
+        target = conversion_target(stream.format, request.query)
+        window = int(request.query['window']) if 'window' in request.query else None
+    except ValueError as e:
+        return error(str(e), 400)
+    query = ''
+    if target is not None:
+        query = '?' + urlencode({key: request.query[key] for key in ('rate', 'channels', 'codec') if key in request.query})
+
+    body = playlist.render(list(stream.index), stream.format['rate'], stream.is_live,
+                           lambda chunk_id: f"/api/chunks/{chunk_id}{query}", window=window)
+    etag = playlist.body_etag(body)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': playlist.cache_control(stream.is_live, CHUNK_DURATION)}
+    if not_modified(request, etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=body, content_type=playlist.CONTENT_TYPE, headers=headers)
+
+@routes.get('/api/uploads')
+async def get_uploads(request):
+    return web.json_response({
+        'backlog': uploader.backlog(),
+        'failed': uploader.failed,
+        'retrying': len(uploader.retrying)
+    })
+
+async def get_converted_chunk(chunk_id, source, target):
+    async def convert():
+        return await run_io(convert_chunk, await cache.get(chunk_id), source, target)
+    return await cache.get(f"{chunk_id}@{format_key(target)}", load=convert)
+
+@routes.get('/api/chunks/{chunk_id:.+}')
+async def get_chunk_data(request):
+    chunk_id = request.match_info['chunk_id']
+    mimetype = codec_for_extension(chunk_id.rsplit('.', 1)[-1]).mimetype
+
+    # Checked before the ETag, so a stale one never vouches for a chunk that is gone
+    stream = await get_stream(chunk_id.split('/', 1)[0])
+    if stream is None or not stream.has_chunk(chunk_id):
+        return error('Chunk not found', 404)
+
+    # ?rate=, ?channels= and ?codec= ask for the chunk in another format
+    target = None
+    if any(key in request.query for key in ('rate', 'channels', 'codec')):
+        try:
+            target = conversion_target(stream.format, request.query)
+        except ValueError as e:
+            return error(str(e), 400)
+
+    # Chunks never change once saved, so a cached copy is always current
+    etag = playlist.chunk_etag(chunk_id, format_key(target) if target is not None else None)
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': playlist.IMMUTABLE})
+
+    # Stored local chunks are sent straight from disk, Range requests
+    # included, with FileResponse's own ETag and conditional handling
+    path = storage.path(chunk_id)
+    if target is None and path is not None and chunk_id not in cache.pending and os.path.isfile(path):
+        return web.FileResponse(path, headers={'Content-Type': mimetype, 'Cache-Control': playlist.IMMUTABLE})
+
+    try:
+        if target is None:
+            data = await cache.get(chunk_id)
+        else:
+            data = await get_converted_chunk(chunk_id, stream.format, target)
+            mimetype = get_codec(target['codec']).mimetype
+    except FileNotFoundError:
+        return error('Chunk not found', 404)
+    except Exception as e:
+        return error(str(e), 500)
+
+    headers = {'Accept-Ranges': 'bytes', 'Content-Type': mimetype, 'ETag': f'"{etag}"',
+               'Cache-Control': playlist.IMMUTABLE}
+    if 'Range' not in request.headers:
+        return web.Response(body=data, headers=headers)
+    try:
+        byte_range = request.http_range
+        first, stop, _ = byte_range.indices(len(data))
+    except ValueError:
+        first, stop = 0, 0
+    if first >= stop:
+        return web.Response(status=416, headers={'Content-Range': f"bytes */{len(data)}"})
+
+    headers['Content-Range'] = f"bytes {first}-{stop - 1}/{len(data)}"
+    return web.Response(body=memoryview(data)[first:stop], status=206, headers=headers)
+
+@routes.get('/api/cache')
+async def get_cache(request):
+    return web.json_response(cache.info())
+
+@sio.on('connect')
+async def socket_connect(sid, environ):
+    print(f"Client connected: {sid}")
+
+@sio.on('disconnect')
+async def socket_disconnect(sid):
+    for stream_id in list(LISTENERS.keys()):
+        if sid in LISTENERS[stream_id]:
+            del LISTENERS[stream_id][sid]
+            if not LISTENERS[stream_id]:
+                del LISTENERS[stream_id]
+
+@sio.on('start_ingest')
+async def start_ingest(sid, data):
+    stream = await get_stream(data.get('stream_id'))
+    if stream is None:
+        return {'error': 'Stream not found'}
+
+    if not stream.is_live:
+        return {'error': 'Stream has ended'}
+
+    return {'success': True, 'last_seq': stream.last_seq, 'next_frame': stream.next_frame}
+
+@sio.on('audio_frame')
+async def audio_frame(sid, data):
+    stream = await get_stream(data.get('stream_id'))
+    if stream is None or not stream.is_live:
+        await sio.emit('error', {'message': 'Invalid stream ID'}, to=sid)
+        return
+
+    await stream.add_audio_data(data.get('data', b''), seq=data.get('seq'), timestamp=data.get('timestamp'),
+                                silence=data.get('silence'))
+
+@sio.on('join_stream')
+async def join_stream(sid, data):
+    stream_id = data.get('stream_id')
+    stream = await get_stream(stream_id)
+    if stream is None:
+        await sio.emit('error', {'message': 'Invalid stream ID'}, to=sid)
+        return
+
+    # Listeners may ask for another format; they fetch chunks with the same one in the query
+    try:
+        target = conversion_target(stream.format, data.get('format') or {})
+    except ValueError as e:
+        await sio.emit('error', {'message': str(e)}, to=sid)
+        return
+
+    # Listeners start from live audio, with up to PREROLL_BUFFER seconds of
+    # what came just before it; recorded chunks are only listed for those
+    # that ask for the whole history, or once the stream has ended
+    history = bool(data.get('history')) or not stream.is_live
+    try:
+        seconds = 0 if history else min(max(float(data.get('preroll') or 0), 0), PREROLL_BUFFER)
+    except (TypeError, ValueError):
+        await sio.emit('error', {'message': 'Invalid pre-roll'}, to=sid)
+        return
+
+    if stream_id not in LISTENERS:
+        LISTENERS[stream_id] = {}
+    if sid in LISTENERS[stream_id]:
+        sio.leave_room(sid, live_room(stream_id, LISTENERS[stream_id][sid]))
+    LISTENERS[stream_id][sid] = target
+
+    await sio.emit('joined', {
+        'stream_id': stream_id,
+        'is_live': stream.is_live,
+        'format': target or stream.format,
+        'chunks': stream.index.chunk_ids() if history else []
+    }, to=sid)
+
+    # The pre-roll goes out before the listener enters the live room, so no
+    # live packet can overtake it. It is converted first; the broadcaster
+    # then holds off while packets recorded since are added and the listener
+    # joins, and live packets it already has are dropped by their start
+    frames = int(seconds * stream.format['rate'])
+    converter = Converter(stream.format, target) if target else None
+    packets = await preroll_packets(stream, converter, frames)
+    async with broadcaster.emitting:
+        packets += await preroll_packets(stream, converter, frames, packets[-1][0] if packets else None)
+        if packets:
+            await sio.emit('preroll', {'stream_id': stream_id, 'data': preroll.pack(packets)}, to=sid)
+        sio.enter_room(sid, stream_id)
+        sio.enter_room(sid, live_room(stream_id, target))
+
+async def on_startup(app):
+    uploader.start()
+    compactor.start()
+    reaper.start()
+    broadcaster.start()
+
+async def on_shutdown(app):
+    # Live streams keep their last chunk; store it before exiting
+    for stream in list(ACTIVE_STREAMS.values()):
+        async with stream.lock:
+            stream.close_chunk()
+            await stream._submit_closed()
+    await uploader.retry_failed()
+    print(f"Waiting for {uploader.backlog()} pending chunk uploads...")
+    await uploader.wait()
+    if uploader.retrying:
+        print(f"{len(uploader.retrying)} chunks could not be stored and are lost")
+
+app.add_routes(routes)
+app.on_startup.append(on_startup)
+app.on_shutdown.append(on_shutdown)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Audio Streaming Server (asyncio)')
+    parser.add_argument('--host', default='0.0.0.0', help='Host to bind the server to')
+    parser.add_argument('--port', type=int, default=8000, help='Port to bind the server to')
+    parser.add_argument('--storage', choices=['s3', 'local'], default='s3',
+                        help=f'Store chunks in the S3 bucket or under {STORAGE_DIR}/')
+    parser.add_argument('--io-threads', type=int, default=IO_THREADS, help='Threads for blocking storage, registry and conversion calls')
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS, help='Number of chunks stored at the same time')
+    parser.add_argument('--upload-retry-interval', type=float, default=UPLOAD_RETRY_INTERVAL, help='Seconds before chunks that could not be stored are tried again')
+    parser.add_argument('--cache-memory', type=int, default=CACHE_MEMORY_BYTES, help='Bytes of chunk data cached in memory')
+    parser.add_argument('--registry', default=None,
+                        help=f'Path of the stream registry database (default {REGISTRY_PATH}, or {STORAGE_DIR}/registry.db with local storage)')
+    parser.add_argument('--compact-interval', type=float, default=COMPACT_INTERVAL, help='Seconds between background compaction passes (0 to disable)')
+    parser.add_argument('--compact-age', type=float, default=COMPACT_AGE, help='Compact chunks of live streams once they are this many seconds old')
+    parser.add_argument('--idle-timeout', type=float, default=STREAM_IDLE_TIMEOUT, help='End live streams that receive no audio for this many seconds (0 to keep them open)')
+    parser.add_argument('--preroll-buffer', type=float, default=PREROLL_BUFFER,
+                        help='Seconds of recent audio kept per live stream for listeners that join (0 to keep none)')
+    parser.add_argument('--export-workers', type=int, default=EXPORT_WORKERS, help='Chunks read at the same time for one export')
+    parser.add_argument('--evict-after', type=float, default=STREAM_EVICT_AFTER, help='Unload ended streams from memory after this many seconds without use')
+    parser.add_argument('--compact', action='store_true', help='Compact all streams into segment files once and exit; run it while no server uses the registry')
+
+    args = parser.parse_args()
+
+    if args.storage == 's3':
+        storage = S3Storage()
+        registry.path = args.registry or REGISTRY_PATH
+    else:
+        os.makedirs(STORAGE_DIR, exist_ok=True)
+        storage = LocalStorage()
+        registry.path = args.registry or os.path.join(STORAGE_DIR, 'registry.db')
+    io_pool = ThreadPoolExecutor(args.io_threads, thread_name_prefix='storage-io')
+    uploader.workers = args.upload_workers
+    uploader.retry_interval = args.upload_retry_interval
+    cache.memory_bytes = args.cache_memory
+    compactor.interval = args.compact_interval
+    compactor.age = args.compact_age
+    reaper.idle_timeout = args.idle_timeout
+    reaper.evict_after = args.evict_after
+    PREROLL_BUFFER = args.preroll_buffer
+    EXPORT_WORKERS = args.export_workers
+    if args.compact:
+        asyncio.run(compactor.run_once())
+        print(f"Compacted {compactor.compacted} chunks")
+        raise SystemExit
+
+    print(f"Starting asyncio server on {args.host}:{args.port} with {args.storage} storage")
+    web.run_app(app, host=args.host, port=args.port)
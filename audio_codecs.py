@@ -0,0 +1,444 @@
+"""Audio codecs shared by the sender, server and receiver scripts.
+
+Every codec turns 16-bit PCM into bytes that can be concatenated: a chunk
+or a live buffer is always a sequence of whole encoded blocks, so it can be
+decoded without knowing where the sender's buffers started and ended.
+Converter changes the rate, channels and codec of a stream for listeners
+that ask for a different format, and SilenceGate picks out quiet stretches
+that need not be sent or stored at all.
+"""
+import io
+import struct
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+class Codec:
+    name = 'pcm'
+    extension = 'raw'
+    mimetype = 'audio/raw'
+    size_ratio = 1.0  # encoded size relative to 16-bit PCM
+
+    def encode(self, data, audio_format):
+        return data
+
+    def decode(self, data, audio_format):
+        return data
+
+    def bytes_per_frame(self, audio_format):
+        # None for codecs whose byte offsets cannot be derived from a frame number
+        return audio_format['channels'] * audio_format['sample_width']
+
+    def frames(self, data, audio_format):
+        return len(data) // self.bytes_per_frame(audio_format)
+
+
+def _ulaw_tables():
+    bias = 0x84
+    pcm = np.arange(-32768, 32768, dtype=np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(pcm), 8159) + (bias >> 2)
+    segment = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), magnitude)
+    code = (np.minimum(segment, 7) << 4) | ((magnitude >> np.minimum(segment + 1, 8)) & 0x0F)
+    code = np.where(segment >= 8, 0x7F, code)
+    encode = ((code ^ mask) & 0xFF).astype(np.uint8)
+
+    code = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (code >> 4) & 0x07
+    mantissa = code & 0x0F
+    magnitude = (((mantissa << 3) + bias) << exponent) - bias
+    decode = np.where(code & 0x80, -magnitude, magnitude).astype(np.int16)
+    return encode, decode
+
+
+def _alaw_tables():
+    pcm = np.arange(-32768, 32768, dtype=np.int32) >> 3
+    mask = np.where(pcm >= 0, 0xD5, 0x55)
+    magnitude = np.where(pcm >= 0, pcm, -pcm - 1)
+    segment = np.searchsorted(np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF]), magnitude)
+    shift = np.where(segment < 2, 1, segment)
+    code = (np.minimum(segment, 7) << 4) | ((magnitude >> np.minimum(shift, 7)) & 0x0F)
+    code = np.where(segment >= 8, 0x7F, code)
+    encode = ((code ^ mask) & 0xFF).astype(np.uint8)
+
+    code = np.arange(256, dtype=np.int32) ^ 0x55
+    segment = (code & 0x70) >> 4
+    magnitude = (code & 0x0F) << 4
+    magnitude = np.where(segment == 0, magnitude + 8, (magnitude + 0x108) << np.maximum(segment - 1, 0))
+    decode = np.where(code & 0x80, magnitude, -magnitude).astype(np.int16)
+    return encode, decode
+
+
+class TableCodec(Codec):
+    """G.711 companding through 64k-entry encode and 256-entry decode tables."""
+
+    def __init__(self, tables):
+        self.encode_table, self.decode_table = tables
+
+    def encode(self, data, audio_format):
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.int32) + 32768
+        return self.encode_table[samples].tobytes()
+
+    def decode(self, data, audio_format):
+        return self.decode_table[np.frombuffer(data, dtype=np.uint8)].tobytes()
+
+    def bytes_per_frame(self, audio_format):
+        return audio_format['channels']
+
+
+class ULawCodec(TableCodec):
+    name = 'ulaw'
+    extension = 'ulaw'
+    mimetype = 'audio/basic'
+    size_ratio = 0.5
+
+    def __init__(self):
+        super().__init__(_ulaw_tables())
+
+
+class ALawCodec(TableCodec):
+    name = 'alaw'
+    extension = 'alaw'
+    mimetype = 'audio/x-alaw-basic'
+    size_ratio = 0.5
+
+    def __init__(self):
+        super().__init__(_alaw_tables())
+
+
+IMA_STEPS = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+]
+IMA_INDEX_ADJUST = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+
+
+class AdpcmCodec(Codec):
+    """IMA-ADPCM, 4 bits per sample.
+
+    Each block starts with its frame count followed by the predictor and step
+    index of every channel, then one plane of packed nibbles per channel.
+    The predictor is sequential, so numpy is only used to split and join the
+    channel planes.
+    """
+
+    name = 'adpcm'
+    extension = 'adpcm'
+    mimetype = 'audio/x-ima-adpcm'
+    size_ratio = 0.25
+    block_frames = 8192
+
+    def _encode_channel(self, samples):
+        predictor = int(samples[0]) if len(samples) else 0
+        index = 0
+        header = struct.pack('<hBx', predictor, index)
+        nibbles = bytearray(len(samples))
+        for i, sample in enumerate(samples.tolist()):
+            step = IMA_STEPS[index]
+            diff = sample - predictor
+            nibble = 0
+            if diff < 0:
+                nibble = 8
+                diff = -diff
+            delta = step >> 3
+            if diff >= step:
+                nibble |= 4
+                diff -= step
+                delta += step
+            step >>= 1
+            if diff >= step:
+                nibble |= 2
+                diff -= step
+                delta += step
+            step >>= 1
+            if diff >= step:
+                nibble |= 1
+                delta += step
+            predictor = predictor - delta if nibble & 8 else predictor + delta
+            predictor = -32768 if predictor < -32768 else 32767 if predictor > 32767 else predictor
+            index = min(max(index + IMA_INDEX_ADJUST[nibble], 0), 88)
+            nibbles[i] = nibble
+        return header, self._pack(nibbles)
+
+    def _pack(self, nibbles):
+        values = np.frombuffer(bytes(nibbles), dtype=np.uint8)
+        if len(values) % 2:
+            values = np.append(values, 0).astype(np.uint8)
+        return ((values[0::2]) | (values[1::2] << 4)).astype(np.uint8).tobytes()
+
+    def _decode_channel(self, predictor, index, packed, frames):
+        values = np.frombuffer(packed, dtype=np.uint8)
+        nibbles = np.empty(len(values) * 2, dtype=np.uint8)
+        nibbles[0::2] = values & 0x0F
+        nibbles[1::2] = values >> 4
+        out = np.empty(frames, dtype=np.int16)
+        for i, nibble in enumerate(nibbles[:frames].tolist()):
+            step = IMA_STEPS[index]
+            delta = step >> 3
+            if nibble & 4:
+                delta += step
+            if nibble & 2:
+                delta += step >> 1
+            if nibble & 1:
+                delta += step >> 2
+            predictor = predictor - delta if nibble & 8 else predictor + delta
+            predictor = -32768 if predictor < -32768 else 32767 if predictor > 32767 else predictor
+            index = min(max(index + IMA_INDEX_ADJUST[nibble], 0), 88)
+            out[i] = predictor
+        return out
+
+    def encode(self, data, audio_format):
+        channels = audio_format['channels']
+        samples = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+        blocks = []
+        for start in range(0, len(samples), self.block_frames):
+            block = samples[start:start + self.block_frames]
+            encoded = [self._encode_channel(block[:, c]) for c in range(channels)]
+            blocks.append(struct.pack('<H', len(block)))
+            blocks.extend(header for header, _ in encoded)
+            blocks.extend(packed for _, packed in encoded)
+        return b''.join(blocks)
+
+    def bytes_per_frame(self, audio_format):
+        return None
+
+    def frames(self, data, audio_format):
+        channels = audio_format['channels']
+        total = 0
+        offset = 0
+        while offset + 2 <= len(data):
+            frames, = struct.unpack_from('<H', data, offset)
+            offset += 2 + 4 * channels + channels * ((frames + 1) // 2)
+            total += frames
+        return total
+
+    def decode(self, data, audio_format):
+        channels = audio_format['channels']
+        blocks = []
+        offset = 0
+        while offset + 2 <= len(data):
+            frames, = struct.unpack_from('<H', data, offset)
+            offset += 2
+            headers = []
+            for _ in range(channels):
+                headers.append(struct.unpack_from('<hBx', data, offset))
+                offset += 4
+            plane = (frames + 1) // 2
+            block = np.empty((frames, channels), dtype=np.int16)
+            for c, (predictor, index) in enumerate(headers):
+                block[:, c] = self._decode_channel(predictor, index, data[offset:offset + plane], frames)
+                offset += plane
+            blocks.append(block.tobytes())
+        return b''.join(blocks)
+
+
+class FlacCodec(Codec):
+    """FLAC through libsndfile; each block is a length-prefixed FLAC stream."""
+
+    name = 'flac'
+    extension = 'flac'
+    mimetype = 'audio/flac'
+    size_ratio = 0.6
+
+    def encode(self, data, audio_format):
+        samples = np.frombuffer(data, dtype=np.int16).reshape(-1, audio_format['channels'])
+        out = io.BytesIO()
+        soundfile.write(out, samples, audio_format['rate'], format='FLAC', subtype='PCM_16')
+        encoded = out.getvalue()
+        return struct.pack('<I', len(encoded)) + encoded
+
+    def bytes_per_frame(self, audio_format):
+        return None
+
+    def frames(self, data, audio_format):
+        # Total sample count is the low 36 bits of STREAMINFO, right after the
+        # "fLaC" marker, the metadata block header and 10 bytes of block sizes
+        total = 0
+        offset = 0
+        while offset + 4 <= len(data):
+            size, = struct.unpack_from('<I', data, offset)
+            total += int.from_bytes(data[offset + 22:offset + 30], 'big') & ((1 << 36) - 1)
+            offset += 4 + size
+        return total
+
+    def decode(self, data, audio_format):
+        blocks = []
+        offset = 0
+        while offset + 4 <= len(data):
+            size, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            samples, _ = soundfile.read(io.BytesIO(data[offset:offset + size]), dtype='int16')
+            blocks.append(samples.tobytes())
+            offset += size
+        return b''.join(blocks)
+
+
+CODECS = {codec.name: codec for codec in [Codec(), ULawCodec(), ALawCodec(), AdpcmCodec()]}
+if soundfile is not None:
+    CODECS['flac'] = FlacCodec()
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Unsupported codec: {name} (available: {', '.join(CODECS)})")
+    return CODECS[name]
+
+
+def codec_for_extension(extension):
+    for codec in CODECS.values():
+        if codec.extension == extension:
+            return codec
+    return CODECS['pcm']
+
+
+def format_key(audio_format):
+    """Short name for a format, used in room names and cache keys."""
+    return f"{audio_format['rate']}x{audio_format['channels']}.{audio_format['codec']}"
+
+
+def conversion_target(source, options):
+    """Returns the format a listener asked for, or None if it is the stream's own.
+
+    Fields missing from `options` (rate, channels, codec) keep the stream's
+    value. Raises ValueError for formats that cannot be produced.
+    """
+    target = dict(source)
+    try:
+        for key in ('rate', 'channels'):
+            if options.get(key) is not None:
+                target[key] = int(options[key])
+    except (TypeError, ValueError):
+        raise ValueError("Invalid target format")
+    if options.get('codec'):
+        target['codec'] = get_codec(options['codec']).name
+    if target == source:
+        return None
+    if source['sample_width'] != 2:
+        raise ValueError("Format conversion requires 16-bit audio")
+    if not 1000 <= target['rate'] <= 192000 or not 1 <= target['channels'] <= 8:
+        raise ValueError("Unsupported target format")
+    return target
+
+
+def _mix_matrix(source_channels, target_channels):
+    # Downmixing averages the source channels that fold onto each target
+    # channel; upmixing repeats source channels
+    matrix = np.zeros((source_channels, target_channels), dtype=np.float32)
+    if target_channels <= source_channels:
+        for channel in range(source_channels):
+            matrix[channel, channel % target_channels] = 1
+        matrix /= matrix.sum(axis=0)
+    else:
+        for channel in range(target_channels):
+            matrix[channel % source_channels, channel] = 1
+    return matrix
+
+
+class Converter:
+    """Converts a continuous stream of buffers from one format to another.
+
+    Channels are remixed with a matrix product and the rate is changed by
+    linear interpolation. The resampler carries its position and the last
+    frame of the previous buffer over, so consecutive buffers join up
+    without clicks. Output frames that fall after the last input frame wait
+    for the next buffer; the final buffer of a stream is passed with
+    final=True, so the output has round(input frames * ratio) frames.
+    """
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.source_codec = get_codec(source['codec'])
+        self.target_codec = get_codec(target['codec'])
+        self.matrix = None
+        if source['channels'] != target['channels']:
+            self.matrix = _mix_matrix(source['channels'], target['channels'])
+        self.step = source['rate'] / target['rate']
+        self.position = 0.0  # source frame of the next output frame, counted from self.previous
+        self.previous = None
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def decode(self, data):
+        """Decodes a buffer of the source format into float frames, to be passed to process()."""
+        samples = np.frombuffer(self.source_codec.decode(data, self.source), dtype=np.int16)
+        return samples.reshape(-1, self.source['channels']).astype(np.float32)
+
+    def _resample(self, frames):
+        self.frames_in += len(frames)
+        if self.previous is not None:
+            frames = np.concatenate([self.previous, frames])
+        if len(frames) < 2:
+            self.previous = frames
+            return frames[:0]
+        positions = np.arange(self.position, len(frames) - 1, self.step)
+        index = positions.astype(np.int64)
+        weight = (positions - index)[:, None].astype(np.float32)
+        out = frames[index] * (1 - weight) + frames[index + 1] * weight
+        next_position = positions[-1] + self.step if len(positions) else self.position
+        self.position = next_position - (len(frames) - 1)
+        self.previous = frames[-1:]
+        self.frames_out += len(out)
+        return out
+
+    def _tail(self, channels):
+        # Frames still owed after the last input frame hold its value
+        missing = max(round(self.frames_in / self.step) - self.frames_out, 0)
+        if self.previous is None or not len(self.previous):
+            return np.zeros((0, channels), dtype=np.float32)
+        self.frames_out += missing
+        return np.repeat(self.previous[-1:], missing, axis=0)
+
+    def process(self, frames, final=False):
+        if self.matrix is not None:
+            frames = frames @ self.matrix
+        if self.step != 1:
+            frames = self._resample(frames)
+            if final:
+                frames = np.concatenate([frames, self._tail(frames.shape[1])])
+        samples = np.clip(np.rint(frames), -32768, 32767).astype(np.int16)
+        return self.target_codec.encode(samples.tobytes(), self.target)
+
+    def convert(self, data, final=False):
+        return self.process(self.decode(data), final)
+
+
+def convert_chunk(data, source, target):
+    """Converts a whole chunk on its own, with no state carried between chunks."""
+    return Converter(source, target).convert(data, final=True)
+
+
+class SilenceGate:
+    """Energy gate that picks out buffers which can be replaced by silence markers.
+
+    A buffer is quiet when its RMS level is below `threshold` dBFS. The gate
+    only closes after `hangover` seconds of continuous quiet, so short pauses
+    and the soft ends of sounds are kept as audio; the first loud buffer
+    opens it again.
+    """
+
+    def __init__(self, threshold=-50.0, hangover=1.0):
+        self.threshold = threshold
+        self.hangover = hangover
+        self.level = 32768 * 10 ** (threshold / 20)
+        self.quiet = 0.0  # seconds of continuous quiet so far
+
+    def check(self, pcm, duration):
+        """Returns True if a buffer of 16-bit PCM lasting `duration` seconds should be skipped."""
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if not len(samples):
+            return False
+        if np.sqrt(np.mean(np.square(samples.astype(np.float32)))) >= self.level:
+            self.quiet = 0.0
+            return False
+        self.quiet += duration
+        return self.quiet > self.hangover
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""Load test for the audio streaming servers.
+
+Starts server.py, direct-server.py or async-server.py in a scratch directory
+(the S3-backed servers talk to a local S3 stand-in), drives it with
+synthetic senders and headless Socket.IO listeners, and reports:
+
+- ingest latency: round trip of each audio POST or acknowledged audio_frame
+- end-to-end latency: from sending a buffer to a listener receiving it live
+- chunk latency: from sending the last buffer of a chunk to its new_chunk event
+- dropped buffers: failed sends and live buffers that never reached a listener
+- CPU time and memory of the server processes, per stream
+
+No audio devices are needed. Each buffer carries its sequence number in its
+first four bytes, which is how listeners match what they hear to when it
+was sent. Results can be saved with --json and compared with an earlier
+run with --baseline to catch regressions.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+import numpy as np
+import requests
+import socketio
+
+SERVERS = {'server': 'server.py', 'direct': 'direct-server.py', 'async': 'async-server.py'}
+S3_BUCKET = 'emeraldflow-audio-stream'
+CHUNK_DURATION = 5  # seconds, as configured in the servers
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Audio Streaming Benchmark')
+    parser.add_argument('--server', choices=list(SERVERS), default='server', help='Server to benchmark')
+    parser.add_argument('--server-args', default='', help='Extra arguments for the server, e.g. "--workers 4"')
+    parser.add_argument('--port', type=int, default=8900, help='Port to run the server on')
+    parser.add_argument('--streams', type=int, default=4, help='Number of concurrent senders, one stream each')
+    parser.add_argument('--listeners', type=int, default=2, help='Live listeners per stream')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of audio each sender sends')
+    parser.add_argument('--rate', type=int, default=44100, help='Sample rate in Hz')
+    parser.add_argument('--channels', type=int, default=1, help='Number of channels')
+    parser.add_argument('--buffer', type=int, default=1024, help='Frames per buffer')
+    parser.add_argument('--transport', choices=['http', 'socket'], default='http', help='How senders deliver audio')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Results file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative regression against the baseline before failing (0.2 = 20%%)')
+    return parser.parse_args()
+
+class S3StandIn(ThreadingHTTPServer):
+    """In-memory S3 that understands just enough for the servers: PUT, GET (with Range), HEAD and DELETE of objects."""
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        self.objects = {}
+        self.puts = 0
+        super().__init__(address, S3Handler)
+
+class S3Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _key(self):
+        path = urlsplit(self.path).path.lstrip('/')
+        bucket, _, key = path.partition('/')
+        if bucket != S3_BUCKET:
+            # Virtual-hosted style request, the bucket is in the host name
+            key = path
+        return key
+
+    def _not_found(self):
+        body = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code><Message>Not found</Message></Error>'
+        self.send_response(404)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        metadata = {name[len('x-amz-meta-'):]: value for name, value in self.headers.items()
+                    if name.lower().startswith('x-amz-meta-')}
+        self.server.objects[self._key()] = (data, metadata)
+        self.server.puts += 1
+        self.send_response(200)
+        self.send_header('ETag', '"0"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self._key() not in self.server.objects:
+            return self._not_found()
+        data, metadata = self.server.objects[self._key()]
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, _, last = byte_range.split('=', 1)[1].partition('-')
+            last = min(int(last) if last else len(data) - 1, len(data) - 1)
+            status, data = 206, data[int(first):last + 1]
+        self.send_response(status)
+        for name, value in metadata.items():
+            self.send_header(f'x-amz-meta-{name}', value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_HEAD = do_GET
+
+    def _deleted(self, status=204, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        self.server.objects.pop(self._key(), None)
+        self._deleted()
+
+    def do_POST(self):
+        # Multi-object delete, as sent by delete_objects
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        for element in ElementTree.fromstring(body).iter():
+            if element.tag.endswith('Key'):
+                self.server.objects.pop(element.text, None)
+        self._deleted(200, b'<?xml version="1.0" encoding="UTF-8"?><DeleteResult></DeleteResult>')
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ingest = []
+        self.end_to_end = []
+        self.chunks = []
+        self.sent = 0
+        self.failed = 0
+        self.late = 0
+        self.expected = 0
+        self.received = 0
+
+    def add(self, name, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+    def count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+class SyntheticSender(threading.Thread):
+    """Sends a generated tone in real time, one buffer per request or frame."""
+
+    def __init__(self, server_url, args, stats, start_event):
+        super().__init__(daemon=True)
+        self.server_url = server_url
+        self.args = args
+        self.stats = stats
+        self.start_event = start_event
+        self.session = requests.Session()
+        self.sio = None
+        self.stream_id = None
+        self.sent_at = {}
+        self.sent = 0
+        self.ready = threading.Event()
+        self.error = None
+
+    def create_stream(self):
+        response = self.session.post(f"{self.server_url}/api/streams", json={
+            'rate': self.args.rate, 'channels': self.args.channels, 'sample_width': 2, 'codec': 'pcm'})
+        response.raise_for_status()
+        self.stream_id = response.json()['stream_id']
+        # Servers running several workers redirect to the one that owns the stream
+        self.server_url = response.url.split('/api/', 1)[0]
+        if self.args.transport == 'socket':
+            self.sio = socketio.Client()
+            self.sio.connect(self.server_url)
+            self.sio.call('start_ingest', {'stream_id': self.stream_id}, timeout=10)
+
+    def _tone(self):
+        frames = np.arange(self.args.buffer)
+        samples = (np.sin(2 * np.pi * 440 * frames / self.args.rate) * 8000).astype(np.int16)
+        return np.repeat(samples, self.args.channels).tobytes()
+
+    def _send(self, seq, data):
+        if self.sio is not None:
+            self.sio.call('audio_frame', {'stream_id': self.stream_id, 'seq': seq,
+                                          'timestamp': seq * self.args.buffer, 'data': data}, timeout=10)
+        else:
+            self.session.post(f"{self.server_url}/api/streams/{self.stream_id}/audio", data=data, headers={
+                'Content-Type': 'application/octet-stream',
+                'X-Audio-Seq': str(seq),
+                'X-Audio-Timestamp': str(seq * self.args.buffer)
+            }).raise_for_status()
+
+    def run(self):
+        try:
+            self.create_stream()
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        self.start_event.wait()
+        tone = self._tone()
+        interval = self.args.buffer / self.args.rate
+        count = int(self.args.duration / interval)
+        next_send = time.monotonic()
+        for seq in range(count):
+            data = bytearray(tone)
+            struct.pack_into('<I', data, 0, seq)
+            self.sent_at[seq] = time.monotonic()
+            try:
+                self._send(seq, bytes(data))
+                self.stats.add('ingest', time.monotonic() - self.sent_at[seq])
+                self.sent += 1
+            except Exception:
+                self.stats.count('failed')
+
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.stats.count('late')
+        self.stats.count('sent', self.sent)
+
+    def finish(self):
+        try:
+            self.session.post(f"{self.server_url}/api/streams/{self.stream_id}/end")
+        finally:
+            if self.sio is not None:
+                self.sio.disconnect()
+            self.session.close()
+
+class Listener:
+    """Headless receiver that timestamps live buffers and chunk announcements."""
+
+    def __init__(self, sender, stats):
+        self.sender = sender
+        self.stats = stats
+        self.received = set()
+        self.joined = threading.Event()
+        self.sio = socketio.Client()
+        self.sio.on('joined', lambda data: self.joined.set())
+        self.sio.on('audio_data', self.on_audio_data)
+        self.sio.on('new_chunk', self.on_new_chunk)
+
+    def connect(self):
+        self.sio.connect(self.sender.server_url)
+        self.sio.emit('join_stream', {'stream_id': self.sender.stream_id})
+
+    def on_audio_data(self, data):
+        now = time.monotonic()
+        seq, = struct.unpack_from('<I', data['data'])
+        sent_at = self.sender.sent_at.get(seq)
+        if sent_at is not None and seq not in self.received:
+            self.received.add(seq)
+            self.stats.add('end_to_end', now - sent_at)
+
+    def on_new_chunk(self, data):
+        now = time.monotonic()
+        # Chunks are named by start frame and close with the buffer holding their last frame
+        start = int(data['chunk_id'].rsplit('/', 1)[1].split('.', 1)[0])
+        last_frame = start + CHUNK_DURATION * self.sender.args.rate - 1
+        sent_at = self.sender.sent_at.get(last_frame // self.sender.args.buffer)
+        if sent_at is not None:
+            self.stats.add('chunks', now - sent_at)
+
+    def finish(self):
+        self.stats.count('expected', self.sender.sent)
+        self.stats.count('received', len(self.received))
+        self.sio.disconnect()
+
+def process_tree(pid):
+    # The server and any worker processes it started
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = [pid]
+    for candidate in tree:
+        tree.extend(child for child, parent in parents.items() if parent == candidate)
+    return tree
+
+def process_usage(pid):
+    """Returns (CPU seconds, resident bytes) of a process and its children, read from /proc."""
+    cpu = 0.0
+    rss = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            with open(f'/proc/{member}/statm') as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+class UsageMonitor(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, process_usage(self.pid)[1])
+
+def start_server(args, workdir, s3_url):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVERS[args.server])
+    env = dict(os.environ, S3_ENDPOINT_URL=s3_url, AWS_ACCESS_KEY_ID='benchmark',
+               AWS_SECRET_ACCESS_KEY='benchmark', AWS_DEFAULT_REGION='us-west-1')
+    command = [sys.executable, script, '--host', '127.0.0.1', '--port', str(args.port)] + shlex.split(args.server_args)
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"Server exited with code {process.returncode}, see {log.name}")
+        try:
+            requests.get(f"http://127.0.0.1:{args.port}/api/streams", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.kill()
+    raise Exception("Server did not start within 30 seconds")
+
+def percentiles(values):
+    if not values:
+        return None
+    ms = np.array(values) * 1000
+    return {'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95)),
+            'p99': float(np.percentile(ms, 99)), 'max': float(ms.max()), 'count': len(values)}
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='audio-benchmark-')
+    s3 = S3StandIn(('127.0.0.1', 0))
+    threading.Thread(target=s3.serve_forever, daemon=True).start()
+    server = start_server(args, workdir, f"http://127.0.0.1:{s3.server_address[1]}")
+    server_url = f"http://127.0.0.1:{args.port}"
+    stats = Stats()
+    start_event = threading.Event()
+    try:
+        senders = [SyntheticSender(server_url, args, stats, start_event) for _ in range(args.streams)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.ready.wait()
+            if sender.error is not None:
+                raise sender.error
+
+        listeners = [Listener(sender, stats) for sender in senders for _ in range(args.listeners)]
+        for listener in listeners:
+            listener.connect()
+        for listener in listeners:
+            listener.joined.wait(10)
+
+        monitor = UsageMonitor(server.pid)
+        monitor.start()
+        cpu_start, _ = process_usage(server.pid)
+        started = time.monotonic()
+        start_event.set()
+        for sender in senders:
+            sender.join()
+        for sender in senders:
+            sender.finish()
+        # Give the last chunks time to be stored and announced
+        time.sleep(CHUNK_DURATION / 2)
+        elapsed = time.monotonic() - started
+        cpu_end, rss = process_usage(server.pid)
+        monitor.stopped.set()
+        for listener in listeners:
+            listener.finish()
+    finally:
+        server.terminate()
+        server.wait()
+        s3.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    missed = stats.expected - stats.received
+    return {
+        'config': {key: getattr(args, key) for key in
+                   ('server', 'server_args', 'streams', 'listeners', 'duration', 'rate', 'channels', 'buffer', 'transport')},
+        'ingest_ms': percentiles(stats.ingest),
+        'end_to_end_ms': percentiles(stats.end_to_end),
+        'chunk_ms': percentiles(stats.chunks),
+        'buffers': {'sent': stats.sent, 'failed': stats.failed, 'late': stats.late, 'missed_by_listeners': missed,
+                    'missed_ratio': missed / stats.expected if stats.expected else 0.0},
+        'cpu_per_stream': (cpu_end - cpu_start) / elapsed / args.streams,
+        'rss_per_stream_mib': max(rss, monitor.peak_rss) / args.streams / (1024 * 1024),
+        's3_puts': s3.puts
+    }
+
+def print_results(results):
+    config = results['config']
+    print(f"{SERVERS[config['server']]} {config['server_args']}".rstrip() +
+          f": {config['streams']} streams x {config['listeners']} listeners, {config['duration']:g}s of "
+          f"{config['rate']} Hz x{config['channels']} in {config['buffer']}-frame buffers over {config['transport']}")
+    for name, key in [('Ingest latency', 'ingest_ms'), ('End-to-end latency', 'end_to_end_ms'), ('Chunk latency', 'chunk_ms')]:
+        values = results[key]
+        if values is None:
+            print(f"  {name:<20} no samples")
+        else:
+            print(f"  {name:<20} p50 {values['p50']:8.1f} ms  p95 {values['p95']:8.1f} ms  "
+                  f"p99 {values['p99']:8.1f} ms  max {values['max']:8.1f} ms  ({values['count']} samples)")
+    buffers = results['buffers']
+    print(f"  Buffers              sent {buffers['sent']}, failed {buffers['failed']}, late {buffers['late']}, "
+          f"missed by listeners {buffers['missed_by_listeners']} ({buffers['missed_ratio']:.1%})")
+    print(f"  Server per stream    CPU {results['cpu_per_stream']:.1%} of a core, "
+          f"peak RSS {results['rss_per_stream_mib']:.1f} MiB")
+
+def compare(results, baseline, tolerance):
+    """Returns a description of every metric that is worse than the baseline by more than the tolerance."""
+    metrics = [('ingest p95', lambda r: (r['ingest_ms'] or {}).get('p95')),
+               ('end-to-end p95', lambda r: (r['end_to_end_ms'] or {}).get('p95')),
+               ('chunk p95', lambda r: (r['chunk_ms'] or {}).get('p95')),
+               ('missed buffers', lambda r: r['buffers']['missed_ratio']),
+               ('CPU per stream', lambda r: r['cpu_per_stream']),
+               ('RSS per stream', lambda r: r['rss_per_stream_mib'])]
+    regressions = []
+    for name, value in metrics:
+        old, new = value(baseline), value(results)
+        if old is None or new is None:
+            continue
+        if new > old * (1 + tolerance) and new - old > 1e-3:
+            regressions.append(f"{name}: {old:.3f} -> {new:.3f}")
+    return regressions
+
+def main():
+    args = parse_args()
+    if args.buffer * args.channels * 2 < 4:
+        print("Buffers must hold at least 4 bytes")
+        return 2
+
+    results = run_benchmark(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Compact in-memory index of a stream's chunks.
+
+A long recording has thousands of chunks, and every stream in memory used
+to hold a dict and a formatted chunk name for each of them. A ChunkIndex
+keeps the start frame, frame count and size of every chunk in one integer
+array and derives chunk ids from the start frame; only chunks with gaps,
+duplicates, skipped silence, a segment or a name of their own (imported
+from an older archive) carry a dict of extra fields. Entries are handed
+out as the same dicts as before, built when they are read.
+"""
+from array import array
+import sys
+import threading
+
+FIELDS = ('chunk_id', 'start', 'frames', 'bytes')
+
+
+def gaps_to_silence(gaps, silence, start, end):
+    """Moves the frames of `gaps` between `start` and `end` to `silence`, both lists of [frame, frames].
+
+    Returns the number of frames moved.
+    """
+    moved = 0
+    kept = []
+    for frame, missing in gaps:
+        first, last = max(frame, start), min(frame + missing, end)
+        if first >= last:
+            kept.append([frame, missing])
+            continue
+        if frame < first:
+            kept.append([frame, first - frame])
+        if last < frame + missing:
+            kept.append([last, frame + missing - last])
+        silence.append([first, last - first])
+        moved += last - first
+    if moved:
+        gaps[:] = kept
+        silence.sort()
+    return moved
+
+
+class ChunkIndex:
+    """The chunks of one stream, ordered by the sample frame they start at.
+
+    Readers do not lock. Each chunk is one (start, frames, bytes) row of
+    `rows`, extended in a single call when a chunk is appended, and a chunk
+    inserted before others (audio backfilled by its sender) replaces the
+    whole array, so readers always see complete rows. Writers take `lock`.
+    """
+    __slots__ = ('prefix', 'extension', 'rows', 'extra', 'lock')
+
+    def __init__(self, stream_id, extension, entries=()):
+        self.prefix = f"{stream_id}/"
+        self.extension = extension
+        self.rows = array('q')
+        self.extra = {}  # start frame -> fields beyond start, frames and bytes
+        self.lock = threading.Lock()
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self.rows) // 3
+
+    def __iter__(self):
+        rows = self.rows
+        for position in range(len(rows) // 3):
+            yield self._entry(rows, position)
+
+    def __getitem__(self, position):
+        rows = self.rows
+        count = len(rows) // 3
+        if position < 0:
+            position += count
+        if not 0 <= position < count:
+            raise IndexError('chunk index out of range')
+        return self._entry(rows, position)
+
+    def _entry(self, rows, position):
+        start, frames, size = rows[position * 3:position * 3 + 3]
+        entry = {'chunk_id': f"{self.prefix}{start}.{self.extension}", 'start': start, 'frames': frames, 'bytes': size}
+        entry.update(self.extra.get(start, ()))
+        return entry
+
+    def _chunk_id(self, start):
+        extra = self.extra.get(start)
+        if extra is not None and 'chunk_id' in extra:
+            return extra['chunk_id']
+        return f"{self.prefix}{start}.{self.extension}"
+
+    def _bisect(self, rows, start):
+        # Position of the first chunk starting at or after `start`
+        low, high = 0, len(rows) // 3
+        while low < high:
+            middle = (low + high) // 2
+            if rows[middle * 3] < start:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _set_extra(self, entry):
+        extra = {key: value for key, value in entry.items() if key not in FIELDS}
+        if entry['chunk_id'] != f"{self.prefix}{entry['start']}.{self.extension}":
+            extra['chunk_id'] = entry['chunk_id']
+        if 'segment' in extra:
+            # Every chunk of a segment names it; keep one copy of the name
+            extra['segment'] = sys.intern(extra['segment'])
+        if extra:
+            self.extra[entry['start']] = extra
+
+    def append(self, entry):
+        """Adds a chunk that starts after every chunk in the index."""
+        with self.lock:
+            self._set_extra(entry)
+            self.rows.extend((entry['start'], entry['frames'], entry['bytes']))
+
+    def insert(self, entry):
+        """Adds a chunk in start order, wherever it falls."""
+        with self.lock:
+            rows = self.rows
+            position = self._bisect(rows, entry['start'])
+            self._set_extra(entry)
+            if position == len(rows) // 3:
+                rows.extend((entry['start'], entry['frames'], entry['bytes']))
+                return
+            inserted = rows[:position * 3]
+            inserted.extend((entry['start'], entry['frames'], entry['bytes']))
+            inserted.extend(rows[position * 3:])
+            self.rows = inserted
+
+    def chunk_ids(self):
+        rows = self.rows
+        return [self._chunk_id(rows[position * 3]) for position in range(len(rows) // 3)]
+
+    def position(self, chunk_id):
+        """Returns the position of a chunk in the index, or None."""
+        return self._position(self.rows, chunk_id)
+
+    def _position(self, rows, chunk_id):
+        # Chunks are named after the sample frame they start at
+        name = chunk_id[len(self.prefix):].split('.', 1)[0] if chunk_id.startswith(self.prefix) else ''
+        if name.isdigit():
+            start = int(name)
+        else:
+            start = next((start for start, extra in list(self.extra.items()) if extra.get('chunk_id') == chunk_id), None)
+            if start is None:
+                return None
+        position = self._bisect(rows, start)
+        if position < len(rows) // 3 and rows[position * 3] == start and self._chunk_id(start) == chunk_id:
+            return position
+        return None
+
+    def find(self, chunk_id):
+        rows = self.rows
+        position = self._position(rows, chunk_id)
+        return self._entry(rows, position) if position is not None else None
+
+    def overlapping(self, start, end):
+        """Returns the entries of chunks that hold any sample frame from `start` up to `end`."""
+        rows = self.rows
+        position = self._bisect(rows, start)
+        if position > 0 and rows[position * 3 - 3] + rows[position * 3 - 2] > start:
+            position -= 1
+        entries = []
+        while position < len(rows) // 3 and rows[position * 3] < end:
+            entries.append(self._entry(rows, position))
+            position += 1
+        return entries
+
+    def mark_silence(self, start, end):
+        """Records the gaps between frames `start` and `end` as skipped silence, e.g. once its sender says so.
+
+        A gap is kept by the chunk that holds its padding, or by the first
+        chunk after it. Returns the entries that changed and the number of
+        frames marked.
+        """
+        with self.lock:
+            rows = self.rows
+            position = self._bisect(rows, start)
+            if position > 0 and rows[position * 3 - 3] + rows[position * 3 - 2] > start:
+                position -= 1
+            changed = []
+            marked = 0
+            while position < len(rows) // 3:
+                chunk_start = rows[position * 3]
+                extra = self.extra.get(chunk_start)
+                if extra is not None and 'gaps' in extra:
+                    gaps = [list(gap) for gap in extra['gaps']]
+                    silence = [list(run) for run in extra.get('silence', [])]
+                    moved = gaps_to_silence(gaps, silence, start, end)
+                    if moved:
+                        extra = dict(extra, silence=silence)
+                        if gaps:
+                            extra['gaps'] = gaps
+                        else:
+                            del extra['gaps']
+                        self.extra[chunk_start] = extra
+                        changed.append(self._entry(rows, position))
+                        marked += moved
+                # Chunks after the first one starting at `end` hold no gaps before it
+                if chunk_start >= end:
+                    break
+                position += 1
+            return changed, marked
+
+    def update(self, chunk_id, fields):
+        """Changes the size or extra fields of a chunk, e.g. once it is in a segment."""
+        with self.lock:
+            position = self.position(chunk_id)
+            if position is None:
+                return
+            fields = dict(fields)
+            if 'bytes' in fields:
+                self.rows[position * 3 + 2] = fields.pop('bytes')
+            if fields:
+                start = self.rows[position * 3]
+                extra = {**self.extra.get(start, {}), **fields}
+                if 'segment' in extra:
+                    extra['segment'] = sys.intern(extra['segment'])
+                self.extra[start] = extra
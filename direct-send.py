@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
+import os
 import sys
 import time
+import struct
 import requests
 import argparse
 import pyaudio
 import threading
+import queue
 from socketio import Client
 import json
+from collections import deque
+from audio_codecs import CODECS, SilenceGate, get_codec
+import ingest
+
+SEND_TIMEOUT = 5  # seconds before a live request is given up and its audio spooled
+BACKFILL_SPEED = 10  # spooled audio is sent at up to this many times real time while live audio continues
+BACKFILL_SECONDS = 10  # seconds of spooled audio sent in one backfill request
+BACKFILL_BYTES = 4 * 1024 * 1024
+INGEST_QUEUE_SIZE = 64  # frames waiting to be written to the ingest request
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Audio Streaming Sender')
@@ -17,6 +29,24 @@ def parse_args():
     parser.add_argument('--rate', '-r', type=int, default=44100, help='Sample rate in Hz')
     parser.add_argument('--format', '-f', type=int, default=pyaudio.paInt16, help='Audio format')
     parser.add_argument('--chunk', type=int, default=1024, help='Frames per buffer')
+    parser.add_argument('--codec', choices=list(CODECS), default='pcm', help='Audio codec used on the wire and for storage')
+    parser.add_argument('--queue-size', type=int, default=200, help='Maximum number of buffers waiting to be sent')
+    parser.add_argument('--max-latency', type=float, default=0.1, help='Maximum time in seconds to hold buffers before sending them')
+    parser.add_argument('--max-batch', type=int, default=16, help='Maximum number of buffers sent in one request')
+    parser.add_argument('--transport', choices=['auto', 'socket', 'http', 'stream'], default='auto',
+                        help='How to send audio: Socket.IO binary frames, HTTP requests, one long streaming HTTP request, '
+                             'or socket when the server supports it')
+    parser.add_argument('--silence-threshold', type=float, default=None,
+                        help='Send silence markers instead of audio below this level in dBFS, e.g. -50 (default: always send audio)')
+    parser.add_argument('--silence-hangover', type=float, default=1.0,
+                        help='Seconds of continuous quiet before silence markers are sent')
+    parser.add_argument('--spool-dir', default='spool', help='Directory for audio that could not be sent, uploaded again once the server is back')
+    parser.add_argument('--no-spool', action='store_true', help='Drop audio that could not be sent instead of spooling it')
+    parser.add_argument('--backfill-speed', type=float, default=BACKFILL_SPEED,
+                        help='Send spooled audio at up to this many times real time while streaming (0 for no limit)')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='Seconds to wait for the spool to drain before ending the stream')
+    parser.add_argument('--drain-spool', default=None, metavar='PATH', help='Upload the audio left in a spool file and exit')
+    parser.add_argument('--stats-interval', type=float, default=10, help='Seconds between upload statistics reports (0 to disable)')
     
     return parser.parse_args()
 
@@ -33,26 +63,562 @@ def list_audio_devices():
     
     p.terminate()
 
-def create_stream(server_url):
-    response = requests.post(f"{server_url}/api/streams")
+def audio_format(args):
+    return {
+        'rate': args.rate,
+        'channels': args.channels,
+        'sample_width': pyaudio.get_sample_size(args.format),
+        'codec': args.codec
+    }
+
+def owner_url(response):
+    # Servers running several workers redirect to the one that owns the stream
+    return response.url.split('/api/', 1)[0]
+
+def create_stream(server_url, args):
+    response = requests.post(f"{server_url}/api/streams", json=audio_format(args))
     if response.status_code != 200:
         raise Exception(f"Failed to create stream: {response.text}")
     
     data = response.json()
-    return data["stream_id"]
+    return data["stream_id"], owner_url(response)
+
+class AudioSpool:
+    """Append-only file of audio that could not be sent, uploaded again from a background thread.
+
+    Each record is the sample frame a batch starts at, its length in frames
+    and its encoded audio, or no audio for a silence marker. The drain
+    thread joins consecutive records of the same kind into requests of up to
+    BACKFILL_SECONDS of audio and sends them to the stream's backfill
+    endpoint, which stores them in their place on the stream's timeline. While live audio is still being sent it goes at up to
+    `speed` times real time, so the live path keeps most of the link.
+
+    How far the spool has been sent is kept in `<path>.sent`, so an
+    interrupted drain resumes where it stopped, also from a later run with
+    --drain-spool. Once everything is sent both files are removed.
+    """
+
+    RECORD = struct.Struct('>QII')
+
+    def __init__(self, path, server_url, stream_id, rate, speed=BACKFILL_SPEED):
+        self.path = path
+        self.url = f"{server_url}/api/streams/{stream_id}/backfill"
+        self.rate = rate
+        self.speed = speed
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.sent = self._read_offset()
+        self.backfilled = 0  # frames stored by the server
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _read_offset(self):
+        try:
+            with open(self.path + '.sent') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def start(self):
+        self._thread.start()
+
+    def append(self, timestamp, frames, data=None):
+        # Silence markers (data None) are records of length 0
+        data = data or b''
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'ab') as f:
+                f.write(self.RECORD.pack(timestamp, frames, len(data)))
+                f.write(data)
+        self._wake.set()
+
+    def backlog(self):
+        # Bytes of the spool not sent yet
+        try:
+            return max(os.path.getsize(self.path) - self.sent, 0)
+        except OSError:
+            return 0
+
+    def _next_batch(self):
+        # Consecutive records from where the last request ended, as one
+        # request; audio is None for a batch of silence markers
+        timestamp = None
+        silent = None
+        frames = 0
+        parts = []
+        size = 0
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            f.seek(self.sent)
+            while frames < BACKFILL_SECONDS * self.rate and size < BACKFILL_BYTES:
+                header = f.read(self.RECORD.size)
+                if len(header) < self.RECORD.size:
+                    break
+                start, count, length = self.RECORD.unpack(header)
+                if timestamp is not None and (start != timestamp + frames or silent != (length == 0)):
+                    break
+                data = f.read(length)
+                if timestamp is None:
+                    timestamp = start
+                    silent = length == 0
+                parts.append(data)
+                frames += count
+                size += self.RECORD.size + length
+        if not size:
+            return None
+        return timestamp, frames, None if silent else b''.join(parts), size
+
+    def drain_once(self):
+        """Sends the next request of spooled audio; returns False if there was nothing to send."""
+        with self.lock:
+            batch = self._next_batch()
+        if batch is None:
+            return False
+
+        timestamp, frames, data, size = batch
+        started = time.monotonic()
+        headers = {"Content-Type": "application/octet-stream", "X-Audio-Timestamp": str(timestamp)}
+        if data is None:
+            headers["X-Audio-Silence"] = str(frames)
+        response = self.session.post(self.url, data=data or b'', timeout=30, headers=headers)
+        if 400 <= response.status_code < 500:
+            # The server will never take it, e.g. because the stream is gone
+            print(f"Backfill of {frames} frames at {timestamp} refused, skipping it: {response.text}")
+        else:
+            response.raise_for_status()
+            self.backfilled += response.json().get('frames', frames)
+
+        with self.lock:
+            self.sent += size
+            if self.sent >= os.path.getsize(self.path):
+                # Everything has been sent; start over with an empty spool
+                os.remove(self.path)
+                if os.path.exists(self.path + '.sent'):
+                    os.remove(self.path + '.sent')
+                self.sent = 0
+            else:
+                with open(self.path + '.sent', 'w') as f:
+                    f.write(str(self.sent))
+
+        if self.speed and data is not None:
+            time.sleep(max(frames / self.rate / self.speed - (time.monotonic() - started), 0))
+        return True
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                if self.drain_once():
+                    delay = 1
+                    continue
+                self._wake.wait(1)
+                self._wake.clear()
+            except Exception as e:
+                print(f"Error sending spooled audio, retrying in {delay}s: {e}")
+                self._stop.wait(delay)
+                delay = min(delay * 2, 30)
+
+    def stop(self, timeout=60):
+        # Live audio has stopped, so the backlog may take the whole link
+        self.speed = 0
+        deadline = time.monotonic() + timeout
+        while self.backlog() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(5)
+        self.session.close()
+        if self.backlog():
+            print(f"{self.backlog()} bytes of audio left in {self.path}; upload them later with --drain-spool {self.path}")
+
+class IngestStream:
+    """One long POST to the stream's ingest endpoint, written frame by frame.
+
+    The body is sent with Transfer-Encoding: chunked from a background
+    thread as frames are queued, so a sender that can only use HTTP needs
+    one connection and one request for the whole session. The server only
+    answers once the body ends, so when the request fails, the audio
+    written in the last SEND_TIMEOUT seconds may not have arrived and is
+    handed back with the frames still queued, to be spooled.
+    """
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+        self.queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.recent = deque()  # (written at, (timestamp, frames, audio or None, buffers)) of recently written frames
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _body(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frame, record = item
+            now = time.monotonic()
+            while self.recent and self.recent[0][0] < now - SEND_TIMEOUT:
+                self.recent.popleft()
+            self.recent.append((now, record))
+            yield frame
+
+    def _run(self):
+        try:
+            response = self.session.post(self.url, data=self._body(), headers={"Content-Type": ingest.CONTENT_TYPE},
+                                         timeout=(SEND_TIMEOUT, None))
+            response.raise_for_status()
+        except Exception as e:
+            self.error = e
+
+    def send(self, seq, timestamp, data=None, frames=0, silence=None, buffers=1):
+        if not self._thread.is_alive():
+            raise self.error or Exception("Ingest request ended")
+        record = (timestamp, frames, data, buffers) if silence is None else (timestamp, silence, None, buffers)
+        self.queue.put((ingest.pack(seq, timestamp, data, silence), record), timeout=SEND_TIMEOUT)
+
+    def close(self, timeout=SEND_TIMEOUT):
+        """Ends the body and waits for the server's answer; returns False if the request failed."""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            self.error = self.error or Exception("Ingest request stalled")
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.error = self.error or Exception("Ingest request stalled")
+        return self.error is None
+
+    def unsent(self):
+        """Returns the (timestamp, frames, audio or None for silence, buffers) of frames that may not have arrived, in order."""
+        records = [record for _, record in list(self.recent)]
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                records.append(item[1])
+        return records
+
+class AudioUploader:
+    """Sends captured buffers to the server from a background thread.
+
+    The audio callback only enqueues; buffers that arrive within the latency
+    budget are encoded together and sent as a single Socket.IO binary frame,
+    or a single request over a keep-alive session when the socket is not
+    available. With the stream transport, every batch is written as a frame
+    to one long ingest request instead.
+
+    Every send carries a sequence number and the sample frame its audio
+    starts at, counted from the start of capture, so the server can place it
+    exactly and notice buffers that were dropped or lost on the way.
+
+    With a silence gate, stretches of quiet are sent as a frame count
+    instead of audio. With a spool, audio that could not be sent is written
+    to it and uploaded again once the server can be reached.
+    """
+
+    def __init__(self, server_url, stream_id, audio_format, queue_size=200, max_latency=0.1, max_batch=16, transport='auto',
+                 silence_gate=None, spool_path=None, backfill_speed=BACKFILL_SPEED, drain_timeout=60):
+        self.server_url = server_url
+        self.stream_id = stream_id
+        self.url = f"{server_url}/api/streams/{stream_id}/audio"
+        self.ingest_url = f"{server_url}/api/streams/{stream_id}/ingest"
+        self.session = requests.Session()
+        self.audio_format = audio_format
+        self.codec = get_codec(audio_format['codec'])
+        self.frame_bytes = audio_format['channels'] * audio_format['sample_width']
+        self.transport = transport
+        self.sio = None
+        self.ingest = None
+        self.seq = 0
+        self.captured = 0  # sample frames captured so far, including dropped buffers
+        self._held = None
+        self.gate = SilenceGate(**silence_gate) if silence_gate else None
+        self.spool = None
+        if spool_path:
+            self.spool = AudioSpool(spool_path, server_url, stream_id, audio_format['rate'], backfill_speed)
+        self.drain_timeout = drain_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.dropped = 0
+        self.failed = 0
+        self.sent = 0
+        self.silent = 0
+        self.spooled = 0
+        self.requests = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.transport == 'stream':
+            print("Sending audio over one streaming HTTP request")
+        else:
+            if self.transport != 'http':
+                self.sio = self._connect_socket()
+                if self.sio is None and self.transport == 'socket':
+                    raise Exception("Server does not accept socket ingest")
+            print(f"Sending audio over {'Socket.IO' if self.sio else 'HTTP'}")
+        self._thread.start()
+        if self.spool is not None:
+            self.spool.start()
+
+    def _connect_socket(self):
+        sio = Client()
+        try:
+            sio.connect(self.server_url)
+            response = sio.call('start_ingest', {'stream_id': self.stream_id}, timeout=5)
+        except Exception as e:
+            print(f"Socket ingest unavailable, falling back to HTTP: {e}")
+            if sio.connected:
+                sio.disconnect()
+            return None
+            
+        if not response or 'error' in response:
+            print(f"Socket ingest refused, falling back to HTTP: {response}")
+            sio.disconnect()
+            return None
+        return sio
+
+    def enqueue(self, data):
+        timestamp = self.captured
+        self.captured += len(data) // self.frame_bytes
+        try:
+            self.queue.put_nowait((timestamp, data))
+        except queue.Full:
+            self.dropped += 1
+
+    def _get(self, timeout):
+        # Gated buffers are replaced by their length in frames
+        timestamp, data = self.queue.get(timeout=timeout)
+        frames = len(data) // self.frame_bytes
+        if self.gate is not None and self.gate.check(data, frames / self.audio_format['rate']):
+            return timestamp, frames, frames
+        return timestamp, data, frames
+
+    def _next_batch(self):
+        if self._held is not None:
+            item, self._held = self._held, None
+        else:
+            try:
+                item = self._get(timeout=0.1)
+            except queue.Empty:
+                return None
+
+        timestamp, data, frames = item
+        batch = [data]
+        end = timestamp + frames
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item[0] != end or isinstance(item[1], int) != isinstance(data, int):
+                # Buffers were dropped in between, or silence starts or ends;
+                # send the rest with its own timestamp
+                self._held = item
+                break
+            batch.append(item[1])
+            end += item[2]
+        return timestamp, batch
+
+    def _send(self, timestamp, batch):
+        if isinstance(batch[0], int):
+            self._send_silence(timestamp, batch)
+        elif self.transport == 'stream':
+            self._send_stream(timestamp, batch)
+        elif self.sio is not None and self.sio.connected:
+            self._send_frame(timestamp, batch)
+        else:
+            self._post(timestamp, batch)
+        self.seq += 1
+
+    def _send_failed(self, timestamp, batch, data, error):
+        # Spooled audio is sent again later instead of being lost
+        if self.spool is None:
+            self.failed += len(batch)
+            print(f"Error sending audio: {error}")
+            return
+        self.spool.append(timestamp, sum(len(buffer) for buffer in batch) // self.frame_bytes, data)
+        self.spooled += len(batch)
+        print(f"Error sending audio, spooled for backfill: {error}")
+
+    def _ingest_stream(self):
+        if self.ingest is None:
+            self.ingest = IngestStream(self.session, self.ingest_url)
+            self.requests += 1
+        return self.ingest
+
+    def _ingest_failed(self):
+        # The next batch opens a new request; audio that may have been lost
+        # with this one is spooled, the server only stores what it is missing
+        stream, self.ingest = self.ingest, None
+        if stream is None:
+            return
+        stream.close(timeout=0.1)
+        records = stream.unsent()
+        if not records:
+            return
+        # They were counted as sent or silent when they were queued
+        buffers = sum(record[3] for record in records)
+        silent = sum(record[3] for record in records if record[2] is None)
+        self.sent -= buffers - silent
+        self.silent -= silent
+        if self.spool is None:
+            self.failed += buffers
+            print(f"Lost {buffers} buffers of audio that were in flight")
+            return
+        for timestamp, frames, data, _ in records:
+            self.spool.append(timestamp, frames, data)
+        self.spooled += buffers
+        print(f"Spooled {buffers} buffers of audio that were in flight for backfill")
+
+    def _send_stream(self, timestamp, batch):
+        data = self.codec.encode(b''.join(batch), self.audio_format)
+        try:
+            self._ingest_stream().send(self.seq, timestamp, data, sum(len(buffer) for buffer in batch) // self.frame_bytes,
+                                       buffers=len(batch))
+            self.sent += len(batch)
+        except Exception as e:
+            self._ingest_failed()
+            self._send_failed(timestamp, batch, data, e)
+
+    def _send_frame(self, timestamp, batch):
+        data = self.codec.encode(b''.join(batch), self.audio_format)
+        try:
+            self.sio.emit('audio_frame', {
+                'stream_id': self.stream_id,
+                'seq': self.seq,
+                'timestamp': timestamp,
+                'data': data
+            })
+            self.sent += len(batch)
+            self.requests += 1
+        except Exception as e:
+            self._send_failed(timestamp, batch, data, e)
+
+    def _send_silence(self, timestamp, batch):
+        try:
+            if self.transport == 'stream':
+                self._ingest_stream().send(self.seq, timestamp, silence=sum(batch), buffers=len(batch))
+                self.silent += len(batch)
+                return
+            if self.sio is not None and self.sio.connected:
+                self.sio.emit('audio_frame', {
+                    'stream_id': self.stream_id,
+                    'seq': self.seq,
+                    'timestamp': timestamp,
+                    'silence': sum(batch)
+                })
+            else:
+                response = self.session.post(self.url, headers={
+                    "X-Audio-Seq": str(self.seq),
+                    "X-Audio-Timestamp": str(timestamp),
+                    "X-Audio-Silence": str(sum(batch))
+                })
+                response.raise_for_status()
+            self.silent += len(batch)
+            self.requests += 1
+        except Exception as e:
+            if self.transport == 'stream':
+                self._ingest_failed()
+            # Spooled so backfill marks it as silence rather than a gap
+            if self.spool is None:
+                self.failed += len(batch)
+                print(f"Error sending silence: {e}")
+                return
+            self.spool.append(timestamp, sum(batch))
+            self.spooled += len(batch)
+            print(f"Error sending silence, spooled for backfill: {e}")
+
+    def _post(self, timestamp, batch):
+        data = self.codec.encode(b''.join(batch), self.audio_format)
+        try:
+            response = self.session.post(
+                self.url,
+                data=data,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "X-Audio-Seq": str(self.seq),
+                    "X-Audio-Timestamp": str(timestamp)
+                },
+                timeout=SEND_TIMEOUT
+            )
+            response.raise_for_status()
+            self.sent += len(batch)
+            self.requests += 1
+        except Exception as e:
+            self._send_failed(timestamp, batch, data, e)
+
+    def _run(self):
+        while not (self._stop.is_set() and self.queue.empty() and self._held is None):
+            batch = self._next_batch()
+            if batch:
+                self._send(*batch)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._thread.join(timeout)
+        if self.sio is not None:
+            self.sio.disconnect()
+        if self.ingest is not None and not self.ingest.close():
+            print(f"Error ending ingest request: {self.ingest.error}")
+            self._ingest_failed()
+        self.session.close()
+        if self.spool is not None:
+            self.spool.stop(self.drain_timeout)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'sent': self.sent,
+            'silent': self.silent,
+            'requests': self.requests,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'spooled': self.spooled,
+            'spool_backlog': self.spool.backlog() if self.spool is not None else 0,
+            'backfilled': self.spool.backfilled if self.spool is not None else 0,
+        }
+
+def print_stats(uploader):
+    stats = uploader.stats()
+    print(f"📊 Queue: {stats['queued']}, sent: {stats['sent']} buffers and {stats['silent']} silent ones "
+          f"in {stats['requests']} requests, dropped: {stats['dropped']}, failed: {stats['failed']}")
+    if stats['spooled']:
+        print(f"💾 Spooled: {stats['spooled']} buffers, {stats['spool_backlog']} bytes still to send, "
+              f"backfilled: {stats['backfilled']} frames")
 
 def stream_audio(server_url, stream_id, args):
     p = pyaudio.PyAudio()
     
+    uploader = AudioUploader(
+        server_url,
+        stream_id,
+        audio_format(args),
+        queue_size=args.queue_size,
+        max_latency=args.max_latency,
+        max_batch=args.max_batch,
+        transport=args.transport,
+        silence_gate={'threshold': args.silence_threshold, 'hangover': args.silence_hangover}
+                     if args.silence_threshold is not None else None,
+        spool_path=None if args.no_spool else os.path.join(args.spool_dir, f"{stream_id}.spool"),
+        backfill_speed=args.backfill_speed,
+        drain_timeout=args.drain_timeout
+    )
+    uploader.start()
+    
     def callback(in_data, frame_count, time_info, status):
-        try:
-            requests.post(
-                f"{server_url}/api/streams/{stream_id}/audio",
-                data=in_data,
-                headers={"Content-Type": "application/octet-stream"}
-            )
-        except Exception as e:
-            print(f"Error sending audio: {e}")
+        uploader.enqueue(in_data)
         return (in_data, pyaudio.paContinue)
     
     stream = p.open(
@@ -69,9 +635,13 @@ def stream_audio(server_url, stream_id, args):
     print(f"Stream ID: {stream_id}")
     print("Press Ctrl+C to stop streaming")
     
+    last_stats = time.monotonic()
     try:
         while stream.is_active():
             time.sleep(0.1)
+            if args.stats_interval and time.monotonic() - last_stats >= args.stats_interval:
+                print_stats(uploader)
+                last_stats = time.monotonic()
     except KeyboardInterrupt:
         pass
     finally:
@@ -79,12 +649,27 @@ def stream_audio(server_url, stream_id, args):
         stream.close()
         p.terminate()
         
+        uploader.stop()
+        print_stats(uploader)
+        
         try:
             requests.post(f"{server_url}/api/streams/{stream_id}/end")
             print("Stream ended")
         except Exception as e:
             print(f"Error ending stream: {e}")
 
+def drain_spool(server_url, path, args):
+    # Spools are named after their stream; the stream may have ended long ago
+    stream_id = os.path.basename(path).rsplit('.', 1)[0]
+    spool = AudioSpool(path, server_url, stream_id, args.rate, speed=0)
+    print(f"Uploading {spool.backlog()} bytes of spooled audio to stream {stream_id}")
+    try:
+        while spool.drain_once():
+            pass
+    except Exception as e:
+        print(f"Error sending spooled audio, run again to resume: {e}")
+    print(f"Backfilled {spool.backfilled} frames")
+
 def main():
     args = parse_args()
     
@@ -94,9 +679,22 @@ def main():
     
     server_url = args.server
     
+    if args.drain_spool:
+        drain_spool(server_url, args.drain_spool, args)
+        return
+    
+    if args.codec != 'pcm' and pyaudio.get_sample_size(args.format) != 2:
+        print("Compressed codecs require 16-bit audio (--format 8)")
+        return
+    if args.silence_threshold is not None and pyaudio.get_sample_size(args.format) != 2:
+        print("The silence gate requires 16-bit audio (--format 8)")
+        return
+    
     # Create a new stream
-    stream_id = create_stream(server_url)
+    stream_id, server_url = create_stream(server_url, args)
     print(f"Created new stream with ID: {stream_id}")
+    if server_url != args.server:
+        print(f"Stream is served by {server_url}")
     
     # Start streaming audio
     stream_audio(server_url, stream_id, args)
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 import os
+import sys
 import time
 import json
 import threading
-from flask import Flask, request, jsonify, send_file
-from flask_socketio import SocketIO, emit
+import queue
+from flask import Flask, Response, request, jsonify, send_file
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import tempfile
-import uuid
+import sqlite3
+from collections import OrderedDict
+from urllib.parse import urlencode
+from audio_codecs import (CODECS, Converter, SilenceGate, codec_for_extension, conversion_target, convert_chunk,
+                          format_key, get_codec)
+from sharding import install_worker, new_stream_id, run_workers, shard_for
+from chunk_index import ChunkIndex, gaps_to_silence
+import export
+import ingest
+import metrics
+import playlist
+import preroll
+import segments
 import logging
 
 # Set up logging
@@ -19,124 +33,1320 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Configuration
 CHUNK_DURATION = 5  # seconds
+GAP_FILL_LIMIT = 1.0  # seconds; longer gaps start a new chunk instead of being padded with silence
+SILENCE_HANGOVER = 1.0  # seconds of quiet before a stream's silence gate closes, unless set per stream
 STORAGE_DIR = "audio_chunks"
+REGISTRY_PATH = os.path.join(STORAGE_DIR, 'registry.db')
+SPILL_BYTES = 16 * 1024 * 1024  # chunks larger than this are moved to a temp file
+PREALLOCATE = False  # reserve a whole chunk's disk space when a chunk moves to a file
+FSYNC_INTERVAL = 0  # seconds between batched fsyncs of new chunk files, 0 leaves writeback to the OS
+DEFAULT_FORMAT = {'rate': 44100, 'channels': 1, 'sample_width': 2, 'codec': 'pcm'}
+COMPACT_INTERVAL = 300  # seconds between compaction passes, 0 to disable
+COMPACT_AGE = 3600  # seconds; older chunks of live streams are compacted into segments
+STREAM_IDLE_TIMEOUT = 300  # seconds without audio before a live stream is ended, 0 to keep it open
+STREAM_EVICT_AFTER = 60  # seconds an ended stream stays in memory after it was last used
+REAP_INTERVAL = 10  # seconds between checks for idle and unused streams
+PREROLL_BUFFER = 10  # seconds of recent audio kept per live stream for listeners that join
+EXPORT_WORKERS = export.WORKERS  # chunks read at the same time for one export
+BROADCAST_QUEUE_SIZE = 1000  # buffers waiting to be broadcast before the oldest is dropped
+LISTENER_QUEUE_LIMIT = 100  # packets queued for one listener before it skips ahead
+CONVERSION_CACHE_BYTES = 64 * 1024 * 1024  # chunks converted to listener formats kept in memory
 ACTIVE_STREAMS = {}
 LISTENERS = {}
+WORKER_INDEX = 0  # this process's shard when running with --workers
+WORKER_COUNT = 1
+
+# Metrics served at /metrics; gauges read their values when scraped
+INGEST_SECONDS = metrics.Histogram('audio_ingest_seconds', 'Time to handle one incoming audio buffer', ['transport'])
+INGEST_BYTES = metrics.Counter('audio_ingest_bytes_total', 'Audio bytes received by each live stream', ['stream_id'])
+LOCK_WAIT_SECONDS = metrics.Histogram('audio_stream_lock_wait_seconds', 'Time spent waiting for a stream lock')
+LOCK_HOLD_SECONDS = metrics.Histogram('audio_stream_lock_hold_seconds', 'Time a stream lock was held')
+CHUNK_SAVE_SECONDS = metrics.Histogram('audio_chunk_save_seconds', 'Time to store a finished chunk: local write',
+                                       ['stage'])
+EMIT_SECONDS = metrics.Histogram('audio_broadcast_emit_seconds', 'Time to emit one live buffer to its listeners')
+CONVERT_SECONDS = metrics.Histogram('audio_convert_seconds', 'Time to convert audio to a listener format, live, pre-roll or chunk',
+                                    ['kind'])
+metrics.Gauge('audio_active_streams', 'Streams loaded in memory', read=lambda: len(ACTIVE_STREAMS))
+metrics.Gauge('audio_listeners', 'Listeners of each stream', ['stream_id'],
+              read=lambda: {(stream_id,): len(sids) for stream_id, sids in list(LISTENERS.items())})
+metrics.Counter('audio_broadcast_dropped_total', 'Live buffers dropped because the broadcast queue was full',
+                read=lambda: broadcaster.dropped)
+metrics.Counter('audio_compacted_chunks_total', 'Chunks copied into segment files', read=lambda: compactor.compacted)
+metrics.Counter('audio_idle_streams_ended_total', 'Live streams ended after receiving no audio', read=lambda: reaper.ended)
+metrics.Counter('audio_streams_evicted_total', 'Ended streams unloaded from memory', read=lambda: reaper.evicted)
 
 # Create storage directory if it doesn't exist
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
+class Broadcaster:
+    """Fans live audio out to listeners from a background thread.
+
+    Ingest only enqueues; each buffer is then emitted once to the stream's
+    live room. Listeners whose outgoing packet queue grows past
+    LISTENER_QUEUE_LIMIT are taken out of the live room until they catch
+    up, so they skip ahead instead of holding back everyone else.
+    Listeners that asked for another format share one converter and one
+    room per stream and format, so each buffer is converted once per format.
+    """
+
+    def __init__(self, queue_size=BROADCAST_QUEUE_SIZE, listener_limit=LISTENER_QUEUE_LIMIT):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.listener_limit = listener_limit
+        self.lagging = {}
+        self.converters = {}  # stream_id -> {format key: Converter}, only used by the broadcast thread
+        self.dropped = 0
+        self.skipped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self.emitting = threading.Lock()  # held while a packet goes out, so listeners join between packets
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def publish(self, stream_id, start, data, silence=0):
+        self.start()
+        item = (stream_id, start, data, silence)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Drop the oldest buffer rather than block ingest
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(item)
+
+    def _pending_packets(self, sid):
+        try:
+            eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+            return socketio.server.eio.sockets[eio_sid].queue.qsize()
+        except (KeyError, AttributeError):
+            return 0
+
+    def _check_listeners(self):
+        for stream_id, listeners in list(LISTENERS.items()):
+            for sid, target in list(listeners.items()):
+                pending = self._pending_packets(sid)
+                if sid in self.lagging:
+                    if pending <= self.listener_limit // 4:
+                        socketio.server.enter_room(sid, live_room(stream_id, target), namespace='/')
+                        del self.lagging[sid]
+                elif pending > self.listener_limit:
+                    socketio.server.leave_room(sid, live_room(stream_id, target), namespace='/')
+                    self.lagging[sid] = stream_id
+                    self.skipped += 1
+        for sid in list(self.lagging):
+            if self.lagging[sid] not in LISTENERS or sid not in LISTENERS[self.lagging[sid]]:
+                del self.lagging[sid]
+        for stream_id in list(self.converters):
+            if stream_id not in LISTENERS:
+                del self.converters[stream_id]
+
+    def _emit_converted(self, stream_id, start, data, silence):
+        targets = {format_key(target): target for target in list(LISTENERS.get(stream_id, {}).values()) if target}
+        converters = self.converters.setdefault(stream_id, {})
+        for key in list(converters):
+            if key not in targets:
+                del converters[key]
+                
+        frames = None
+        for key, target in targets.items():
+            converter = converters.get(key)
+            if converter is None:
+                converter = converters[key] = Converter(ACTIVE_STREAMS[stream_id].format, target)
+            if silence:
+                # Silence only needs its length scaled to the target rate
+                message = {'stream_id': stream_id, 'start': start,
+                           'silence': round(silence * target['rate'] / converter.source['rate'])}
+            else:
+                with CONVERT_SECONDS.time('live'):
+                    # Every converter of a stream decodes the same source format
+                    if frames is None:
+                        frames = converter.decode(data)
+                    message = {'stream_id': stream_id, 'start': start, 'data': converter.process(frames)}
+            with EMIT_SECONDS.time():
+                socketio.emit('audio_data', message, room=live_room(stream_id, target), ignore_queue=True)
+
+    def _run(self):
+        last_check = time.monotonic()
+        while True:
+            try:
+                stream_id, start, data, silence = self.queue.get(timeout=0.5)
+                # Silence goes out as a frame count instead of audio
+                if silence:
+                    message = {'stream_id': stream_id, 'start': start, 'silence': silence}
+                else:
+                    message = {'stream_id': stream_id, 'start': start, 'data': data}
+                # Listeners of a stream are routed to the worker that ingests it,
+                # so live audio never needs to go through the worker relay
+                with self.emitting:
+                    with EMIT_SECONDS.time():
+                        socketio.emit('audio_data', message, room=live_room(stream_id), ignore_queue=True)
+                    self._emit_converted(stream_id, start, data, silence)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                logger.error(f"Error broadcasting audio: {e}")
+                
+            if time.monotonic() - last_check >= 0.2:
+                self._check_listeners()
+                last_check = time.monotonic()
+
+def live_room(stream_id, target=None):
+    if target:
+        return f"{stream_id}/live/{format_key(target)}"
+    return f"{stream_id}/live"
+
+def preroll_packets(stream, converter, frames, after=None):
+    """Returns the newest packets of a live stream, covering `frames` sample frames and starting after `after`.
+
+    With a converter they are converted to the listener's format, carrying
+    on from the packets it converted before.
+    """
+    packets = [packet for packet in stream.recent.last(frames) if after is None or packet[0] > after]
+    if converter is None:
+        return packets
+    converted = []
+    for start, data, count in packets:
+        if data is None:
+            converted.append((start, None, round(count * converter.target['rate'] / converter.source['rate'])))
+            continue
+        with CONVERT_SECONDS.time('preroll'):
+            converted.append((start, converter.process(converter.decode(data)), count))
+    return converted
+
+broadcaster = Broadcaster()
+
+class StreamRegistry:
+    """Durable record of streams and their chunks, kept in SQLite.
+
+    Streams are looked up one at a time when a request needs them, so
+    startup time does not depend on the size of the archive.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS streams (
+                    stream_id TEXT PRIMARY KEY,
+                    format TEXT NOT NULL,
+                    is_live INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    options TEXT
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    chunk_id TEXT PRIMARY KEY,
+                    stream_id TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    frames INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    metadata TEXT,
+                    segment TEXT,
+                    segment_offset INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS chunks_by_stream ON chunks (stream_id, start);
+            """)
+            # Registries created before gap tracking have no metadata column
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(chunks)')]
+            if 'metadata' not in columns:
+                self.db.execute('ALTER TABLE chunks ADD COLUMN metadata TEXT')
+            # ... or, before compaction, segment columns
+            if 'segment' not in columns:
+                self.db.execute('ALTER TABLE chunks ADD COLUMN segment TEXT')
+                self.db.execute('ALTER TABLE chunks ADD COLUMN segment_offset INTEGER')
+            self.db.execute('CREATE INDEX IF NOT EXISTS loose_chunks ON chunks (stream_id) WHERE segment IS NULL')
+            # ... and registries created before the silence gate no stream options
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(streams)')]
+            if 'options' not in columns:
+                self.db.execute('ALTER TABLE streams ADD COLUMN options TEXT')
+        return self.db
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            db = self._connect()
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def add_stream(self, stream_id, audio_format, options=None):
+        self._execute('INSERT INTO streams VALUES (?, ?, 1, ?, ?)',
+                      (stream_id, json.dumps(audio_format), time.time(), json.dumps(options) if options else None))
+
+    def _chunk_row(self, stream_id, entry):
+        metadata = {key: entry[key] for key in ('gaps', 'duplicates', 'silence') if entry.get(key)}
+        return (entry['chunk_id'], stream_id, entry['start'], entry['frames'], entry['bytes'],
+                json.dumps(metadata) if metadata else None, entry.get('segment'), entry.get('offset'))
+
+    def add_chunk(self, stream_id, entry):
+        self._execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._chunk_row(stream_id, entry))
+
+    def set_live(self, stream_id, is_live):
+        self._execute('UPDATE streams SET is_live = ? WHERE stream_id = ?', (int(is_live), stream_id))
+
+    def load(self, stream_id):
+        rows = self._execute('SELECT format, is_live, options FROM streams WHERE stream_id = ?', (stream_id,))
+        if not rows:
+            return None
+        entries = []
+        for chunk_id, start, frames, size, metadata, segment, offset in self._execute(
+                'SELECT chunk_id, start, frames, bytes, metadata, segment, segment_offset FROM chunks '
+                'WHERE stream_id = ? ORDER BY start', (stream_id,)):
+            entry = {'chunk_id': chunk_id, 'start': start, 'frames': frames, 'bytes': size}
+            entry.update(json.loads(metadata) if metadata else {})
+            if segment is not None:
+                entry.update(segment=segment, offset=offset)
+            entries.append(entry)
+        return json.loads(rows[0][0]), bool(rows[0][1]), entries, json.loads(rows[0][2] or '{}')
+
+    def set_segment(self, entries):
+        # Compacted chunks keep their ids and are found through their segment
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.executemany('UPDATE chunks SET segment = ?, segment_offset = ?, bytes = ? WHERE chunk_id = ?',
+                               [(entry['segment'], entry['offset'], entry['bytes'], entry['chunk_id'])
+                                for entry in entries])
+
+    def streams_to_compact(self):
+        return [row[0] for row in self._execute('SELECT DISTINCT stream_id FROM chunks WHERE segment IS NULL')]
+
+    def list_streams(self):
+        rows = self._execute("""
+            SELECT streams.stream_id, streams.is_live, COUNT(chunks.chunk_id)
+            FROM streams LEFT JOIN chunks ON chunks.stream_id = streams.stream_id
+            GROUP BY streams.stream_id
+        """)
+        return {stream_id: {'is_live': bool(is_live), 'chunks': count} for stream_id, is_live, count in rows}
+
+    def replace_stream(self, stream_id, audio_format, entries):
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('DELETE FROM chunks WHERE stream_id = ?', (stream_id,))
+                # Options given when the stream was created (e.g. its silence gate) are not in the archive
+                db.execute('INSERT OR REPLACE INTO streams VALUES '
+                           '(?, ?, 0, ?, (SELECT options FROM streams WHERE stream_id = ?))',
+                           (stream_id, json.dumps(audio_format), time.time(), stream_id))
+                db.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               [self._chunk_row(stream_id, entry) for entry in entries])
+
+registry = StreamRegistry()
+
+class ConversionCache:
+    """LRU cache of chunks converted to listener formats, kept in memory.
+
+    Concurrent requests for the same conversion wait for the first one
+    instead of converting the chunk again.
+    """
+
+    def __init__(self, memory_bytes=CONVERSION_CACHE_BYTES):
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def _put(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            _, old_data = self.memory.popitem(last=False)
+            self.memory_size -= len(old_data)
+
+    def get(self, key, convert):
+        while True:
+            with self.lock:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    return self.memory[key]
+                event = self.loading.get(key)
+                if event is None:
+                    event = self.loading[key] = threading.Event()
+                    break
+            event.wait()
+            
+        try:
+            data = convert()
+            with self.lock:
+                self._put(key, data)
+            return data
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+conversions = ConversionCache()
+
+class ChunkBuffer:
+    """Accumulates the audio of one chunk.
+
+    Data is kept in a preallocated bytearray and only moves to a temporary
+    file once it grows past spill_bytes (0 keeps every chunk on disk, None
+    never spills). The file is created in `directory`, next to where the
+    chunk will be stored, so storing it is a rename rather than a copy;
+    with `preallocate` its whole capacity is reserved up front.
+    """
+
+    def __init__(self, capacity, spill_bytes=None, directory=None, preallocate=False):
+        self.capacity = capacity
+        self.spill_bytes = spill_bytes
+        self.directory = directory
+        self.preallocate = preallocate
+        self.size = 0
+        self.buffer = None
+        self.file = None
+        self.path = None
+        if spill_bytes == 0:
+            self._open_file()
+        else:
+            self.buffer = bytearray(capacity)
+
+    def __len__(self):
+        return self.size
+
+    def _open_file(self):
+        self.file = tempfile.NamedTemporaryFile(delete=False, dir=self.directory, prefix='.', suffix='.part')
+        self.path = self.file.name
+        if self.preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.file.fileno(), 0, self.capacity)
+            except OSError:
+                pass  # not supported by this filesystem
+
+    def spill(self):
+        if self.buffer is None:
+            return
+        self._open_file()
+        self.file.write(memoryview(self.buffer)[:self.size])
+        self.buffer = None
+
+    def write(self, data):
+        end = self.size + len(data)
+        if self.buffer is not None and self.spill_bytes and end > self.spill_bytes:
+            self.spill()
+            
+        if self.buffer is not None:
+            self.buffer[self.size:end] = data
+        else:
+            self.file.write(data)
+        self.size = end
+
+    def finish(self):
+        if self.buffer is not None:
+            del self.buffer[self.size:]
+        elif self.file is not None:
+            if self.preallocate:
+                self.file.truncate(self.size)
+            self.file.close()
+            self.file = None
+
+    def data(self):
+        # The chunk contents when held in memory, None when they are on disk
+        return self.buffer
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.buffer = None
+
 class AudioStream:
-    def __init__(self, stream_id):
+    def __init__(self, stream_id, audio_format=None, silence_gate=None):
         self.stream_id = stream_id
-        self.chunks = []
+        self.format = audio_format or dict(DEFAULT_FORMAT)
+        self.silence_gate = silence_gate  # {'threshold': dBFS, 'hangover': seconds}, or None to store everything
+        self.gate = SilenceGate(**silence_gate) if silence_gate else None
+        self.codec = get_codec(self.format['codec'])
+        self.chunk_frames = int(self.format['rate'] * CHUNK_DURATION)
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        if frame_bytes is not None:
+            # Chunks are cut at an exact sample count, so their size is known up front
+            self.chunk_bytes = self.chunk_frames * frame_bytes
+        else:
+            self.chunk_bytes = int(self.chunk_frames * self.format['channels'] * self.format['sample_width'] *
+                                   self.codec.size_ratio * 1.1)
+        # {'chunk_id', 'start', 'frames', 'bytes'[, 'gaps', 'duplicates', 'silence']}, start/frames in sample frames
+        self.index = ChunkIndex(stream_id, self.codec.extension)
+        self.next_frame = 0  # sender timestamp the next buffer should start at
         self.current_chunk = None
         self.current_chunk_start = 0
+        self.current_chunk_frames = 0
+        self.chunk_gaps = []  # [frame, missing frames] pairs for the current chunk
+        self.chunk_duplicates = 0
+        self.chunk_silence = []  # [frame, frames] runs of silence skipped before the current chunk
         self.is_live = True
-        self.lock = threading.Lock()
+        self.last_seq = -1
+        self.lock = metrics.TimedLock(LOCK_WAIT_SECONDS, LOCK_HOLD_SECONDS)
+        self.last_active = self.last_used = time.monotonic()  # last audio received, last request
+        self.recent = preroll.RecentAudio(self.format['rate'], PREROLL_BUFFER)  # pre-roll for listeners that join
         
         # Create directory for this stream
         self.stream_dir = os.path.join(STORAGE_DIR, stream_id)
         os.makedirs(self.stream_dir, exist_ok=True)
         
-    def start_new_chunk(self):
-        if self.current_chunk:
-            self._save_chunk()
+    @classmethod
+    def load(cls, stream_id):
+        record = registry.load(stream_id)
+        if record is None:
+            return None
+            
+        audio_format, is_live, entries, options = record
+        stream = cls(stream_id, audio_format, options.get('silence_gate'))
+        stream.is_live = is_live
+        stream.index = ChunkIndex(stream_id, stream.codec.extension, entries)
+        if entries:
+            stream.next_frame = entries[-1]['start'] + entries[-1]['frames']
+        return stream
+        
+    def save_metadata(self):
+        # Archived chunks are only decodable with the stream's format and codec
+        with open(os.path.join(self.stream_dir, 'metadata.json'), 'w') as f:
+            json.dump({'stream_id': self.stream_id, 'format': self.format, 'chunk_names': 'start_frame'}, f)
             
-        self.current_chunk = tempfile.NamedTemporaryFile(delete=False, suffix='.raw')
-        self.current_chunk_start = time.time()
+    def _index_entry(self, chunk_id):
+        entry = {
+            'chunk_id': chunk_id,
+            'start': self.current_chunk_start,
+            'frames': self.current_chunk_frames,
+            'bytes': len(self.current_chunk)
+        }
+        if self.chunk_gaps:
+            entry['gaps'] = self.chunk_gaps
+        if self.chunk_duplicates:
+            entry['duplicates'] = self.chunk_duplicates
+        if self.chunk_silence:
+            entry['silence'] = self.chunk_silence
+        self.chunk_gaps = []
+        self.chunk_duplicates = 0
+        self.chunk_silence = []
+        return entry
+        
+    def find_entry(self, chunk_id):
+        return self.index.find(chunk_id)
+        
+    def chunk_ranges(self, start, end):
+        """Yields (chunk_id, first_byte, last_byte, start_frame) for the audio between two offsets in seconds.
+
+        Constant-bitrate codecs are cut to the exact frame, others are returned as whole chunks.
+        """
+        rate = self.format['rate']
+        start_frame = int(start * rate)
+        end_frame = int(end * rate) if end is not None else None
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        for entry in list(self.index):
+            chunk_end = entry['start'] + entry['frames']
+            if chunk_end <= start_frame or (end_frame is not None and entry['start'] >= end_frame):
+                continue
+            if frame_bytes is None:
+                yield entry['chunk_id'], 0, entry['bytes'] - 1, entry['start']
+                continue
+            first = max(start_frame - entry['start'], 0)
+            last = entry['frames'] if end_frame is None else min(end_frame - entry['start'], entry['frames'])
+            yield entry['chunk_id'], first * frame_bytes, last * frame_bytes - 1, entry['start'] + first
+            
+    def start_new_chunk(self):
+        self.current_chunk = ChunkBuffer(self.chunk_bytes, SPILL_BYTES, self.stream_dir, PREALLOCATE)
+        self.current_chunk_start = self.next_frame
+        self.current_chunk_frames = 0
         return self.current_chunk
+        
+    def close_chunk(self):
+        if self.current_chunk is not None:
+            self._save_chunk()
+            self.current_chunk = None
     
     def _save_chunk(self):
-        chunk_size = os.path.getsize(self.current_chunk.name)
-        if chunk_size == 0:
-            os.unlink(self.current_chunk.name)
+        if len(self.current_chunk) == 0:
+            self.current_chunk.discard()
             return
             
-        chunk_filename = f"{int(self.current_chunk_start)}.raw"
+        # Named by the sample frame they start at, so names are unique and sort in stream order
+        chunk_filename = f"{self.current_chunk_start}.{self.codec.extension}"
         chunk_path = os.path.join(self.stream_dir, chunk_filename)
         
-        # Copy to permanent storage
-        with open(self.current_chunk.name, 'rb') as src, open(chunk_path, 'wb') as dest:
-            dest.write(src.read())
+        # Write to permanent storage; a chunk that spilled to a file is
+        # already in the stream's directory and only needs renaming
+        with CHUNK_SAVE_SECONDS.time('write'):
+            self.current_chunk.finish()
+            if self.current_chunk.data() is not None:
+                write_chunk_file(chunk_path, self.current_chunk.data())
+            else:
+                os.replace(self.current_chunk.path, chunk_path)
+                syncer.add(chunk_path)
         
-        self.chunks.append(chunk_filename)
+        entry = self._index_entry(f"{self.stream_id}/{chunk_filename}")
+        self.index.append(entry)
+        registry.add_chunk(self.stream_id, entry)
         
         # Notify all listeners
-        for listener_id in LISTENERS.get(self.stream_id, []):
-            socketio.emit('new_chunk', {'chunk_id': f"{self.stream_id}/{chunk_filename}"}, room=listener_id)
+        socketio.emit('new_chunk', {'chunk_id': f"{self.stream_id}/{chunk_filename}"}, room=self.stream_id)
             
         # Cleanup temp file
-        os.unlink(self.current_chunk.name)
+        self.current_chunk.discard()
         logger.info(f"Saved chunk: {chunk_path}")
         
-    def add_audio_data(self, data):
-        with self.lock:
+    def _write(self, data, frames):
+        # Chunks end after exactly chunk_frames samples. Buffers of codecs
+        # without fixed-size frames cannot be split, so those chunks may run
+        # over by up to one buffer.
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        data = memoryview(data)
+        while frames > 0:
             if self.current_chunk is None:
                 self.start_new_chunk()
                 
-            # Check if we need to start a new chunk
-            if time.time() - self.current_chunk_start > CHUNK_DURATION:
-                self.start_new_chunk()
+            count = frames
+            if frame_bytes is not None:
+                count = min(frames, self.chunk_frames - self.current_chunk_frames)
+            part = data[:count * frame_bytes] if frame_bytes is not None else data
+            self.current_chunk.write(part)
+            self.current_chunk_frames += count
+            self.next_frame += count
+            data = data[len(part):]
+            frames -= count
+            
+            if self.current_chunk_frames >= self.chunk_frames:
+                self.close_chunk()
                 
-            self.current_chunk.write(data)
-            self.current_chunk.flush()
+    def _silence(self, frames):
+        fmt = self.format
+        return self.codec.encode(bytes(frames * fmt['channels'] * fmt['sample_width']), fmt)
+        
+    def _align(self, data, frames, timestamp):
+        """Lines a buffer up with the audio already received, using its sender timestamp.
+
+        Missing audio is recorded as a gap; short gaps are padded with silence,
+        longer ones start a new chunk at the timestamp. Audio the stream
+        already has is trimmed off and counted as a duplicate.
+        """
+        if timestamp > self.next_frame:
+            missing = timestamp - self.next_frame
+            if missing <= GAP_FILL_LIMIT * self.format['rate']:
+                self.chunk_gaps.append([self.next_frame, missing])
+                self._write(self._silence(missing), missing)
+            else:
+                self.close_chunk()
+                self.chunk_gaps.append([self.next_frame, missing])
+                self.next_frame = timestamp
+            return data, frames
             
-            # Forward to live listeners
-            for listener_id in LISTENERS.get(self.stream_id, []):
-                socketio.emit('audio_data', {'stream_id': self.stream_id, 'data': data}, room=listener_id)
+        self.chunk_duplicates += 1
+        overlap = self.next_frame - timestamp
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        if overlap >= frames or frame_bytes is None:
+            return data, 0
+        return data[overlap * frame_bytes:], frames - overlap
+        
+    def _skip_silence(self, frames):
+        # Silence is not stored: the chunk ends and the next one starts after
+        # it, so chunk names still place every chunk on the stream's timeline
+        self.close_chunk()
+        last = self.chunk_silence[-1] if self.chunk_silence else None
+        if last is not None and last[0] + last[1] == self.next_frame:
+            last[1] += frames
+        else:
+            self.chunk_silence.append([self.next_frame, frames])
+        self.next_frame += frames
+        
+    def add_audio_data(self, data, seq=None, timestamp=None, silence=None):
+        """Appends a buffer of encoded audio, or `silence` frames of silence marked by the sender."""
+        INGEST_BYTES.inc(self.stream_id, amount=len(data))
+        self.last_active = time.monotonic()
+        with self.lock:
+            # Senders number their buffers; ignore replays
+            if seq is not None:
+                if seq <= self.last_seq:
+                    self.chunk_duplicates += 1
+                    return
+                self.last_seq = seq
+                
+            # Buffers without a timestamp are taken to follow on directly
+            frames = silence if silence is not None else self.codec.frames(data, self.format)
+            if timestamp is not None and timestamp != self.next_frame:
+                data, frames = self._align(data, frames, timestamp)
+            if frames <= 0:
+                return
+                
+            if silence is None and self.gate is not None:
+                if self.gate.check(self.codec.decode(data, self.format), frames / self.format['rate']):
+                    silence = frames
+            start = self.next_frame
+            if silence is not None:
+                self._skip_silence(frames)
+                self.recent.add(start, None, frames)
+                if self.stream_id in LISTENERS:
+                    broadcaster.publish(self.stream_id, start, None, silence=frames)
+                return
+                
+            self._write(data, frames)
+            
+            # Kept for listeners that join, and forwarded to live ones
+            data = bytes(data)
+            self.recent.add(start, data, frames)
+            if self.stream_id in LISTENERS:
+                broadcaster.publish(self.stream_id, start, data)
+                
+    def _save_backfill(self, start, frames, data):
+        chunk_id = f"{self.stream_id}/{start}.{self.codec.extension}"
+        with CHUNK_SAVE_SECONDS.time('write'):
+            write_chunk_file(os.path.join(STORAGE_DIR, chunk_id), data)
+        entry = {'chunk_id': chunk_id, 'start': start, 'frames': frames, 'bytes': len(data)}
+        self.index.insert(entry)
+        registry.add_chunk(self.stream_id, entry)
+        logger.info(f"Saved backfilled chunk: {chunk_id}")
+        
+    def _holes(self, start, end):
+        # Frame ranges between start and end that no chunk holds yet
+        position = start
+        for entry in self.index.overlapping(start, end):
+            if entry['start'] > position:
+                yield position, entry['start']
+            position = max(position, entry['start'] + entry['frames'])
+        if position < end:
+            yield position, end
+            
+    def backfill(self, data, timestamp):
+        """Stores audio its sender could not deliver live, in its place on the stream's timeline.
+
+        Only sample frames that no chunk holds yet are stored, as chunks of
+        their own, so audio that did arrive is never replaced and short gaps
+        that were padded with silence stay that way. Audio from past the last
+        frame received continues a live stream as usual, without going out to
+        listeners. Returns the number of frames stored.
+        """
+        frames = self.codec.frames(data, self.format)
+        frame_bytes = self.codec.bytes_per_frame(self.format)
+        end = timestamp + frames
+        with self.lock:
+            if self.is_live and timestamp >= self.next_frame:
+                if timestamp > self.next_frame:
+                    data, frames = self._align(data, frames, timestamp)
+                self._write(data, frames)
+                return frames
+                
+            # The chunk being recorded is not in the index yet
+            frontier = end
+            if self.is_live:
+                frontier = self.current_chunk_start if self.current_chunk is not None else self.next_frame
+            if frame_bytes is None:
+                # Buffers of codecs without fixed-size frames cannot be split
+                if end <= frontier and list(self._holes(timestamp, end)) == [(timestamp, end)]:
+                    self._save_backfill(timestamp, frames, data)
+                    return frames
+                self.chunk_duplicates += 1
+                return 0
+                
+            stored = 0
+            data = memoryview(data)
+            for first, last in list(self._holes(timestamp, min(end, frontier))):
+                for start in range(first, last, self.chunk_frames):
+                    count = min(self.chunk_frames, last - start)
+                    offset = (start - timestamp) * frame_bytes
+                    self._save_backfill(start, count, data[offset:offset + count * frame_bytes])
+                    stored += count
+            if self.is_live and end > self.next_frame:
+                self._write(data[(self.next_frame - timestamp) * frame_bytes:], end - self.next_frame)
+                stored += end - self.next_frame
+            return stored
+            
+    def backfill_silence(self, timestamp, frames):
+        """Marks silence its sender could not deliver live, where the stream recorded a gap instead.
+
+        Silence is not stored, so what backfill restores is the difference
+        between silence and lost audio: the frames it covers move from the
+        gaps of their chunks to their skipped silence. Silence from past the
+        last frame received continues a live stream as usual. Returns the
+        number of frames marked.
+        """
+        end = timestamp + frames
+        with self.lock:
+            if self.is_live and timestamp >= self.next_frame:
+                if timestamp > self.next_frame:
+                    self._align(b'', 0, timestamp)
+                self._skip_silence(frames)
+                return frames
                 
+            # The chunk being recorded is not in the index yet
+            marked = gaps_to_silence(self.chunk_gaps, self.chunk_silence, timestamp, end)
+            changed, count = self.index.mark_silence(timestamp, end)
+            for entry in changed:
+                registry.add_chunk(self.stream_id, entry)
+            return marked + count
+            
     def end_stream(self):
         with self.lock:
-            if self.current_chunk:
-                self._save_chunk()
+            self.close_chunk()
             self.is_live = False
+            self.recent.clear()
+            registry.set_live(self.stream_id, False)
             logger.info(f"Stream ended: {self.stream_id}")
+        INGEST_BYTES.remove(self.stream_id)
+
+def get_stream(stream_id):
+    # Streams that are not in memory (e.g. after a restart) are loaded from the registry
+    stream = ACTIVE_STREAMS.get(stream_id)
+    if stream is None and stream_id:
+        stream = AudioStream.load(stream_id)
+        if stream is not None:
+            stream = ACTIVE_STREAMS.setdefault(stream_id, stream)
+    if stream is not None:
+        stream.last_used = time.monotonic()
+    return stream
+
+def chunk_location(chunk_id):
+    """Returns (path, offset, size) of a chunk's bytes, size None for a whole file, or None if there is no such chunk."""
+    path = os.path.join(STORAGE_DIR, chunk_id)
+    if os.path.isfile(path):
+        return path, 0, None
+        
+    # Compacted chunks are a byte range of their segment
+    stream = get_stream(chunk_id.split('/', 1)[0])
+    entry = stream.find_entry(chunk_id) if stream is not None else None
+    if entry is None or 'segment' not in entry:
+        return None
+    return os.path.join(STORAGE_DIR, entry['segment']), entry['offset'], entry['bytes']
+
+def read_range(path, offset=0, size=None):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read() if size is None else f.read(size)
+
+def write_chunk_file(path, data):
+    # Written under a temporary name next to the chunk and renamed into
+    # place, so a chunk file is complete whenever it exists
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.part')
+    with open(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    syncer.add(path)
+
+def remove_partial_files():
+    # Chunks that were being written when the server stopped never made it into place
+    count = 0
+    for stream_id in os.listdir(STORAGE_DIR):
+        stream_dir = os.path.join(STORAGE_DIR, stream_id)
+        if not os.path.isdir(stream_dir):
+            continue
+        for name in os.listdir(stream_dir):
+            if name.startswith('.') and name.endswith('.part'):
+                os.unlink(os.path.join(stream_dir, name))
+                count += 1
+    return count
+
+class ChunkSyncer:
+    """Flushes new chunk files to disk in batches from a background thread.
+
+    Chunk files are renamed into place as soon as they are written and left
+    to the OS to write back. With an `interval`, the files stored since the
+    last pass are fsynced together, followed by their directories, so a
+    crash loses at most that many seconds of chunks without an fsync per
+    chunk on the ingest path.
+    """
+
+    def __init__(self, interval=FSYNC_INTERVAL):
+        self.interval = interval
+        self.paths = []
+        self.synced = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, path):
+        if self.interval > 0:
+            with self.lock:
+                self.paths.append(path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+    def run_once(self):
+        with self.lock:
+            paths, self.paths = self.paths, []
+        # Directories last, so the renames are only made durable after the data
+        for path in paths + sorted({os.path.dirname(path) for path in paths}):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue  # compacted into a segment in the meantime
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                logger.error(f"Error syncing {path}: {e}")
+            finally:
+                os.close(fd)
+        self.synced += len(paths)
+
+syncer = ChunkSyncer()
+
+class Compactor:
+    """Merges the chunks of each stream into segment files from a background thread.
+
+    Chunks of ended streams, and chunks of live streams older than
+    COMPACT_AGE, are copied into segments of up to SEGMENT_BYTES (see
+    segments.py). Live streams are only compacted in full segments. Once the
+    registry points at a segment its chunk files are deleted; chunk ids stay
+    the same, so listeners never notice.
+    """
+
+    def __init__(self, interval=COMPACT_INTERVAL, age=COMPACT_AGE, segment_bytes=segments.SEGMENT_BYTES):
+        self.interval = interval
+        self.age = age
+        self.segment_bytes = segment_bytes
+        self.compacted = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+    def run_once(self):
+        for stream_id in registry.streams_to_compact():
+            # With --workers, each worker compacts the streams it owns
+            if shard_for(stream_id, WORKER_COUNT) != WORKER_INDEX:
+                continue
+            try:
+                stream = get_stream(stream_id)
+                if stream is not None:
+                    self.compact(stream)
+            except Exception as e:
+                logger.error(f"Error compacting stream {stream_id}: {e}")
+
+    def compact(self, stream):
+        entries = list(stream.index)
+        if stream.is_live:
+            horizon = stream.next_frame - self.age * stream.format['rate']
+            entries = [entry for entry in entries if entry['start'] + entry['frames'] <= horizon]
+        for run in segments.plan(entries, self.segment_bytes, final=not stream.is_live):
+            self._write_segment(stream, run)
+
+    def _write_segment(self, stream, run):
+        chunks = [read_range(os.path.join(STORAGE_DIR, entry['chunk_id'])) for entry in run]
+        segment_id = segments.segment_id(stream.stream_id, run[0]['start'])
+        segment_path = os.path.join(STORAGE_DIR, segment_id)
+        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+        # Written under a temporary name, so a segment is either complete or absent
+        with open(segment_path + '.tmp', 'wb') as f:
+            offsets = segments.write(f, stream.stream_id, stream.format, run, chunks)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(segment_path + '.tmp', segment_path)
+        
+        updates = [{'segment': segment_id, 'offset': offset, 'bytes': len(data)} for offset, data in zip(offsets, chunks)]
+        registry.set_segment([dict(entry, **update) for entry, update in zip(run, updates)])
+        for entry, update in zip(run, updates):
+            stream.index.update(entry['chunk_id'], update)
+            
+        # Only once nothing refers to them any more can the chunk files go
+        for entry in run:
+            os.unlink(os.path.join(STORAGE_DIR, entry['chunk_id']))
+        self.compacted += len(run)
+        logger.info(f"Compacted {len(run)} chunks of stream {stream.stream_id} into {segment_path}")
+
+compactor = Compactor()
+
+class StreamReaper:
+    """Ends abandoned streams and unloads ended ones from a background thread.
+
+    A sender that goes away without ending its stream would keep the
+    stream's chunk buffer, and any spill file, open forever, so live streams
+    that receive no audio for `idle_timeout` seconds are ended as if the
+    sender had ended them. Ended streams are dropped from ACTIVE_STREAMS once
+    they have gone unused for `evict_after` seconds and have no listeners
+    left; get_stream loads them from the registry again when asked.
+    """
+
+    def __init__(self, idle_timeout=STREAM_IDLE_TIMEOUT, evict_after=STREAM_EVICT_AFTER, interval=REAP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.evict_after = evict_after
+        self.interval = interval
+        self.ended = 0
+        self.evicted = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+    def run_once(self):
+        now = time.monotonic()
+        for stream_id, stream in list(ACTIVE_STREAMS.items()):
+            try:
+                if stream.is_live:
+                    # With --workers, only the worker that owns a stream ends it
+                    if (self.idle_timeout and now - stream.last_active > self.idle_timeout
+                            and shard_for(stream_id, WORKER_COUNT) == WORKER_INDEX):
+                        logger.info(f"Ending stream {stream_id}: no audio for {self.idle_timeout:g} seconds")
+                        stream.end_stream()
+                        self.ended += 1
+                elif now - stream.last_used > self.evict_after and stream_id not in LISTENERS:
+                    ACTIVE_STREAMS.pop(stream_id, None)
+                    self.evicted += 1
+            except Exception as e:
+                logger.error(f"Error checking stream {stream_id}: {e}")
+
+reaper = StreamReaper()
+
+def chunk_sort_key(name):
+    return int(name.split('.', 1)[0])
+
+def parse_time_range():
+    try:
+        start = float(request.args.get('start', 0))
+        end = float(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end <= start):
+        return None
+    return start, end
 
 @app.route('/api/streams', methods=['GET'])
 def list_streams():
-    # List all active streams
-    active = {id: {'is_live': stream.is_live, 'chunks': len(stream.chunks)} 
-              for id, stream in ACTIVE_STREAMS.items()}
-    return jsonify(active)
+    # List all known streams, with live state from memory where loaded
+    streams = registry.list_streams()
+    streams.update({id: {'is_live': stream.is_live, 'chunks': len(stream.index)}
+                    for id, stream in list(ACTIVE_STREAMS.items())})
+    return jsonify(streams)
 
 @app.route('/api/streams', methods=['POST'])
 def create_stream():
-    stream_id = str(uuid.uuid4())
-    ACTIVE_STREAMS[stream_id] = AudioStream(stream_id)
+    options = request.get_json(silent=True) or {}
+    try:
+        audio_format = {key: int(options.get(key, DEFAULT_FORMAT[key])) for key in ('rate', 'channels', 'sample_width')}
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid audio format'}), 400
+        
+    audio_format['codec'] = options.get('codec', 'pcm')
+    if audio_format['codec'] not in CODECS:
+        return jsonify({'error': f"Unsupported codec: {audio_format['codec']}"}), 400
+    if audio_format['codec'] != 'pcm' and audio_format['sample_width'] != 2:
+        return jsonify({'error': 'Compressed codecs require 16-bit audio'}), 400
+        
+    # An optional silence gate keeps quiet stretches out of storage and off the wire
+    silence_gate = None
+    if options.get('silence_threshold') is not None:
+        try:
+            silence_gate = {'threshold': float(options['silence_threshold']),
+                            'hangover': float(options.get('silence_hangover', SILENCE_HANGOVER))}
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid silence gate'}), 400
+        if audio_format['sample_width'] != 2 or get_codec(audio_format['codec']).bytes_per_frame(audio_format) is None:
+            return jsonify({'error': 'The silence gate needs 16-bit pcm, ulaw or alaw audio'}), 400
+            
+    stream_id = new_stream_id(WORKER_INDEX, WORKER_COUNT)
+    ACTIVE_STREAMS[stream_id] = AudioStream(stream_id, audio_format, silence_gate)
+    ACTIVE_STREAMS[stream_id].save_metadata()
+    registry.add_stream(stream_id, audio_format, {'silence_gate': silence_gate} if silence_gate else None)
     logger.info(f"Created new stream: {stream_id}")
     return jsonify({'stream_id': stream_id})
 
 @app.route('/api/streams/<stream_id>/audio', methods=['POST'])
 def add_audio(stream_id):
-    if stream_id not in ACTIVE_STREAMS:
+    stream = get_stream(stream_id)
+    if stream is None:
         return jsonify({'error': 'Stream not found'}), 404
         
-    if not ACTIVE_STREAMS[stream_id].is_live:
+    if not stream.is_live:
         return jsonify({'error': 'Stream has ended'}), 400
         
-    data = request.get_data()
-    ACTIVE_STREAMS[stream_id].add_audio_data(data)
+    with INGEST_SECONDS.time('http'):
+        data = request.get_data()
+        seq = request.headers.get('X-Audio-Seq', type=int)
+        timestamp = request.headers.get('X-Audio-Timestamp', type=int)
+        silence = request.headers.get('X-Audio-Silence', type=int)
+        stream.add_audio_data(data, seq=seq, timestamp=timestamp, silence=silence)
     return jsonify({'success': True})
 
+@app.route('/api/streams/<stream_id>/ingest', methods=['POST'])
+def ingest_audio(stream_id):
+    stream = get_stream(stream_id)
+    if stream is None:
+        return jsonify({'error': 'Stream not found'}), 404
+        
+    if not stream.is_live:
+        return jsonify({'error': 'Stream has ended'}), 400
+        
+    # One long request carries the whole session (see ingest.py); frames are
+    # handled as they arrive instead of once the body is complete
+    count = 0
+    try:
+        for seq, timestamp, payload, silence in ingest.read_frames(request.stream):
+            if not stream.is_live:
+                return jsonify({'error': 'Stream has ended', 'frames': count}), 400
+            with INGEST_SECONDS.time('stream'):
+                stream.add_audio_data(payload, seq=seq, timestamp=timestamp, silence=silence)
+            count += 1
+    except ValueError as e:
+        return jsonify({'error': str(e), 'frames': count}), 400
+    return jsonify({'success': True, 'frames': count})
+
+@app.route('/api/streams/<stream_id>/backfill', methods=['POST'])
+def backfill_audio(stream_id):
+    stream = get_stream(stream_id)
+    if stream is None:
+        return jsonify({'error': 'Stream not found'}), 404
+        
+    # Audio from a sender's spool; the stream may have ended in the meantime
+    timestamp = request.headers.get('X-Audio-Timestamp', type=int)
+    if timestamp is None or timestamp < 0:
+        return jsonify({'error': 'X-Audio-Timestamp is required'}), 400
+    silence = request.headers.get('X-Audio-Silence', type=int)
+    if silence is not None and silence <= 0:
+        return jsonify({'error': 'Invalid X-Audio-Silence'}), 400
+    with INGEST_SECONDS.time('backfill'):
+        if silence is not None:
+            frames = stream.backfill_silence(timestamp, silence)
+        else:
+            frames = stream.backfill(request.get_data(), timestamp)
+    return jsonify({'success': True, 'frames': frames})
+
+@app.route('/api/streams/<stream_id>/audio', methods=['GET'])
+def get_audio(stream_id):
+    stream = get_stream(stream_id)
+    if stream is None:
+        return jsonify({'error': 'Stream not found'}), 404
+        
+    time_range = parse_time_range()
+    if time_range is None:
+        return jsonify({'error': 'Invalid time range'}), 400
+        
+    ranges = list(stream.chunk_ranges(*time_range))
+    if not ranges:
+        return jsonify({'error': 'No audio in the requested range'}), 404
+        
+    def generate():
+        for chunk_id, first, last, _ in ranges:
+            path, offset, _ = chunk_location(chunk_id)
+            with open(path, 'rb') as f:
+                f.seek(offset + first)
+                remaining = last + 1 - first
+                while remaining > 0:
+                    data = f.read(min(remaining, 64 * 1024))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+                    
+    return Response(generate(), mimetype=stream.codec.mimetype, headers={
+        'X-Audio-Start': f"{ranges[0][3] / stream.format['rate']:.6f}",
+        'X-Audio-Format': json.dumps(stream.format)
+    })
+
+@app.route('/api/streams/<stream_id>/export', methods=['GET'])
+def export_audio(stream_id):
+    stream = get_stream(stream_id)
+    if stream is None:
+        return jsonify({'error': 'Stream not found'}), 404
+        
+    time_range = parse_time_range()
+    if time_range is None:
+        return jsonify({'error': 'Invalid time range'}), 400
+    file_format = request.args.get('format', 'wav')
+    try:
+        export.check(file_format, stream.format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+        
+    rate = stream.format['rate']
+    start, end = time_range
+    parts = export.plan(list(stream.index), int(start * rate), int(end * rate) if end is not None else None)
+    if not any(entry is not None for entry, _, _ in parts):
+        return jsonify({'error': 'No audio in the requested range'}), 404
+        
+    # Chunks are read ahead in parallel and decoded in order
+    frame_bytes = stream.format['channels'] * stream.format['sample_width']
+    blocks = export.pcm_blocks(parts, lambda entry: read_range(*chunk_location(entry['chunk_id'])),
+                               lambda data: stream.codec.decode(data, stream.format), frame_bytes, EXPORT_WORKERS)
+    filename = f"{stream_id}.{file_format}"
+    headers = {'X-Audio-Start': f"{start:.6f}", 'X-Audio-Format': json.dumps(stream.format)}
+    if file_format == 'wav':
+        frames = export.total_frames(parts)
+        
+        def generate():
+            yield export.wav_header(stream.format, frames)
+            for block in blocks:
+                yield export.wav_data(block, stream.format)
+                
+        headers['Content-Length'] = str(export.WAV_HEADER_BYTES + frames * frame_bytes)
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return Response(generate(), mimetype=export.FORMATS['wav'], headers=headers)
+        
+    # The size of a FLAC file is only known once it is encoded, so it is
+    # written to a temp file first
+    f = tempfile.TemporaryFile()
+    try:
+        writer = export.FlacWriter(f, stream.format)
+        for block in blocks:
+            writer.write(block)
+        writer.close()
+    except Exception as e:
+        f.close()
+        logger.error(f"Error exporting stream {stream_id}: {e}")
+        return jsonify({'error': str(e)}), 500
+    f.seek(0)
+    response = send_file(f, mimetype=export.FORMATS['flac'], as_attachment=True, download_name=filename)
+    response.headers.update(headers)
+    return response
+
 @app.route('/api/streams/<stream_id>/end', methods=['POST'])
 def end_stream(stream_id):
-    if stream_id not in ACTIVE_STREAMS:
+    stream = get_stream(stream_id)
+    if stream is None:
         return jsonify({'error': 'Stream not found'}), 404
         
-    ACTIVE_STREAMS[stream_id].end_stream()
+    stream.end_stream()
     return jsonify({'success': True})
 
 @app.route('/api/streams/<stream_id>/chunks', methods=['GET'])
 def get_chunks(stream_id):
-    if stream_id not in ACTIVE_STREAMS:
+    stream = get_stream(stream_id)
+    if stream is None:
         return jsonify({'error': 'Stream not found'}), 404
         
     return jsonify({
-        'chunks': [f"{stream_id}/{chunk}" for chunk in ACTIVE_STREAMS[stream_id].chunks],
-        'is_live': ACTIVE_STREAMS[stream_id].is_live
+        'chunks': stream.index.chunk_ids(),
+        'format': stream.format,
+        'index': [{
+            'chunk_id': entry['chunk_id'],
+            'start': entry['start'] / stream.format['rate'],
+            'duration': entry['frames'] / stream.format['rate'],
+            'bytes': entry['bytes'],
+            'gaps': [[frame / stream.format['rate'], missing / stream.format['rate']]
+                     for frame, missing in entry.get('gaps', [])],
+            'duplicates': entry.get('duplicates', 0),
+            'silence': [[frame / stream.format['rate'], frames / stream.format['rate']]
+                        for frame, frames in entry.get('silence', [])]
+        } for entry in stream.index],
+        'is_live': stream.is_live
     })
 
+@app.route('/api/streams/<stream_id>/playlist.m3u8', methods=['GET'])
+def get_playlist(stream_id):
+    stream = get_stream(stream_id)
+    if stream is None:
+        return jsonify({'error': 'Stream not found'}), 404
+        
+    # ?rate=, ?channels= and ?codec= list the chunks converted to that format
+    try:
+        target = conversion_target(stream.format, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    query = ''
+    if target is not None:
+        query = '?' + urlencode({key: request.args[key] for key in ('rate', 'channels', 'codec') if key in request.args})
+        
+    body = playlist.render(list(stream.index), stream.format['rate'], stream.is_live,
+                           lambda chunk_id: f"/api/chunks/{chunk_id}{query}",
+                           window=request.args.get('window', type=int))
+    etag = playlist.body_etag(body)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': playlist.cache_control(stream.is_live, CHUNK_DURATION)}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, content_type=playlist.CONTENT_TYPE, headers=headers)
+
+def send_bytes(data, mimetype, headers):
+    # Answers Range requests the way send_file does for whole files
+    byte_range = request.range.range_for_length(len(data)) if request.range else None
+    if byte_range is None:
+        if request.range:
+            return Response(status=416, headers={'Content-Range': f"bytes */{len(data)}"})
+        return Response(data, mimetype=mimetype, headers={'Accept-Ranges': 'bytes', **headers})
+        
+    first, stop = byte_range
+    return Response(data[first:stop], status=206, mimetype=mimetype, headers={
+        'Accept-Ranges': 'bytes',
+        'Content-Range': f"bytes {first}-{stop - 1}/{len(data)}",
+        **headers
+    })
+
+class FileRange:
+    """Response body of `size` bytes of an open file from `offset`, sent with sendfile where the server allows it.
+
+    The bundled Werkzeug server hands over its socket, so once the headers
+    are out the bytes go from the page cache to the socket without passing
+    through Python; other servers get the file in blocks.
+    """
+
+    def __init__(self, file, offset, size, sock=None):
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.sock = sock
+
+    def __iter__(self):
+        if self.sock is not None:
+            yield b''  # has the server send the status line and headers first
+            self.sock.sendfile(self.file, self.offset, self.size)
+            return
+        self.file.seek(self.offset)
+        remaining = self.size
+        while remaining > 0:
+            data = self.file.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.file.close()
+
+def send_chunk_file(path, offset, size, mimetype, headers):
+    # Answers Range requests the way send_bytes does, straight from the file
+    f = open(path, 'rb')
+    if size is None:
+        size = os.fstat(f.fileno()).st_size
+    byte_range = request.range.range_for_length(size) if request.range else None
+    if byte_range is None and request.range:
+        f.close()
+        return Response(status=416, headers={'Content-Range': f"bytes */{size}"})
+        
+    first, stop = byte_range or (0, size)
+    headers = {'Accept-Ranges': 'bytes', 'Content-Length': str(stop - first), **headers}
+    if byte_range is not None:
+        headers['Content-Range'] = f"bytes {first}-{stop - 1}/{size}"
+    body = FileRange(f, offset + first, stop - first, request.environ.get('werkzeug.socket'))
+    return Response(body, status=206 if byte_range is not None else 200, mimetype=mimetype, headers=headers,
+                    direct_passthrough=True)
+
+def send_converted_chunk(chunk_id, location, source, target, headers):
+    def convert():
+        with CONVERT_SECONDS.time('chunk'):
+            return convert_chunk(read_range(*location), source, target)
+    data = conversions.get(f"{chunk_id}@{format_key(target)}", convert)
+    return send_bytes(data, get_codec(target['codec']).mimetype, headers)
+
 @app.route('/api/chunks/<path:chunk_path>', methods=['GET'])
 def get_chunk_data(chunk_path):
     parts = chunk_path.split('/')
@@ -144,12 +1354,38 @@ def get_chunk_data(chunk_path):
         return jsonify({'error': 'Invalid chunk path'}), 400
         
     stream_id, chunk_filename = parts
-    chunk_path = os.path.join(STORAGE_DIR, stream_id, chunk_filename)
-    
-    if not os.path.exists(chunk_path):
+    location = chunk_location(chunk_path)
+    if location is None:
         return jsonify({'error': 'Chunk not found'}), 404
         
-    return send_file(chunk_path, mimetype='audio/raw')
+    # ?rate=, ?channels= and ?codec= ask for the chunk in another format
+    target = None
+    if any(key in request.args for key in ('rate', 'channels', 'codec')):
+        stream = get_stream(stream_id)
+        if stream is None:
+            return jsonify({'error': 'Stream not found'}), 404
+        try:
+            target = conversion_target(stream.format, request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+            
+    # Chunks never change once saved, so a cached copy is always current
+    etag = playlist.chunk_etag(chunk_path, format_key(target) if target is not None else None)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': playlist.IMMUTABLE}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+        
+    if target is not None:
+        return send_converted_chunk(chunk_path, location, stream.format, target, headers)
+        
+    mimetype = codec_for_extension(chunk_filename.rsplit('.', 1)[-1]).mimetype
+    # Whole chunk files and compacted chunks alike are sent from the page
+    # cache, without reading them into memory
+    return send_chunk_file(*location, mimetype, headers)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @socketio.on('connect')
 def socket_connect():
@@ -159,29 +1395,152 @@ def socket_connect():
 def socket_disconnect():
     for stream_id in list(LISTENERS.keys()):
         if request.sid in LISTENERS[stream_id]:
-            LISTENERS[stream_id].remove(request.sid)
+            del LISTENERS[stream_id][request.sid]
             if not LISTENERS[stream_id]:
                 del LISTENERS[stream_id]
     logger.info(f"Client disconnected: {request.sid}")
 
+@socketio.on('start_ingest')
+def start_ingest(data):
+    stream = get_stream(data.get('stream_id'))
+    if stream is None:
+        return {'error': 'Stream not found'}
+        
+    if not stream.is_live:
+        return {'error': 'Stream has ended'}
+        
+    return {'success': True, 'last_seq': stream.last_seq, 'next_frame': stream.next_frame}
+
+@socketio.on('audio_frame')
+def audio_frame(data):
+    stream = get_stream(data.get('stream_id'))
+    if stream is None or not stream.is_live:
+        emit('error', {'message': 'Invalid stream ID'})
+        return
+        
+    with INGEST_SECONDS.time('socket'):
+        stream.add_audio_data(data.get('data', b''), seq=data.get('seq'), timestamp=data.get('timestamp'),
+                              silence=data.get('silence'))
+
 @socketio.on('join_stream')
 def join_stream(data):
     stream_id = data.get('stream_id')
-    if not stream_id or stream_id not in ACTIVE_STREAMS:
+    # Live audio only reaches listeners on the worker that owns the stream;
+    # clients find it by following the redirect of any HTTP request for it
+    if stream_id and shard_for(stream_id, WORKER_COUNT) != WORKER_INDEX:
+        emit('error', {'message': 'Stream is served by another worker',
+                       'worker': shard_for(stream_id, WORKER_COUNT)})
+        return
+        
+    stream = get_stream(stream_id)
+    if stream is None:
         emit('error', {'message': 'Invalid stream ID'})
         return
         
+    # Listeners may ask for another format; they fetch chunks with the same one in the query
+    try:
+        target = conversion_target(stream.format, data.get('format') or {})
+    except ValueError as e:
+        emit('error', {'message': str(e)})
+        return
+        
+    # Listeners start from live audio, with up to PREROLL_BUFFER seconds of
+    # what came just before it; recorded chunks are only listed for those
+    # that ask for the whole history, or once the stream has ended
+    history = bool(data.get('history')) or not stream.is_live
+    try:
+        seconds = 0 if history else min(max(float(data.get('preroll') or 0), 0), PREROLL_BUFFER)
+    except (TypeError, ValueError):
+        emit('error', {'message': 'Invalid pre-roll'})
+        return
+        
     if stream_id not in LISTENERS:
-        LISTENERS[stream_id] = set()
-    LISTENERS[stream_id].add(request.sid)
+        LISTENERS[stream_id] = {}
+    if request.sid in LISTENERS[stream_id]:
+        leave_room(live_room(stream_id, LISTENERS[stream_id][request.sid]))
+    LISTENERS[stream_id][request.sid] = target
     
     logger.info(f"Client {request.sid} joined stream {stream_id}")
     
     emit('joined', {
         'stream_id': stream_id,
-        'is_live': ACTIVE_STREAMS[stream_id].is_live,
-        'chunks': [f"{stream_id}/{chunk}" for chunk in ACTIVE_STREAMS[stream_id].chunks]
+        'is_live': stream.is_live,
+        'format': target or stream.format,
+        'chunks': stream.index.chunk_ids() if history else []
     })
+    
+    # The pre-roll goes out before the listener enters the live room, so no
+    # live packet can overtake it. It is converted first; the broadcaster
+    # then holds off while packets recorded since are added and the listener
+    # joins, and live packets it already has are dropped by their start
+    frames = int(seconds * stream.format['rate'])
+    converter = Converter(stream.format, target) if target else None
+    packets = preroll_packets(stream, converter, frames)
+    with broadcaster.emitting:
+        packets += preroll_packets(stream, converter, frames, packets[-1][0] if packets else None)
+        if packets:
+            emit('preroll', {'stream_id': stream_id, 'data': preroll.pack(packets)})
+        join_room(stream_id)
+        join_room(live_room(stream_id, target))
+
+def import_archive():
+    """Rebuilds the registry from the chunk files under STORAGE_DIR."""
+    count = 0
+    for stream_id in sorted(os.listdir(STORAGE_DIR)):
+        stream_dir = os.path.join(STORAGE_DIR, stream_id)
+        if not os.path.isdir(stream_dir):
+            continue
+            
+        metadata = {'format': dict(DEFAULT_FORMAT)}
+        metadata_path = os.path.join(stream_dir, 'metadata.json')
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        audio_format = metadata['format']
+        codec = get_codec(audio_format['codec'])
+        frame_bytes = codec.bytes_per_frame(audio_format)
+        
+        # Compacted chunks are listed in the header of their segment
+        compacted = {}
+        segment_dir = os.path.join(stream_dir, segments.SEGMENT_DIR)
+        for name in sorted(os.listdir(segment_dir)) if os.path.isdir(segment_dir) else []:
+            if not name.endswith('.seg'):
+                continue
+            segment_path = os.path.join(segment_dir, name)
+            header = segments.read_header(lambda offset, size: read_range(segment_path, offset, size))
+            for chunk in header['chunks']:
+                compacted[chunk['chunk_id']] = dict(chunk, segment=f"{stream_id}/{segments.SEGMENT_DIR}/{name}")
+                
+        names = []
+        for name in os.listdir(stream_dir):
+            try:
+                names.append((chunk_sort_key(name), name))
+            except ValueError:
+                continue
+                
+        entries = []
+        start = 0
+        for _, name in sorted(names):
+            if f"{stream_id}/{name}" in compacted:
+                continue
+            chunk_path = os.path.join(stream_dir, name)
+            size = os.path.getsize(chunk_path)
+            if frame_bytes:
+                frames = size // frame_bytes
+            else:
+                with open(chunk_path, 'rb') as f:
+                    frames = codec.frames(f.read(), audio_format)
+            # Newer chunks are named by start frame; older archives are laid end to end
+            if metadata.get('chunk_names') == 'start_frame':
+                start = chunk_sort_key(name)
+            entries.append({'chunk_id': f"{stream_id}/{name}", 'start': start, 'frames': frames, 'bytes': size})
+            start += frames
+        entries = sorted(entries + list(compacted.values()), key=lambda entry: entry['start'])
+            
+        registry.replace_stream(stream_id, audio_format, entries)
+        logger.info(f"Imported stream {stream_id}: {len(entries)} chunks")
+        count += 1
+    return count
 
 if __name__ == '__main__':
     import argparse
@@ -189,8 +1548,67 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Audio Streaming Server')
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind the server to')
     parser.add_argument('--port', type=int, default=8000, help='Port to bind the server to')
+    parser.add_argument('--spill-bytes', type=int, default=SPILL_BYTES, help='Move chunks larger than this to a temp file (0 to always use temp files)')
+    parser.add_argument('--preallocate', action='store_true', help='Reserve disk space for a whole chunk when it moves to a file')
+    parser.add_argument('--fsync-interval', type=float, default=FSYNC_INTERVAL,
+                        help='Seconds between batched fsyncs of new chunk files (0 leaves writeback to the OS)')
+    parser.add_argument('--conversion-cache', type=int, default=CONVERSION_CACHE_BYTES, help='Bytes of chunks converted to listener formats cached in memory')
+    parser.add_argument('--registry', default=REGISTRY_PATH, help='Path of the stream registry database')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes to shard streams across')
+    parser.add_argument('--worker-index', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--relay', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--import-archive', action='store_true', help=f'Rebuild the stream registry from {STORAGE_DIR}/ and exit')
+    parser.add_argument('--compact-interval', type=float, default=COMPACT_INTERVAL, help='Seconds between background compaction passes (0 to disable)')
+    parser.add_argument('--compact-age', type=float, default=COMPACT_AGE, help='Compact chunks of live streams once they are this many seconds old')
+    parser.add_argument('--idle-timeout', type=float, default=STREAM_IDLE_TIMEOUT, help='End live streams that receive no audio for this many seconds (0 to keep them open)')
+    parser.add_argument('--preroll-buffer', type=float, default=PREROLL_BUFFER,
+                        help='Seconds of recent audio kept per live stream for listeners that join (0 to keep none)')
+    parser.add_argument('--export-workers', type=int, default=EXPORT_WORKERS, help='Chunks read at the same time for one export')
+    parser.add_argument('--evict-after', type=float, default=STREAM_EVICT_AFTER, help='Unload ended streams from memory after this many seconds without use')
+    parser.add_argument('--compact', action='store_true', help='Compact all streams into segment files once and exit; run it while no server uses the registry')
     
     args = parser.parse_args()
     
+    registry.path = args.registry
+    if args.import_archive:
+        logger.info(f"Imported {import_archive()} streams into {args.registry}")
+        raise SystemExit
+        
+    compactor.interval = args.compact_interval
+    compactor.age = args.compact_age
+    if args.compact:
+        compactor.run_once()
+        logger.info(f"Compacted {compactor.compacted} chunks")
+        raise SystemExit
+        
+    # Workers share the storage directory, so only the first process cleans it up
+    if args.worker_index is None:
+        removed = remove_partial_files()
+        if removed:
+            logger.info(f"Removed {removed} partly written chunk files")
+            
+    if args.workers > 1 and args.worker_index is None:
+        run_workers(os.path.abspath(__file__), sys.argv[1:], args.host, args.port, args.workers)
+        raise SystemExit
+        
+    if args.worker_index is not None:
+        WORKER_INDEX, WORKER_COUNT = args.worker_index, args.workers
+        install_worker(app, socketio.server, WORKER_INDEX, WORKER_COUNT, args.port, args.relay)
+        
+    SPILL_BYTES = args.spill_bytes
+    PREALLOCATE = args.preallocate
+    PREROLL_BUFFER = args.preroll_buffer
+    EXPORT_WORKERS = args.export_workers
+    conversions.memory_bytes = args.conversion_cache
+    compactor.start()
+    reaper.idle_timeout = args.idle_timeout
+    reaper.evict_after = args.evict_after
+    reaper.start()
+    syncer.interval = args.fsync_interval
+    syncer.start()
     logger.info(f"Starting server on {args.host}:{args.port}")
-    socketio.run(app, host=args.host, port=args.port) 
\ No newline at end of file
+    try:
+        # The bundled Werkzeug server is what the deployment scripts run
+        socketio.run(app, host=args.host, port=args.port, allow_unsafe_werkzeug=True)
+    finally:
+        syncer.run_once() 
\ No newline at end of file
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import os
+import time
+import argparse
+import requests
+from audio_codecs import get_codec
+import export
+
+FETCH_RETRIES = 3
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a recorded stream as one WAV or FLAC file')
+    parser.add_argument('--server', '-s', required=True, help='Server URL (e.g., http://ec2-xx-xx-xx-xx.compute-1.amazonaws.com:8000)')
+    parser.add_argument('--stream-id', '-i', required=True, help='Stream ID to export')
+    parser.add_argument('--output', '-o', default=None, help='Output file; default: <stream id>.<format>')
+    parser.add_argument('--format', '-f', choices=sorted(export.FORMATS), default=None,
+                        help="File format; default: from the output file's extension, else wav")
+    parser.add_argument('--start', type=float, default=0, help='Seconds into the stream to start at')
+    parser.add_argument('--end', type=float, default=None, help='Seconds into the stream to stop at; default: the end of the recording')
+    parser.add_argument('--workers', type=int, default=export.WORKERS, help='Maximum number of concurrent chunk downloads')
+    parser.add_argument('--window', type=int, default=export.WINDOW, help='Number of chunks to download ahead of the one being written')
+
+    return parser.parse_args()
+
+def owner_url(response):
+    # Servers running several workers redirect to the one that owns the stream
+    return response.url.split('/api/', 1)[0]
+
+def get_stream_info(server_url, stream_id):
+    try:
+        response = requests.get(f"{server_url}/api/streams/{stream_id}/chunks")
+        if response.status_code != 200:
+            print(f"Error: {response.text}")
+            return None, server_url
+
+        return response.json(), owner_url(response)
+    except Exception as e:
+        print(f"Error getting stream info: {e}")
+        return None, server_url
+
+def index_entries(stream_info):
+    # The index lists seconds; chunks start and end on whole sample frames
+    rate = stream_info['format']['rate']
+    return [{'chunk_id': entry['chunk_id'],
+             'start': round(entry['start'] * rate),
+             'frames': round(entry['duration'] * rate)} for entry in stream_info['index']]
+
+class ChunkFetcher:
+    """Downloads chunks over one keep-alive session shared by the export's workers."""
+
+    def __init__(self, server_url, workers):
+        self.server_url = server_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.bytes = 0
+
+    def fetch(self, entry):
+        for attempt in range(FETCH_RETRIES):
+            try:
+                response = self.session.get(f"{self.server_url}/api/chunks/{entry['chunk_id']}", timeout=60)
+                response.raise_for_status()
+                self.bytes += len(response.content)
+                return response.content
+            except requests.RequestException as e:
+                if attempt == FETCH_RETRIES - 1:
+                    raise
+                print(f"Retrying chunk {entry['chunk_id']}: {e}")
+                time.sleep(2 ** attempt)
+
+def export_stream(server_url, stream_info, output, file_format, start, end, workers, window):
+    audio_format = stream_info['format']
+    codec = get_codec(audio_format['codec'])
+    rate = audio_format['rate']
+    parts = export.plan(index_entries(stream_info), int(start * rate), int(end * rate) if end is not None else None)
+    if not any(entry is not None for entry, _, _ in parts):
+        print("No audio in the requested range")
+        return False
+
+    frames = export.total_frames(parts)
+    frame_bytes = audio_format['channels'] * audio_format['sample_width']
+    fetcher = ChunkFetcher(server_url, workers)
+    started = time.time()
+
+    # Written next to the output and moved into place once complete, so a
+    # failed export never leaves a truncated file behind under its name
+    partial = output + '.part'
+    try:
+        with open(partial, 'wb') as f:
+            writer = export.writer(f, file_format, audio_format, frames)
+            for block in export.pcm_blocks(parts, fetcher.fetch, lambda data: codec.decode(data, audio_format),
+                                           frame_bytes, workers, window):
+                writer.write(block)
+            writer.close()
+        os.replace(partial, output)
+    except BaseException:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+
+    elapsed = time.time() - started
+    print(f"Exported {frames / rate:.1f} s of audio to {output} ({os.path.getsize(output)} bytes) in {elapsed:.1f} s, "
+          f"downloading {fetcher.bytes / max(elapsed, 1e-6) / 1e6:.1f} MB/s")
+    return True
+
+def main():
+    args = parse_args()
+
+    server_url = args.server
+    stream_id = args.stream_id
+
+    stream_info, server_url = get_stream_info(server_url, stream_id)
+    if not stream_info:
+        print(f"Stream {stream_id} not found")
+        return 1
+    if 'format' not in stream_info or 'index' not in stream_info:
+        print("The server does not list the stream's format and chunk index; update it to export")
+        return 1
+
+    file_format = args.format
+    if file_format is None:
+        extension = os.path.splitext(args.output or '')[1].lstrip('.').lower()
+        file_format = extension if extension in export.FORMATS else 'wav'
+    output = args.output or f"{stream_id}.{file_format}"
+    try:
+        export.check(file_format, stream_info['format'])
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+    if stream_info['is_live']:
+        print(f"Stream {stream_id} is live; exporting the chunks recorded so far")
+    try:
+        return 0 if export_stream(server_url, stream_info, output, file_format, args.start, args.end,
+                                  args.workers, args.window) else 1
+    except KeyboardInterrupt:
+        print("Stopping...")
+        return 1
+    except Exception as e:
+        print(f"Error exporting stream {stream_id}: {e}")
+        return 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
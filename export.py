@@ -0,0 +1,147 @@
+"""Export of a stream's recording as a single WAV or FLAC file.
+
+Chunks hold headerless audio in the stream's codec, and stretches that were
+never stored (skipped silence, long gaps) lie between them. An export
+decodes the chunks of a time range in order, puts silence of the same
+length where nothing was stored, and writes the result after a header for
+its total length, which the chunk index gives up front. Chunks are fetched
+by a bounded pool of workers up to a window ahead of the one being written,
+so a long recording is bound by bandwidth rather than by the latency of
+each request, and is never held in memory as a whole.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import struct
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+FORMATS = {'wav': 'audio/wav'}
+if soundfile is not None:
+    FORMATS['flac'] = 'audio/flac'
+WORKERS = 8  # chunks fetched at the same time
+WINDOW = 16  # parts of the timeline fetched ahead of the one being written
+SILENCE_FRAMES = 65536  # most frames of silence written at once
+WAV_HEADER_BYTES = 44
+# 8-bit WAV samples are unsigned, 8-bit PCM from the sender is signed
+_UNSIGNED = bytes((value + 128) % 256 for value in range(256))
+
+
+def plan(entries, start=0, end=None):
+    """Splits sample frames `start` to `end` of a stream's timeline into parts, in order.
+
+    `entries` are index entries sorted by start frame. Each part is
+    (entry, first frame in the chunk, frames) for audio from a chunk, or
+    (None, 0, frames) for silence where no chunk was stored. Without `end`,
+    the parts run to the end of the last chunk.
+    """
+    parts = []
+    position = start
+    for entry in entries:
+        chunk_end = entry['start'] + entry['frames']
+        if chunk_end <= position:
+            continue
+        if end is not None and entry['start'] >= end:
+            break
+        if entry['start'] > position:
+            parts.append((None, 0, entry['start'] - position))
+            position = entry['start']
+        last = chunk_end if end is None else min(chunk_end, end)
+        parts.append((entry, position - entry['start'], last - position))
+        position = last
+    return parts
+
+
+def part_blocks(part, pcm, frame_bytes):
+    """Yields the PCM of one part, given its chunk decoded to PCM (None for silence)."""
+    _, first, frames = part
+    if pcm is None:
+        while frames > 0:
+            count = min(frames, SILENCE_FRAMES)
+            yield bytes(count * frame_bytes)
+            frames -= count
+        return
+    block = bytes(pcm[first * frame_bytes:(first + frames) * frame_bytes])
+    # A chunk that decodes short is padded, so the header stays right
+    yield block + bytes(frames * frame_bytes - len(block)) if len(block) < frames * frame_bytes else block
+
+
+def pcm_blocks(parts, fetch, decode, frame_bytes, workers=WORKERS, window=WINDOW):
+    """Yields the PCM of `parts` in order, fetching chunks with fetch(entry) on `workers` threads."""
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for part in parts:
+            pending.append((part, executor.submit(fetch, part[0]) if part[0] is not None else None))
+            if len(pending) >= window:
+                part, future = pending.popleft()
+                yield from part_blocks(part, decode(future.result()) if future is not None else None, frame_bytes)
+        while pending:
+            part, future = pending.popleft()
+            yield from part_blocks(part, decode(future.result()) if future is not None else None, frame_bytes)
+    finally:
+        # An export that stops early (e.g. the client went away) drops the fetches it queued
+        executor.shutdown(cancel_futures=True)
+
+
+def total_frames(parts):
+    return sum(part[2] for part in parts)
+
+
+def wav_header(audio_format, frames):
+    channels, width, rate = audio_format['channels'], audio_format['sample_width'], audio_format['rate']
+    # RIFF sizes are 32-bit; longer recordings get the largest size, which most players accept
+    size = min(frames * channels * width, 0xFFFFFFFF - 36)
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + size, b'WAVE', b'fmt ', 16, 1, channels, rate,
+                       rate * channels * width, channels * width, width * 8, b'data', size)
+
+
+def wav_data(block, audio_format):
+    return block.translate(_UNSIGNED) if audio_format['sample_width'] == 1 else block
+
+
+def check(file_format, audio_format):
+    """Raises ValueError if a stream in `audio_format` cannot be exported as `file_format`."""
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported export format: {file_format} (available: {', '.join(FORMATS)})")
+    if file_format == 'flac' and audio_format['sample_width'] != 2:
+        raise ValueError('FLAC export requires 16-bit audio')
+
+
+class WavWriter:
+    def __init__(self, file, audio_format, frames):
+        self.file = file
+        self.audio_format = audio_format
+        file.write(wav_header(audio_format, frames))
+
+    def write(self, block):
+        self.file.write(wav_data(block, self.audio_format))
+
+    def close(self):
+        pass
+
+
+class FlacWriter:
+    """Encodes blocks of 16-bit PCM into a FLAC file through libsndfile, which needs a seekable file."""
+
+    def __init__(self, file, audio_format):
+        self.channels = audio_format['channels']
+        self.sound = soundfile.SoundFile(file, 'w', samplerate=audio_format['rate'], channels=self.channels,
+                                         format='FLAC', subtype='PCM_16')
+
+    def write(self, block):
+        self.sound.write(np.frombuffer(block, dtype=np.int16).reshape(-1, self.channels))
+
+    def close(self):
+        self.sound.close()
+
+
+def writer(file, file_format, audio_format, frames):
+    check(file_format, audio_format)
+    if file_format == 'flac':
+        return FlacWriter(file, audio_format)
+    return WavWriter(file, audio_format, frames)
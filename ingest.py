@@ -0,0 +1,79 @@
+"""Framed audio for the streaming ingest endpoint.
+
+Senders that can only use HTTP send a whole session as the body of one long
+POST to /api/streams/<stream_id>/ingest, usually with Transfer-Encoding:
+chunked, instead of one request per buffer. The body is a sequence of
+frames, each a fixed header followed by its audio:
+
+    kind (1 byte) | seq (4 bytes) | timestamp (8 bytes) | length (4 bytes) | audio
+
+All numbers are big-endian. An AUDIO frame carries `length` bytes of
+encoded audio; a SILENCE frame carries none and `length` is the number of
+sample frames of silence. `seq` and `timestamp` mean the same as the
+X-Audio-Seq and X-Audio-Timestamp headers of a single request.
+"""
+import struct
+
+HEADER = struct.Struct('>BIQI')
+AUDIO = 0
+SILENCE = 1
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+CONTENT_TYPE = 'application/x-audio-frames'
+
+
+def pack(seq, timestamp, data=None, silence=None):
+    if silence is not None:
+        return HEADER.pack(SILENCE, seq, timestamp, silence)
+    return HEADER.pack(AUDIO, seq, timestamp, len(data)) + data
+
+
+def read_frames(stream):
+    """Yields the (seq, timestamp, audio, silence) of each frame of a blocking file-like body as soon as it is complete."""
+    while True:
+        header = stream.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size:
+            raise ValueError('Body ends inside a frame')
+        kind, seq, timestamp, length = HEADER.unpack(header)
+        if kind == SILENCE:
+            yield seq, timestamp, b'', length
+            continue
+        if kind != AUDIO or length > MAX_FRAME_BYTES:
+            raise ValueError('Malformed audio frame')
+        data = stream.read(length)
+        if len(data) < length:
+            raise ValueError('Body ends inside a frame')
+        yield seq, timestamp, data, None
+
+
+class FrameReader:
+    """Splits a body that arrives in pieces of any size back into frames, for non-blocking readers."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Returns the (seq, timestamp, audio, silence) of every frame completed by `data`."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            kind, seq, timestamp, length = HEADER.unpack_from(self.buffer, offset)
+            if kind == SILENCE:
+                frames.append((seq, timestamp, b'', length))
+                offset += HEADER.size
+                continue
+            if kind != AUDIO or length > MAX_FRAME_BYTES:
+                raise ValueError('Malformed audio frame')
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((seq, timestamp, bytes(self.buffer[offset + HEADER.size:end]), None))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+    def pending(self):
+        # Bytes of a frame that has not been completed
+        return len(self.buffer)
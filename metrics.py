@@ -0,0 +1,166 @@
+"""Pre-aggregated metrics served in the Prometheus text format.
+
+Recording a value only bumps a counter or a histogram bucket under a short
+lock, so instrumentation can stay on in production; nothing is logged per
+event. Values that already live elsewhere, such as listener counts or
+cache statistics, are read through a callback when /metrics is scraped.
+"""
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named family of series, one per combination of label values.
+
+    With `read`, series come from calling it at scrape time: a number when
+    the metric has no labels, otherwise a dict of label value tuples to numbers.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), read=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def remove(self, *values):
+        with self.lock:
+            self.values.pop(values, None)
+
+    def _series(self):
+        if self.read is not None:
+            values = self.read()
+            return values if self.labels else {(): values}
+        with self.lock:
+            return {key: self._copy(value) for key, value in self.values.items()}
+
+    def _copy(self, value):
+        return value
+
+    def _samples(self, values, value):
+        yield f"{self.name}{_labels(self.labels, values)} {_number(value)}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in sorted(self._series().items()):
+            lines.extend(self._samples(values, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *values, amount=1):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        with self.lock:
+            self.values[values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(values)
+            if series is None:
+                series = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *values):
+        """Context manager that observes how long its block took."""
+        return _Timer(self, values)
+
+    def _copy(self, value):
+        return [list(value[0]), value[1]]
+
+    def _samples(self, values, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield f"{self.name}_bucket{_labels(self.labels, values, [('le', _number(bound))])} {cumulative}"
+        yield f"{self.name}_sum{_labels(self.labels, values)} {_number(total)}"
+        yield f"{self.name}_count{_labels(self.labels, values)} {cumulative}"
+
+
+class _Timer:
+    __slots__ = ('histogram', 'values', 'start')
+
+    def __init__(self, histogram, values):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.values)
+
+
+class TimedLock:
+    """Lock that records how long callers waited for it and then held it."""
+
+    def __init__(self, wait, hold, lock=None):
+        self.wait = wait
+        self.hold = hold
+        self.lock = lock or threading.Lock()
+        self.acquired = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        # Only the holder writes this, so it needs no protection of its own
+        self.acquired = time.perf_counter()
+        self.wait.observe(self.acquired - start)
+        return self
+
+    def __exit__(self, *exc):
+        self.hold.observe(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
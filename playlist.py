@@ -0,0 +1,74 @@
+"""HLS-style playlists of a stream's chunks, and HTTP caching of chunks.
+
+A chunk never changes once it has been saved, and its id is never reused,
+so a chunk (in a given format) can be served with a strong ETag derived
+from its id and cached forever. HTTP caches and reverse proxies in front
+of the server can then answer repeated requests from many listeners
+themselves. The playlist lists chunk URLs with their durations and is the
+only response that changes while a stream is live.
+"""
+import hashlib
+import math
+
+CONTENT_TYPE = 'application/vnd.apple.mpegurl'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def chunk_etag(chunk_id, format_key=None):
+    """Returns the (unquoted) ETag of a chunk, as stored or converted to the format with `format_key`."""
+    key = chunk_id if format_key is None else f"{chunk_id}@{format_key}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def body_etag(body):
+    return hashlib.sha1(body.encode()).hexdigest()
+
+
+def cache_control(is_live, chunk_duration):
+    # Live playlists may be reused for half a chunk, as HLS clients expect;
+    # ended ones only change if the stream is imported again
+    return f"public, max-age={max(int(chunk_duration) // 2, 1)}" if is_live else 'public, max-age=86400'
+
+
+def render(entries, rate, is_live, chunk_url, window=None):
+    """Renders the playlist of a stream's index entries (start and frames in sample frames at `rate`).
+
+    Chunks that do not follow on from the one before, after a long gap or
+    skipped silence, are marked as discontinuities. With `window`, only the
+    last `window` chunks are listed, as in an HLS live playlist. `entries`
+    is the whole index, so the media sequence number of each chunk is its
+    position in it: chunks only ever follow the ones before them, whatever
+    their length, and keep their number as the window slides.
+    """
+    if window is not None and window <= 0:
+        window = None
+    first = max(len(entries) - window, 0) if window else 0
+    lines = []
+    discontinuities = 0
+    end = None
+    target = 1
+    for number, entry in enumerate(entries):
+        jump = end is not None and entry['start'] != end
+        end = entry['start'] + entry['frames']
+        if number < first:
+            discontinuities += jump
+            continue
+        if jump:
+            lines.append('#EXT-X-DISCONTINUITY')
+        duration = entry['frames'] / rate
+        target = max(target, math.ceil(duration))
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(chunk_url(entry['chunk_id']))
+
+    header = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f"#EXT-X-TARGETDURATION:{target}",
+        f"#EXT-X-MEDIA-SEQUENCE:{first}",
+    ]
+    if discontinuities:
+        header.append(f"#EXT-X-DISCONTINUITY-SEQUENCE:{discontinuities}")
+    if not window:
+        header.append(f"#EXT-X-PLAYLIST-TYPE:{'EVENT' if is_live else 'VOD'}")
+    footer = [] if is_live else ['#EXT-X-ENDLIST']
+    return '\n'.join(header + lines + footer) + '\n'
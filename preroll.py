@@ -0,0 +1,58 @@
+"""The last seconds of a live stream's audio, for listeners that join it.
+
+A listener that joins a live stream starts from live audio instead of
+downloading every recorded chunk first. To give it something to play at
+once, each live stream keeps the packets it broadcast most recently in
+memory, as they were sent, and the server sends the last few seconds of
+them to the listener as it joins, as a single message framed as in
+ingest.py, before the listener enters the live room. Every packet is
+tagged with the sample frame it starts at, so a listener can drop a packet
+it gets both from the pre-roll and from the live broadcast, and play
+packets in order whichever it handles first.
+"""
+from collections import deque
+
+import ingest
+
+
+class RecentAudio:
+    """Ring of the most recent packets of a stream, covering at least `seconds` of audio."""
+
+    def __init__(self, rate, seconds):
+        self.limit = int(rate * seconds)
+        self.packets = deque()  # (start frame, encoded audio or None for silence, frames)
+        self.frames = 0
+
+    def add(self, start, data, frames):
+        if self.limit <= 0:
+            return
+        self.packets.append((start, data, frames))
+        self.frames += frames
+        # Drop old packets once the rest still covers the limit
+        while self.frames - self.packets[0][2] >= self.limit:
+            self.frames -= self.packets.popleft()[2]
+
+    def last(self, frames):
+        """Returns the newest packets that together cover `frames` sample frames, oldest first."""
+        packets = list(self.packets)
+        count = 0
+        covered = 0
+        while count < len(packets) and covered < frames:
+            count += 1
+            covered += packets[-count][2]
+        return packets[len(packets) - count:]
+
+    def clear(self):
+        self.packets.clear()
+        self.frames = 0
+
+
+def pack(packets):
+    """Frames (start, audio or None for silence, frames) packets into the body of one pre-roll message."""
+    return b''.join(ingest.pack(number, start, data) if data is not None else ingest.pack(number, start, silence=frames)
+                    for number, (start, data, frames) in enumerate(packets))
+
+
+def unpack(data):
+    """Returns the (start, audio, silence) of every packet of a pre-roll message."""
+    return [(start, audio, silence) for _, start, audio, silence in ingest.FrameReader().feed(data)]
@@ -6,8 +6,13 @@ import requests
 import pyaudio
 import threading
 import queue
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from socketio import Client
 import json
+from audio_codecs import get_codec
+import preroll
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Audio Streaming Receiver')
@@ -15,11 +20,19 @@ def parse_args():
     parser.add_argument('--stream-id', '-i', required=True, help='Stream ID to listen to')
     parser.add_argument('--device', '-d', type=int, default=None, help='Output device index')
     parser.add_argument('--list-devices', '-l', action='store_true', help='List available audio devices and exit')
-    parser.add_argument('--channels', '-c', type=int, default=1, help='Number of channels (1=mono, 2=stereo)')
-    parser.add_argument('--rate', '-r', type=int, default=44100, help='Sample rate in Hz')
+    parser.add_argument('--channels', '-c', type=int, default=None, help="Number of channels (1=mono, 2=stereo); default: the stream's")
+    parser.add_argument('--rate', '-r', type=int, default=None, help="Sample rate in Hz; default: the stream's")
+    parser.add_argument('--codec', default=None, help="Codec to receive audio in, e.g. ulaw for a lighter feed; default: the stream's")
     parser.add_argument('--format', '-f', type=int, default=pyaudio.paInt16, help='Audio format')
     parser.add_argument('--buffer-size', '-b', type=int, default=10, help='Audio buffer size (number of chunks)')
     parser.add_argument('--chunk', type=int, default=1024, help='Frames per buffer')
+    parser.add_argument('--prefetch', type=int, default=4, help='Number of chunks to download ahead of playback')
+    parser.add_argument('--prefetch-workers', type=int, default=4, help='Maximum number of concurrent chunk downloads')
+    parser.add_argument('--min-delay', type=float, default=0.05, help='Minimum live buffering delay in seconds')
+    parser.add_argument('--max-delay', type=float, default=2.0, help='Maximum live buffering delay in seconds')
+    parser.add_argument('--preroll', type=float, default=1.0,
+                        help='Seconds of audio from just before joining a live stream to start with (at most --max-delay)')
+    parser.add_argument('--from-start', action='store_true', help='Play a live stream from its first recorded chunk instead of from live audio')
     
     return parser.parse_args()
 
@@ -36,33 +49,189 @@ def list_audio_devices():
     
     p.terminate()
 
+def owner_url(response):
+    # Servers running several workers redirect to the one that owns the stream
+    return response.url.split('/api/', 1)[0]
+
 def get_stream_info(server_url, stream_id):
     try:
         response = requests.get(f"{server_url}/api/streams/{stream_id}/chunks")
         if response.status_code != 200:
             print(f"Error: {response.text}")
-            return None
+            return None, server_url
         
-        return response.json()
+        return response.json(), owner_url(response)
     except Exception as e:
         print(f"Error getting stream info: {e}")
-        return None
+        return None, server_url
 
-def play_chunk(server_url, chunk_id, audio_queue):
-    try:
-        response = requests.get(f"{server_url}/api/chunks/{chunk_id}")
-        if response.status_code == 200:
-            audio_queue.put(response.content)
-    except Exception as e:
-        print(f"Error fetching chunk {chunk_id}: {e}")
+class ChunkPrefetcher:
+    """Downloads chunks ahead of playback and hands them over strictly in order.
+
+    At most `window` chunks are in flight at once, fetched by a fixed pool
+    of workers over one keep-alive session. Chunks are named by the frame
+    they start at, so stretches the server did not store, such as gated
+    silence, are handed over as silence of the same length.
+    """
+
+    def __init__(self, server_url, audio_queue, audio_format, window=4, workers=4):
+        self.server_url = server_url
+        self.audio_queue = audio_queue
+        self.window = window
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.params = {}  # target format for servers that convert chunks
+        self.source_rate = audio_format['rate']  # chunk names count frames at the stream's own rate
+        self.format = audio_format  # format chunks are delivered in
+        self.position = None  # seconds into the stream where the last chunk ended
+        self.pending = queue.Queue()
+        self.seen = set()
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, chunk_id):
+        with self.lock:
+            # The chunk list is sent again on every (re)join
+            if chunk_id in self.seen:
+                return
+            self.seen.add(chunk_id)
+            self.outstanding += 1
+        self.pending.put(chunk_id)
+
+    def idle(self):
+        return self.outstanding == 0
+
+    def _fetch(self, chunk_id):
+        response = self.session.get(f"{self.server_url}/api/chunks/{chunk_id}", params=self.params)
+        response.raise_for_status()
+        return response.content
+
+    def _deliver(self, chunk_id, data):
+        try:
+            start = int(chunk_id.rsplit('/', 1)[-1].split('.')[0]) / self.source_rate
+        except ValueError:
+            start = None
+        # Silence goes in the queue as a frame count
+        if start is not None and self.position is not None and start - self.position > 0.01:
+            self.audio_queue.put(round((start - self.position) * self.format['rate']))
+        self.audio_queue.put(data)
+        if start is not None:
+            fmt = self.format
+            self.position = start + get_codec(fmt['codec']).frames(data, fmt) / fmt['rate']
+
+    def _run(self):
+        inflight = deque()
+        while True:
+            try:
+                while len(inflight) < self.window:
+                    if inflight:
+                        chunk_id = self.pending.get_nowait()
+                    else:
+                        chunk_id = self.pending.get(timeout=0.5)
+                    inflight.append((chunk_id, self.executor.submit(self._fetch, chunk_id)))
+            except queue.Empty:
+                pass
+                
+            if not inflight:
+                continue
+                
+            chunk_id, future = inflight.popleft()
+            try:
+                self._deliver(chunk_id, future.result())
+            except Exception as e:
+                print(f"Error fetching chunk {chunk_id}: {e}")
+            finally:
+                with self.lock:
+                    self.outstanding -= 1
+
+class JitterBuffer:
+    """Holds back live audio just long enough to ride out network jitter.
+
+    Packet inter-arrival times are tracked with exponentially weighted mean
+    and variance; playback starts (and restarts after an underrun) once the
+    buffered audio covers the mean gap plus four standard deviations, kept
+    between min_delay and max_delay. Audio beyond max_delay is dropped so
+    playback skips ahead instead of falling behind. Packets tagged with the
+    sample frame they start at are kept in that order, whatever order their
+    handlers run in, and one that was already buffered or played (sent both
+    as pre-roll and live) is dropped.
+    """
 
-def connect_to_socket_io(server_url, stream_id, audio_queue):
+    def __init__(self, min_delay=0.05, max_delay=2.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.packets = deque()  # (start frame or None, audio, duration)
+        self.played = None  # start frame of the last tagged packet played or dropped
+        self.buffered = 0.0
+        self.buffering = True
+        self.last_arrival = None
+        self.mean_gap = 0.0
+        self.gap_var = 0.0
+        self.dropped = 0
+        self.underruns = 0
+        self.cond = threading.Condition()
+
+    def target_delay(self):
+        return min(max(self.mean_gap + 4 * math.sqrt(self.gap_var), self.min_delay), self.max_delay)
+
+    def put(self, data, duration, start=None):
+        with self.cond:
+            now = time.monotonic()
+            if self.last_arrival is not None:
+                gap = now - self.last_arrival
+                deviation = gap - self.mean_gap
+                self.mean_gap += deviation / 16
+                self.gap_var += (deviation * deviation - self.gap_var) / 16
+            self.last_arrival = now
+            
+            position = len(self.packets)
+            if start is not None:
+                if self.played is not None and start <= self.played:
+                    return
+                if any(packet[0] == start for packet in self.packets):
+                    return
+                while position > 0 and self.packets[position - 1][0] is not None and self.packets[position - 1][0] > start:
+                    position -= 1
+            self.packets.insert(position, (start, data, duration))
+            self.buffered += duration
+            while self.buffered > self.max_delay and len(self.packets) > 1:
+                old_start, _, old_duration = self.packets.popleft()
+                self.buffered -= old_duration
+                self.dropped += 1
+                if old_start is not None:
+                    self.played = old_start
+            self.cond.notify()
+
+    def get(self, timeout):
+        with self.cond:
+            deadline = time.monotonic() + timeout
+            while not self.packets or (self.buffering and self.buffered < self.target_delay()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                self.cond.wait(remaining)
+                
+            self.buffering = False
+            start, data, duration = self.packets.popleft()
+            if start is not None:
+                self.played = start
+            self.buffered -= duration
+            if not self.packets:
+                self.buffering = True
+                self.underruns += 1
+            return data
+
+def connect_to_socket_io(server_url, stream_id, prefetcher, jitter_buffer, target, state, preroll_seconds=0, history=False):
     sio = Client()
     
     @sio.event
     def connect():
         print(f"🔌 Connected to server! Joining stream {stream_id}")
-        sio.emit('join_stream', {'stream_id': stream_id})
+        sio.emit('join_stream', {'stream_id': stream_id, 'format': target, 'preroll': preroll_seconds, 'history': history})
     
     @sio.event
     def disconnect():
@@ -72,18 +241,50 @@ def connect_to_socket_io(server_url, stream_id, audio_queue):
     def on_joined(data):
         print(f"Joined stream. Live: {data['is_live']}, Chunks: {len(data['chunks'])}")
         
-        # Queue up existing chunks for playback
+        # The server converts to the requested format; older servers send the stream's own
+        if 'format' in data:
+            state['format'] = prefetcher.format = data['format']
+            prefetcher.params = target
+        elif target:
+            print("Server cannot convert audio, playing the stream's own format")
+        state['joined'].set()
+        
+        # Queue up existing chunks for playback; a live stream joined without
+        # its history plays live audio straight away
+        if data['is_live'] and not data['chunks']:
+            state['live'] = True
+            print("📡 Playing live audio")
         for chunk_id in data['chunks']:
-            threading.Thread(target=play_chunk, args=(server_url, chunk_id, audio_queue)).start()
+            prefetcher.add(chunk_id)
     
     @sio.on('audio_data')
     def on_audio_data(data):
-        if data['stream_id'] == stream_id:
-            audio_queue.put(data['data'])
+        if data['stream_id'] != stream_id:
+            return
+        # Audio sent as pre-roll may arrive again from the live broadcast, and
+        # either may be handled first; the jitter buffer orders them by start
+        audio_format = state['format']
+        if 'silence' in data:
+            # Silence comes as a frame count and is played as such
+            jitter_buffer.put(data['silence'], data['silence'] / audio_format['rate'], data.get('start'))
+        else:
+            duration = get_codec(audio_format['codec']).frames(data['data'], audio_format) / audio_format['rate']
+            jitter_buffer.put(data['data'], duration, data.get('start'))
+    
+    @sio.on('preroll')
+    def on_preroll(data):
+        # The audio from just before joining, as packets of live audio
+        for start, audio, silence in preroll.unpack(data['data']):
+            if silence is not None:
+                on_audio_data({'stream_id': data['stream_id'], 'start': start, 'silence': silence})
+            else:
+                on_audio_data({'stream_id': data['stream_id'], 'start': start, 'data': audio})
     
     @sio.on('new_chunk')
     def on_new_chunk(data):
-        threading.Thread(target=play_chunk, args=(server_url, data['chunk_id'], audio_queue)).start()
+        # Once playback has caught up, new chunks have already been heard live
+        if not state['live']:
+            prefetcher.add(data['chunk_id'])
     
     @sio.on('error')
     def on_error(data):
@@ -96,14 +297,38 @@ def connect_to_socket_io(server_url, stream_id, audio_queue):
         print(f"Error connecting to server: {e}")
         return None
 
-def play_audio(args, audio_queue):
+def next_audio(audio_queue, prefetcher, jitter_buffer, state, timeout):
+    # Recorded chunks are played first; live audio takes over once they run out
+    try:
+        return audio_queue.get_nowait()
+    except queue.Empty:
+        pass
+        
+    if not prefetcher.idle():
+        return audio_queue.get(timeout=timeout)
+        
+    if not state['live']:
+        state['live'] = True
+        print("📡 Caught up, playing live audio")
+    return jitter_buffer.get(timeout)
+
+def play_silence(stream, frames, audio_format):
+    # Written a second at a time so long silences need no large buffer
+    frame_bytes = audio_format['channels'] * audio_format['sample_width']
+    while frames > 0:
+        count = min(frames, audio_format['rate'])
+        stream.write(bytes(count * frame_bytes))
+        frames -= count
+
+def play_audio(args, audio_queue, prefetcher, jitter_buffer, audio_format, state):
     p = pyaudio.PyAudio()
+    codec = get_codec(audio_format['codec'])
     
     # Open audio stream
     stream = p.open(
-        format=args.format,
-        channels=args.channels,
-        rate=args.rate,
+        format=p.get_format_from_width(audio_format['sample_width']),
+        channels=audio_format['channels'],
+        rate=audio_format['rate'],
         output=True,
         output_device_index=args.device,
         frames_per_buffer=args.chunk
@@ -114,8 +339,11 @@ def play_audio(args, audio_queue):
     try:
         while True:
             try:
-                data = audio_queue.get(timeout=1)
-                stream.write(data)
+                data = next_audio(audio_queue, prefetcher, jitter_buffer, state, timeout=1)
+                if isinstance(data, int):
+                    play_silence(stream, data, audio_format)
+                else:
+                    stream.write(codec.decode(data, audio_format))
             except queue.Empty:
                 # No data available, just continue
                 pass
@@ -138,7 +366,7 @@ def main():
     stream_id = args.stream_id
     
     # Check if stream exists
-    stream_info = get_stream_info(server_url, stream_id)
+    stream_info, server_url = get_stream_info(server_url, stream_id)
     if not stream_info:
         print(f"Stream {stream_id} not found")
         return
@@ -147,16 +375,42 @@ def main():
     print(f"Live: {stream_info['is_live']}")
     print(f"Chunks: {len(stream_info['chunks'])}")
     
+    # Older servers do not report a format; their streams are always raw PCM
+    audio_format = stream_info.get('format', {
+        'rate': args.rate or 44100,
+        'channels': args.channels or 1,
+        'sample_width': pyaudio.get_sample_size(args.format),
+        'codec': 'pcm'
+    })
+    print(f"Codec: {audio_format['codec']}")
+    
+    # Ask the server for any field that differs from the stream's own format
+    target = {key: value for key, value in [('rate', args.rate), ('channels', args.channels), ('codec', args.codec)]
+              if value is not None and value != audio_format[key]}
+    
     # Create audio queue for communication between threads
     audio_queue = queue.Queue(maxsize=args.buffer_size)
+    prefetcher = ChunkPrefetcher(server_url, audio_queue, audio_format, window=args.prefetch, workers=args.prefetch_workers)
+    jitter_buffer = JitterBuffer(min_delay=args.min_delay, max_delay=args.max_delay)
+    state = {'live': False, 'format': audio_format, 'joined': threading.Event()}
     
-    # Connect to socket.io server
-    sio = connect_to_socket_io(server_url, stream_id, audio_queue)
+    # Connect to socket.io server; live streams start from live audio unless asked to play from the start
+    sio = connect_to_socket_io(server_url, stream_id, prefetcher, jitter_buffer, target, state,
+                               preroll_seconds=args.preroll, history=args.from_start)
     if not sio:
         return
+        
+    # Playback is opened in the format the server confirms when joining
+    if not state['joined'].wait(10):
+        print("Could not join the stream")
+        sio.disconnect()
+        return
+    if target:
+        print(f"Receiving {state['format']['rate']} Hz, {state['format']['channels']} channel(s), {state['format']['codec']}")
     
     # Start audio playback in a separate thread
-    playback_thread = threading.Thread(target=play_audio, args=(args, audio_queue))
+    playback_thread = threading.Thread(target=play_audio,
+                                       args=(args, audio_queue, prefetcher, jitter_buffer, state['format'], state))
     playback_thread.daemon = True
     playback_thread.start()
     
@@ -12,7 +12,7 @@ echo "Current time with TZ adjustment: $(date)"
 
 # Copy server code to EC2 instance
 echo "Copying server code to EC2..."
-scp -i "$KEY_FILE" -o StrictHostKeyChecking=no server.py ec2-user@$PUBLIC_DNS:~/
+scp -i "$KEY_FILE" -o StrictHostKeyChecking=no server.py audio_codecs.py sharding.py metrics.py segments.py playlist.py chunk_index.py ingest.py preroll.py export.py ec2-user@$PUBLIC_DNS:~/
 
 # Connect to instance and run setup commands
 echo "Setting up server environment..."
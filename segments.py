@@ -0,0 +1,86 @@
+"""Segment files that hold many chunks of one stream.
+
+Every stream stores a chunk each CHUNK_DURATION seconds, so long recordings
+turn into thousands of small objects. Compaction copies runs of finished
+chunks into one segment each: a short header followed by the chunks' bytes
+back to back. The header carries the stream's format and an index of the
+chunks with their offsets, so a segment describes itself and every chunk
+can be read back as a byte range without fetching the rest.
+
+    MAGIC (8 bytes) | header length (4 bytes, big-endian) | JSON header | chunk data
+
+Chunks keep their ids after compaction; only the registry learns which
+segment, and which offset in it, now holds each one.
+"""
+import json
+import struct
+
+MAGIC = b'SNKSEG1\n'
+PREFIX = struct.Struct('>8sI')
+SEGMENT_BYTES = 64 * 1024 * 1024  # chunk data gathered into one segment
+SEGMENT_DIR = 'segments'
+
+
+def segment_id(stream_id, start):
+    """Names a segment by the sample frame its first chunk starts at, next to the stream's chunks."""
+    return f"{stream_id}/{SEGMENT_DIR}/{start}.seg"
+
+
+def plan(entries, segment_bytes=SEGMENT_BYTES, final=False):
+    """Groups the index entries that are not in a segment yet into runs, one per new segment.
+
+    A run is cut once it holds segment_bytes of chunk data. The last, shorter
+    run is only returned when `final` is set, e.g. because the stream has
+    ended, so live streams are compacted in full segments.
+    """
+    runs = []
+    run = []
+    size = 0
+    for entry in entries:
+        if 'segment' in entry:
+            continue
+        run.append(entry)
+        size += entry['bytes']
+        if size >= segment_bytes:
+            runs.append(run)
+            run = []
+            size = 0
+    if run and final:
+        runs.append(run)
+    return runs
+
+
+def write(f, stream_id, audio_format, entries, chunks):
+    """Writes a segment of `chunks`, the contents of `entries`, to a file object.
+
+    Returns the offset of each chunk from the start of the segment.
+    """
+    index = []
+    position = 0
+    for entry, data in zip(entries, chunks):
+        chunk = {key: value for key, value in entry.items() if key not in ('segment', 'offset')}
+        chunk.update(offset=position, bytes=len(data))
+        index.append(chunk)
+        position += len(data)
+
+    header = json.dumps({'stream_id': stream_id, 'format': audio_format, 'chunks': index}).encode()
+    f.write(PREFIX.pack(MAGIC, len(header)))
+    f.write(header)
+    for data in chunks:
+        f.write(data)
+    return [PREFIX.size + len(header) + chunk['offset'] for chunk in index]
+
+
+def read_header(read):
+    """Reads a segment's header with `read(offset, size)`.
+
+    Returns the header with chunk offsets counted from the start of the
+    segment, ready to be stored as index entries.
+    """
+    magic, length = PREFIX.unpack(read(0, PREFIX.size))
+    if magic != MAGIC:
+        raise ValueError('Not a segment file')
+    header = json.loads(read(PREFIX.size, length))
+    for chunk in header['chunks']:
+        chunk['offset'] += PREFIX.size + length
+    return header
@@ -20,11 +20,11 @@ aws ec2 authorize-security-group-ingress \
   --cidr 0.0.0.0/0 \
   --profile emeraldflow
 
-# Port for audio streaming
+# Ports for audio streaming: 8000, plus one per worker when the server runs with --workers (up to 16)
 aws ec2 authorize-security-group-ingress \
   --group-id $SECURITY_GROUP_ID \
   --protocol tcp \
-  --port 8000 \
+  --port 8000-8016 \
   --cidr 0.0.0.0/0 \
   --profile emeraldflow
 
@@ -6,7 +6,7 @@ source ./ec2-info.sh
 echo "Setting up audio streaming server on $PUBLIC_DNS..."
 
 # Copy server code to EC2 instance
-scp -i audio-streamer-key.pem server.py ec2-user@$PUBLIC_DNS:~/
+scp -i audio-streamer-key.pem server.py audio_codecs.py sharding.py metrics.py segments.py playlist.py chunk_index.py ingest.py preroll.py export.py ec2-user@$PUBLIC_DNS:~/
 
 # Connect to instance and run setup commands
 ssh -i audio-streamer-key.pem ec2-user@$PUBLIC_DNS << 'EOF'
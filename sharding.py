@@ -0,0 +1,228 @@
+"""Runs a server script as several worker processes on one machine.
+
+Streams are assigned to workers by a hash of their id. The parent process
+listens on the public port and redirects every request to the worker that
+owns the stream it names; clients follow the redirect once and then talk to
+that worker directly, for HTTP and Socket.IO alike. Socket.IO events other
+than live audio are relayed between workers over a Unix socket, so room
+events such as new_chunk reach listeners connected to any worker.
+"""
+import itertools
+import os
+import pickle
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+import zlib
+import socketio
+from flask import Flask, jsonify, redirect, request
+from werkzeug.serving import make_server
+
+
+def shard_for(stream_id, workers):
+    # hash() is randomized per process, every worker must agree on the owner
+    return zlib.crc32(stream_id.encode()) % workers
+
+
+def new_stream_id(index=0, workers=1):
+    """Returns a new stream id owned by the given worker."""
+    while True:
+        stream_id = str(uuid.uuid4())
+        if shard_for(stream_id, workers) == index:
+            return stream_id
+
+
+def path_stream_id(path):
+    parts = path.strip('/').split('/')
+    if len(parts) >= 3 and parts[0] == 'api' and parts[1] in ('streams', 'chunks'):
+        return parts[2]
+    return None
+
+
+def worker_port(base_port, index):
+    return base_port + 1 + index
+
+
+def worker_url(base_port, index, path=None):
+    host = request.host
+    if not host.endswith(']'):  # a bare IPv6 literal has no port to strip
+        host = host.rsplit(':', 1)[0]
+    if path is None:
+        path = request.full_path if request.query_string else request.path
+    return f"{request.scheme}://{host}:{worker_port(base_port, index)}{path}"
+
+
+def _send_message(sock, payload):
+    sock.sendall(struct.pack('<I', len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            return None
+        data += part
+    return bytes(data)
+
+
+def _recv_message(sock):
+    header = _recv_exact(sock, 4)
+    if header is None:
+        return None
+    size, = struct.unpack('<I', header)
+    return _recv_exact(sock, size)
+
+
+class RelayHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.clients.append(self.request)
+        try:
+            while True:
+                message = _recv_message(self.request)
+                if message is None:
+                    break
+                self.server.forward(message)
+        finally:
+            with self.server.lock:
+                self.server.clients.remove(self.request)
+
+
+class RelayHub(socketserver.ThreadingUnixStreamServer):
+    """Forwards every message from one worker to all workers, the sender included."""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.clients = []
+        self.lock = threading.Lock()
+        super().__init__(path, RelayHandler)
+
+    def forward(self, message):
+        with self.lock:
+            for client in self.clients:
+                try:
+                    _send_message(client, message)
+                except OSError:
+                    pass
+
+
+class RelayManager(socketio.PubSubManager):
+    """Socket.IO client manager that shares events through a RelayHub."""
+
+    name = 'relay'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        self.path = path
+        self.sock = None
+        self.connect_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _connect(self):
+        with self.connect_lock:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+            return self.sock
+
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        with self.send_lock:
+            _send_message(self._connect(), payload)
+
+    def _listen(self):
+        sock = self._connect()
+        while True:
+            message = _recv_message(sock)
+            if message is None:
+                return
+            yield message
+
+
+def install_worker(app, server, index, workers, port, relay_path):
+    """Sets a worker up to relay Socket.IO events and redirect requests for streams it does not own.
+
+    Must be called before the server accepts connections, while its client
+    manager has not been initialized yet.
+    """
+    manager = RelayManager(relay_path)
+    manager.set_server(server)
+    server.manager = manager
+    base_port = port - 1 - index
+
+    @app.before_request
+    def route_to_owner():
+        stream_id = path_stream_id(request.path)
+        if stream_id is not None and shard_for(stream_id, workers) != index:
+            return redirect(worker_url(base_port, shard_for(stream_id, workers)), code=307)
+
+
+def create_router(port, workers):
+    router = Flask(__name__)
+    next_worker = itertools.count()
+
+    @router.route('/api/workers')
+    def list_workers():
+        return jsonify({'workers': [worker_url(port, index, '') for index in range(workers)]})
+
+    @router.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
+    @router.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+    def route(path):
+        stream_id = path_stream_id(request.path)
+        if stream_id is not None:
+            index = shard_for(stream_id, workers)
+        elif request.method == 'POST':
+            # New streams are spread round-robin; the worker picks an id it owns
+            index = next(next_worker) % workers
+        else:
+            index = request.args.get('worker', 0, type=int) % workers
+        return redirect(worker_url(port, index), code=307)
+
+    return router
+
+
+def run_workers(script, argv, host, port, workers):
+    """Starts one process per worker and routes requests to them until interrupted.
+
+    Each worker runs `script` with `argv` plus its own --port, --worker-index
+    and --relay options; workers listen on the ports after `port`.
+    """
+    relay_dir = tempfile.mkdtemp(prefix='audio-relay-')
+    relay_path = os.path.join(relay_dir, 'relay.sock')
+    hub = RelayHub(relay_path)
+    threading.Thread(target=hub.serve_forever, daemon=True).start()
+
+    processes = []
+    for index in range(workers):
+        processes.append(subprocess.Popen([sys.executable, script] + argv + [
+            '--port', str(worker_port(port, index)),
+            '--worker-index', str(index),
+            '--relay', relay_path
+        ]))
+        print(f"Started worker {index} on port {worker_port(port, index)}")
+
+    router = make_server(host, port, create_router(port, workers), threaded=True)
+    try:
+        router.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.server_close()
+        # SIGINT lets workers finish their shutdown work, such as pending uploads
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+        hub.shutdown()
+        hub.server_close()
+        shutil.rmtree(relay_dir, ignore_errors=True)
@@ -0,0 +1,29 @@
+from chunk_index import ChunkIndex, gaps_to_silence
+
+
+def test_gaps_to_silence_moves_only_the_covered_frames():
+    gaps = [[100, 50], [400, 100]]
+    silence = [[0, 20]]
+    assert gaps_to_silence(gaps, silence, 120, 450) == 80
+    assert gaps == [[100, 20], [450, 50]]
+    assert silence == [[0, 20], [120, 30], [400, 50]]
+
+
+def test_mark_silence_reaches_the_chunk_after_a_long_gap():
+    index = ChunkIndex('s', 'raw', [
+        {'chunk_id': 's/0.raw', 'start': 0, 'frames': 100, 'bytes': 200, 'gaps': [[50, 10]]},
+        {'chunk_id': 's/1000.raw', 'start': 1000, 'frames': 100, 'bytes': 200, 'gaps': [[100, 900]]},
+        {'chunk_id': 's/1100.raw', 'start': 1100, 'frames': 100, 'bytes': 200},
+    ])
+    changed, marked = index.mark_silence(55, 600)
+    assert marked == 505
+    assert [entry['chunk_id'] for entry in changed] == ['s/0.raw', 's/1000.raw']
+    assert index.find('s/0.raw')['gaps'] == [[50, 5]]
+    assert index.find('s/0.raw')['silence'] == [[55, 5]]
+    assert index.find('s/1000.raw')['gaps'] == [[600, 400]]
+    assert index.find('s/1000.raw')['silence'] == [[100, 500]]
+
+    changed, marked = index.mark_silence(600, 1000)
+    assert marked == 400
+    assert 'gaps' not in index.find('s/1000.raw')
+    assert index.find('s/1000.raw')['silence'] == [[100, 500], [600, 400]]
@@ -0,0 +1,47 @@
+import playlist
+
+RATE = 100
+
+
+def chunk_url(chunk_id):
+    return f"/api/chunks/{chunk_id}"
+
+
+def header(body, tag):
+    return next(line.split(':', 1)[1] for line in body.splitlines() if line.startswith(f"#{tag}:"))
+
+
+def numbered(body):
+    """Returns {chunk URL: media sequence number} of the segments in a playlist."""
+    urls = [line for line in body.splitlines() if line and not line.startswith('#')]
+    first = int(header(body, 'EXT-X-MEDIA-SEQUENCE'))
+    return {url: first + number for number, url in enumerate(urls)}
+
+
+def test_sequence_numbers_stay_with_irregular_chunks_as_the_window_slides():
+    # Full chunks, a short one at a gap restart, skipped silence and a short one at the end
+    lengths = [(0, 500), (500, 500), (1000, 120), (1500, 500), (2000, 500), (9000, 500), (9500, 500), (10000, 37)]
+    entries = [{'chunk_id': f"s/{start}.raw", 'start': start, 'frames': frames} for start, frames in lengths]
+
+    seen = {}
+    for count in range(1, len(entries) + 1):
+        body = playlist.render(entries[:count], RATE, True, chunk_url, window=3)
+        for url, number in numbered(body).items():
+            assert seen.setdefault(url, number) == number
+    assert sorted(seen.values()) == list(range(len(entries)))
+
+
+def test_window_that_starts_at_a_later_chunk_is_numbered_after_the_first():
+    entries = [{'chunk_id': f"s/{start}.raw", 'start': start, 'frames': frames}
+               for start, frames in [(0, 500), (500, 30), (530, 500), (132300, 500)]]
+    assert header(playlist.render(entries[:2], RATE, True, chunk_url, window=2), 'EXT-X-MEDIA-SEQUENCE') == '0'
+    assert header(playlist.render(entries, RATE, True, chunk_url, window=2), 'EXT-X-MEDIA-SEQUENCE') == '2'
+
+
+def test_whole_playlist_of_an_ended_stream():
+    entries = [{'chunk_id': 's/0.raw', 'start': 0, 'frames': 500}, {'chunk_id': 's/900.raw', 'start': 900, 'frames': 250}]
+    body = playlist.render(entries, RATE, False, chunk_url)
+    assert header(body, 'EXT-X-MEDIA-SEQUENCE') == '0'
+    assert header(body, 'EXT-X-PLAYLIST-TYPE') == 'VOD'
+    assert '#EXT-X-DISCONTINUITY' in body.splitlines()
+    assert body.endswith('#EXT-X-ENDLIST\n')
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+import preroll
+
+server = pytest.importorskip('server')
+
+RATE = 8000
+PACKET_FRAMES = 80
+
+
+def packet(number):
+    return number * PACKET_FRAMES, bytes([number]) * PACKET_FRAMES * 2
+
+
+def broadcast(stream, number):
+    """Records a packet and waits until the broadcaster has sent it to the live room."""
+    start, data = packet(number)
+    stream.recent.add(start, data, PACKET_FRAMES)
+    server.broadcaster.publish(stream.stream_id, start, data)
+    deadline = time.monotonic() + 5
+    while not server.broadcaster.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with server.broadcaster.emitting:
+        pass
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    stream = server.AudioStream('preroll-test', {'rate': RATE, 'channels': 1, 'sample_width': 2, 'codec': 'pcm'})
+    monkeypatch.setitem(server.ACTIVE_STREAMS, stream.stream_id, stream)
+    yield stream
+    server.LISTENERS.pop(stream.stream_id, None)
+
+
+def test_live_packet_broadcast_while_a_listener_joins_comes_after_the_preroll(stream, monkeypatch):
+    for number in range(10):
+        start, data = packet(number)
+        stream.recent.add(start, data, PACKET_FRAMES)
+
+    # A packet goes out live while the listener's pre-roll is being built
+    build = server.preroll_packets
+
+    def preroll_packets(stream, converter, frames, after=None):
+        packets = build(stream, converter, frames, after)
+        if after is None:
+            broadcast(stream, 10)
+        return packets
+
+    monkeypatch.setattr(server, 'preroll_packets', preroll_packets)
+    client = server.socketio.test_client(server.app)
+    client.emit('join_stream', {'stream_id': stream.stream_id, 'preroll': 1})
+    broadcast(stream, 11)
+
+    received = [event for event in client.get_received() if event['name'] in ('preroll', 'audio_data')]
+    client.disconnect()
+    assert received[0]['name'] == 'preroll'
+    starts = [start for start, _, _ in preroll.unpack(received[0]['args'][0]['data'])]
+    live = [event['args'][0]['start'] for event in received[1:]]
+    # Nothing is missing between the pre-roll and live audio, nor sent twice
+    assert starts == [number * PACKET_FRAMES for number in range(11)]
+    assert live == [11 * PACKET_FRAMES]